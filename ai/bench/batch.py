@@ -0,0 +1,64 @@
+"""Compare N serial /chat calls with one /chat/batch call of N items.
+
+Example (service on :8000 pointed at bench.stub_upstream on :9000):
+    python -m bench.batch --base http://127.0.0.1:8000 -n 50
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+
+def _item(i: int) -> dict:
+    return {"user_id": 1, "org_id": 1, "message": f"prod order #{i} holati", "context": {"prod_order_id": i}}
+
+
+async def _run(base: str, n: int, stream: bool) -> dict:
+    async with httpx.AsyncClient(base_url=base, timeout=600) as c:
+        t0 = time.perf_counter()
+        for i in range(n):
+            (await c.post("/chat", json=_item(i))).raise_for_status()
+        serial = time.perf_counter() - t0
+
+        # Distinct messages so the cache/coalescing layers do not skew the batch run
+        body = {"items": [_item(n + i) for i in range(n)], "stream": stream}
+        t0 = time.perf_counter()
+        first = None
+        ok = 0
+        async with c.stream("POST", "/chat/batch", json=body) as r:
+            r.raise_for_status()
+            raw = b""
+            async for chunk in r.aiter_bytes():
+                first = first or time.perf_counter() - t0
+                raw += chunk
+        batch = time.perf_counter() - t0
+        if stream:
+            ok = sum(1 for line in raw.splitlines() if json.loads(line)["ok"])
+        else:
+            ok = sum(1 for item in json.loads(raw)["results"] if item["ok"])
+
+    return {
+        "items": n,
+        "serial_s": round(serial, 3),
+        "serial_items_per_s": round(n / serial, 1),
+        "batch_s": round(batch, 3),
+        "batch_items_per_s": round(n / batch, 1),
+        "batch_ok": ok,
+        "batch_first_byte_ms": round(first * 1000, 1) if first else None,
+        "speedup": round(serial / batch, 1),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--base", default="http://127.0.0.1:8000")
+    ap.add_argument("-n", "--items", type=int, default=50)
+    ap.add_argument("--stream", action="store_true", help="request NDJSON streaming")
+    args = ap.parse_args()
+    print(json.dumps(asyncio.run(_run(args.base, args.items, args.stream))))
+
+
+if __name__ == "__main__":
+    main()
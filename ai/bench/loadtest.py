@@ -0,0 +1,94 @@
+"""Closed-loop load generator for the AI service.
+
+Example (service on :8000 pointed at bench.stub_upstream on :9000):
+    python -m bench.loadtest --url http://127.0.0.1:8000/chat -n 500 -c 64
+    python -m bench.loadtest --url http://127.0.0.1:8000/chat/stream --stream -n 200 -c 16
+
+With --stream the time to the first SSE data frame is reported as ttft.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import httpx
+
+
+def _pct(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[idx]
+
+
+async def _run(url: str, total: int, concurrency: int, unique: bool, stream: bool = False) -> dict:
+    latencies: list[float] = []
+    ttfts: list[float] = []
+    errors = 0
+    counter = iter(range(total))
+
+    async def worker(client: httpx.AsyncClient):
+        nonlocal errors
+        for i in counter:
+            payload = {
+                "user_id": 1,
+                "org_id": 1,
+                "message": f"ombordagi qoldiq #{i if unique else 0}",
+                "context": {"screen": "inventory"},
+            }
+            t0 = time.perf_counter()
+            try:
+                if stream:
+                    async with client.stream("POST", url, json=payload) as r:
+                        if r.status_code >= 400:
+                            errors += 1
+                        first = None
+                        async for line in r.aiter_lines():
+                            if first is None and line.startswith("data:"):
+                                first = time.perf_counter() - t0
+                        ttfts.append(first if first is not None else time.perf_counter() - t0)
+                else:
+                    r = await client.post(url, json=payload)
+                    if r.status_code >= 400:
+                        errors += 1
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - t0)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        t0 = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - t0
+
+    res = {
+        "requests": total,
+        "concurrency": concurrency,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "rps": round(total / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(statistics.median(latencies) * 1000, 1) if latencies else 0.0,
+        "p99_ms": round(_pct(latencies, 99) * 1000, 1),
+    }
+    if stream:
+        res["ttft_p50_ms"] = round(statistics.median(ttfts) * 1000, 1) if ttfts else 0.0
+        res["ttft_p99_ms"] = round(_pct(ttfts, 99) * 1000, 1)
+    return res
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--url", default="http://127.0.0.1:8000/chat")
+    ap.add_argument("-n", "--requests", type=int, default=500)
+    ap.add_argument("-c", "--concurrency", type=int, default=64)
+    ap.add_argument("--same", action="store_true", help="send identical payloads")
+    ap.add_argument("--stream", action="store_true", help="consume an SSE endpoint and report ttft")
+    args = ap.parse_args()
+    res = asyncio.run(_run(args.url, args.requests, args.concurrency, not args.same, args.stream))
+    print(json.dumps(res))
+
+
+if __name__ == "__main__":
+    main()
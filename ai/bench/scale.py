@@ -0,0 +1,105 @@
+"""Throughput vs. gunicorn worker count against the stub upstream.
+
+Starts bench.stub_upstream, then for each worker count starts the service with
+gunicorn.conf.py, runs the closed-loop load test and stops it again:
+    python -m bench.scale --workers 1,2,4 -n 2000 -c 128
+
+The service runs with AI_RPM=0 AI_TPM=0 so the limiter does not cap the run.
+Throughput can only scale up to the number of CPU cores available.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+from bench.loadtest import _run
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _wait_ready(url: str, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not become ready")
+
+
+def _start(cmd: list[str], env: dict) -> subprocess.Popen:
+    return subprocess.Popen(cmd, cwd=HERE, env={**os.environ, **env}, stdout=subprocess.DEVNULL)
+
+
+def _stop(proc: subprocess.Popen) -> None:
+    proc.terminate()
+    try:
+        proc.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--workers", default="1,2,4", help="comma-separated worker counts")
+    ap.add_argument("-n", "--requests", type=int, default=2000)
+    ap.add_argument("-c", "--concurrency", type=int, default=128)
+    ap.add_argument("--latency-ms", type=int, default=300, help="stub completion time")
+    ap.add_argument("--stub-workers", type=int, default=2)
+    ap.add_argument("--port", type=int, default=8000)
+    ap.add_argument("--stub-port", type=int, default=9000)
+    args = ap.parse_args()
+
+    stub = _start(
+        [sys.executable, "-m", "uvicorn", "bench.stub_upstream:app", "--port", str(args.stub_port),
+         "--workers", str(args.stub_workers), "--log-level", "warning"],
+        {"STUB_LATENCY_MS": str(args.latency_ms)},
+    )
+    rows = []
+    try:
+        _wait_ready(f"http://127.0.0.1:{args.stub_port}/calls")
+        for workers in [int(w) for w in args.workers.split(",")]:
+            service = _start(
+                [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "main:app"],
+                {
+                    "AI_WORKERS": str(workers),
+                    "AI_BIND": f"127.0.0.1:{args.port}",
+                    "AI_RPM": "0",
+                    "AI_TPM": "0",
+                    "AI_LOG_LEVEL": "WARNING",
+                    "OPENAI_API_KEY": os.getenv("OPENAI_API_KEY", "sk-bench"),
+                    "OPENAI_BASE_URL": f"http://127.0.0.1:{args.stub_port}/v1",
+                },
+            )
+            try:
+                base = f"http://127.0.0.1:{args.port}"
+                _wait_ready(f"{base}/health")
+                # Warm every worker's connection pool before measuring
+                asyncio.run(_run(f"{base}/chat", args.concurrency, args.concurrency, True))
+                res = asyncio.run(_run(f"{base}/chat", args.requests, args.concurrency, True))
+            finally:
+                _stop(service)
+            rows.append({"workers": workers, **res})
+            print(json.dumps(rows[-1]), flush=True)
+    finally:
+        _stop(stub)
+
+    base_rps = rows[0]["rps"] if rows else 0
+    print(f"\n{'workers':>7} {'rps':>8} {'p50_ms':>8} {'p99_ms':>8} {'errors':>6} {'speedup':>7}")
+    for row in rows:
+        speedup = row["rps"] / base_rps if base_rps else 0.0
+        print(
+            f"{row['workers']:>7} {row['rps']:>8} {row['p50_ms']:>8} {row['p99_ms']:>8} "
+            f"{row['errors']:>6} {speedup:>6.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
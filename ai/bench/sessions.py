@@ -0,0 +1,74 @@
+"""One long conversation sent with full history vs. with a server-side session.
+
+Example (service on :8000 pointed at bench.stub_upstream on :9000):
+    python -m bench.sessions --mode history --turns 40
+    python -m bench.sessions --mode session --turns 40
+
+The context carries a timestamp like AiContextService::summary(). Request bytes are
+measured on the client; prompt and cached tokens are read from the stub's /calls.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import uuid
+
+import httpx
+
+
+async def _run(base: str, stub: str, turns: int, mode: str, size: int) -> dict:
+    history: list = []
+    sizes: list[int] = []
+    latencies: list[float] = []
+    session = uuid.uuid4().hex
+    async with httpx.AsyncClient(timeout=120) as c:
+        before = (await c.get(f"{stub}/calls")).json()
+        for i in range(turns):
+            message = f"{i}-savol: " + "ombordagi qoldiq va buyurtmalar haqida batafsil " * (size // 48)
+            payload = {
+                "user_id": 1,
+                "org_id": 1,
+                "message": message,
+                "context": {"screen": "inventory", "timestamp": time.time()},
+            }
+            if mode == "session":
+                payload["session_id"] = session
+            else:
+                payload["history"] = history + [{"role": "user", "content": message}]
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            t0 = time.perf_counter()
+            r = await c.post(f"{base}/chat", content=body, headers={"content-type": "application/json"})
+            latencies.append(time.perf_counter() - t0)
+            r.raise_for_status()
+            sizes.append(len(body))
+            history += [{"role": "user", "content": message}, {"role": "assistant", "content": r.json()["answer"]}]
+        after = (await c.get(f"{stub}/calls")).json()
+    prompt = after.get("prompt_tokens", 0) - before.get("prompt_tokens", 0)
+    cached = after.get("cached_tokens", 0) - before.get("cached_tokens", 0)
+    return {
+        "mode": mode,
+        "turns": turns,
+        "bytes_total": sum(sizes),
+        "bytes_mean": round(statistics.mean(sizes)),
+        "bytes_last": sizes[-1],
+        "p50_ms": round(statistics.median(latencies) * 1000, 1),
+        "prompt_tokens": prompt,
+        "cached_tokens": cached,
+        "cached_ratio": round(cached / prompt, 4) if prompt else 0.0,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--base", default="http://127.0.0.1:8000")
+    ap.add_argument("--stub", default="http://127.0.0.1:9000")
+    ap.add_argument("--turns", type=int, default=40)
+    ap.add_argument("--mode", choices=("history", "session"), default="session")
+    ap.add_argument("--size", type=int, default=300, help="approximate characters per user message")
+    args = ap.parse_args()
+    print(json.dumps(asyncio.run(_run(args.base, args.stub, args.turns, args.mode, args.size))))
+
+
+if __name__ == "__main__":
+    main()
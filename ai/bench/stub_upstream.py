@@ -0,0 +1,133 @@
+"""Minimal OpenAI-compatible upstream for local benchmarks.
+
+Run:  uvicorn bench.stub_upstream:app --port 9000
+Then start the AI service with OPENAI_BASE_URL=http://127.0.0.1:9000/v1.
+
+Env: STUB_LATENCY_MS (default 300) - simulated completion time.
+     STUB_TOKENS (default 20) - chunks emitted when stream=true; the latency is spread across them.
+     STUB_FAIL_RATE (default 0) - fraction of calls answered with STUB_FAIL_STATUS (default 500).
+     STUB_RPM (default 0 = off) - per-minute request limit; sends x-ratelimit-* headers and 429s.
+Prompt caching is simulated like the real API: a request whose leading messages match an earlier
+request's reports the matched prefix as usage.prompt_tokens_details.cached_tokens (from 1024 tokens,
+in 128-token steps; tokens are estimated as characters / 4).
+Faults can be changed at runtime: POST /faults {"fail_rate": 1.0, "status": 503}.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import time
+import uuid
+from collections import OrderedDict
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+app = FastAPI(title="Stub upstream")
+
+LATENCY = float(os.getenv("STUB_LATENCY_MS", "300")) / 1000.0
+TOKENS = int(os.getenv("STUB_TOKENS", "20"))
+CALLS = {"count": 0}
+FAULTS = {
+    "fail_rate": float(os.getenv("STUB_FAIL_RATE", "0")),
+    "status": int(os.getenv("STUB_FAIL_STATUS", "500")),
+    "rpm": int(os.getenv("STUB_RPM", "0")),
+}
+_window = {"minute": 0, "used": 0}
+_prefixes: "OrderedDict[str, None]" = OrderedDict()
+
+
+def _prompt_usage(messages: list) -> dict:
+    """prompt_tokens and the cached share of the longest previously seen message prefix."""
+    digest = hashlib.sha256()
+    tokens = cached = 0
+    for m in messages:
+        digest.update(json.dumps([m.get("role"), m.get("content")], ensure_ascii=False).encode("utf-8"))
+        tokens += len(m.get("content") or "") // 4 + 4
+        key = digest.hexdigest()
+        if key in _prefixes:
+            cached = tokens
+            _prefixes.move_to_end(key)
+        else:
+            _prefixes[key] = None
+    while len(_prefixes) > 100000:
+        _prefixes.popitem(last=False)
+    cached = cached // 128 * 128 if cached >= 1024 else 0
+    CALLS["prompt_tokens"] = CALLS.get("prompt_tokens", 0) + tokens
+    CALLS["cached_tokens"] = CALLS.get("cached_tokens", 0) + cached
+    return {"prompt_tokens": tokens, "prompt_tokens_details": {"cached_tokens": cached}}
+
+
+def _rate_headers() -> dict | None:
+    """x-ratelimit-* headers for a fixed per-minute window; None once the window is exhausted."""
+    rpm = FAULTS["rpm"]
+    if not rpm:
+        return {}
+    now = time.time()
+    minute = int(now // 60)
+    if _window["minute"] != minute:
+        _window.update(minute=minute, used=0)
+    reset = f"{60 - now % 60:.1f}s"
+    if _window["used"] >= rpm:
+        return None
+    _window["used"] += 1
+    return {
+        "x-ratelimit-limit-requests": str(rpm),
+        "x-ratelimit-remaining-requests": str(rpm - _window["used"]),
+        "x-ratelimit-reset-requests": reset,
+    }
+
+
+async def _stream(body: dict, cid: str, prompt: dict):
+    base = {"id": cid, "object": "chat.completion.chunk", "created": int(time.time()), "model": body.get("model", "stub")}
+    step = LATENCY / max(1, TOKENS)
+    for i in range(TOKENS):
+        await asyncio.sleep(step)
+        chunk = dict(base, choices=[{"index": 0, "delta": {"content": f"tok{i} "}, "finish_reason": None}])
+        yield f"data: {json.dumps(chunk)}\n\n"
+    yield f"data: {json.dumps(dict(base, choices=[{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]))}\n\n"
+    if (body.get("stream_options") or {}).get("include_usage"):
+        usage = {**prompt, "completion_tokens": TOKENS, "total_tokens": prompt["prompt_tokens"] + TOKENS}
+        yield f"data: {json.dumps(dict(base, choices=[], usage=usage))}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+@app.post("/v1/chat/completions")
+async def completions(request: Request):
+    body = await request.json()
+    CALLS["count"] += 1
+    headers = _rate_headers()
+    if headers is None:
+        return JSONResponse({"error": {"message": "rate limited"}}, status_code=429, headers={"retry-after": "1"})
+    if FAULTS["fail_rate"] and random.random() < FAULTS["fail_rate"]:
+        await asyncio.sleep(LATENCY / 10)
+        return JSONResponse({"error": {"message": "injected fault"}}, status_code=FAULTS["status"])
+    cid = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+    prompt = _prompt_usage(body.get("messages") or [])
+    if body.get("stream"):
+        return StreamingResponse(_stream(body, cid, prompt), media_type="text/event-stream", headers=headers)
+    await asyncio.sleep(LATENCY)
+    last = body["messages"][-1]["content"]
+    answer = '{"echo": "%s"}' % last[:40] if body.get("response_format") else f"echo: {last[:200]}"
+    return JSONResponse(headers=headers, content={
+        "id": cid,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "stub"),
+        "choices": [
+            {"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": answer}},
+        ],
+        "usage": {**prompt, "completion_tokens": 10, "total_tokens": prompt["prompt_tokens"] + 10},
+    })
+
+
+@app.get("/calls")
+async def calls():
+    return CALLS
+
+
+@app.post("/faults")
+async def faults(request: Request):
+    FAULTS.update(await request.json())
+    return FAULTS
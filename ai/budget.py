@@ -0,0 +1,183 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import cache
+import metrics
+
+log = logging.getLogger("ai.budget")
+
+# Prompt-token budget per model; AI_PROMPT_BUDGETS="gpt-4o=16000,gpt-4o-mini=8000" overrides
+DEFAULT_BUDGET = int(os.getenv("AI_PROMPT_BUDGET", "8000"))
+BUDGETS: Dict[str, int] = {"gpt-4o": 16000, "gpt-4o-mini": 8000}
+for _item in filter(None, os.getenv("AI_PROMPT_BUDGETS", "").split(",")):
+    _name, _, _value = _item.partition("=")
+    BUDGETS[_name.strip()] = int(_value)
+
+# Summaries of dropped turns (AI_HISTORY_SUMMARY=1); otherwise old turns are just trimmed
+SUMMARIZE = os.getenv("AI_HISTORY_SUMMARY", "0") == "1"
+SUMMARY_MODEL = os.getenv("AI_SUMMARY_MODEL", "gpt-4o-mini")
+SUMMARY_TTL = int(os.getenv("AI_SUMMARY_TTL", "3600"))
+SUMMARY_PROMPT = (
+    "Quyidagi suhbatning qisqa xulosasini yozing: foydalanuvchi so'ragan narsalar, berilgan muhim "
+    "raqamlar va qarorlar. 120 so'zdan oshmasin."
+)
+
+# Approximate chat-format overhead per message; room kept for a summary of dropped turns
+PER_MESSAGE = 4
+SUMMARY_RESERVE = 300
+
+_encodings: Dict[str, Any] = {}
+_state = {"loading": False, "unavailable": False}
+_summaries = cache.MemoryStore(int(os.getenv("AI_SUMMARY_MAX_ENTRIES", "1000")))
+# Worker-local totals for /health; Prometheus aggregates the same counts across workers
+STATS = {"requests": 0, "trimmed": 0, "summarized": 0, "tokens_in": 0, "tokens_out": 0}
+
+
+def compact_context(context: Dict[str, Any]) -> str:
+    return json.dumps(context, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def _encoding(model: str):
+    if model in _encodings:
+        return _encodings[model]
+    if _state["loading"] or _state["unavailable"]:
+        # Never block the event loop on a BPE download; the heuristic covers the gap
+        return None
+    return _load(model)
+
+
+def _load(model: str):
+    try:
+        import tiktoken
+
+        try:
+            enc = tiktoken.encoding_for_model(model)
+        except KeyError:
+            enc = tiktoken.get_encoding("o200k_base")
+    except Exception as e:  # pragma: no cover - not installed or BPE files unavailable offline
+        log.warning("tiktoken unavailable (%s); using length heuristic", e)
+        _state["unavailable"] = True
+        enc = None
+    _encodings[model] = enc
+    return enc
+
+
+def warm(model: str) -> None:
+    """Load the BPE tables up front (run in a thread); tiktoken may download them on first use."""
+    _state["loading"] = True
+    try:
+        _load(model)
+    finally:
+        _state["loading"] = False
+
+
+def count(text: str, model: str) -> int:
+    enc = _encoding(model)
+    if enc is None:
+        # Uzbek/Russian text tokenizes denser than English; stay conservative
+        return len(text) // 3 + 1
+    return len(enc.encode(text))
+
+
+def budget_for(model: str) -> int:
+    if model in BUDGETS:
+        return BUDGETS[model]
+    # Dated snapshots such as gpt-4o-2024-08-06 use the family budget
+    family = max((name for name in BUDGETS if model.startswith(name)), key=len, default=None)
+    return BUDGETS[family] if family else DEFAULT_BUDGET
+
+
+def _tokens(messages: List[Dict[str, str]], model: str) -> int:
+    return sum(count(m["content"], model) + PER_MESSAGE for m in messages)
+
+
+def fit(
+    fixed: List[Dict[str, str]], history: List[Dict[str, str]], model: str, low_water: float = 1.0
+) -> Tuple[List[Dict[str, str]], List[Dict[str, str]], int]:
+    """Keep the newest history turns that fit the model budget.
+
+    Returns (kept, dropped, prompt_tokens); kept and dropped are in chronological
+    order. The `fixed` messages (system prompt, context, new user message) are
+    always sent. When turns must be dropped, only `low_water` of the budget is
+    filled, so the kept prefix stays the same for the next few turns.
+    """
+    budget = budget_for(model) - (SUMMARY_RESERVE if SUMMARIZE else 0)
+    base = _tokens(fixed, model)
+    costs = [count(m["content"], model) + PER_MESSAGE for m in history]
+    STATS["requests"] += 1
+    STATS["tokens_in"] += base + sum(costs)
+    cut = _cut(costs, base, budget)
+    if cut and low_water < 1.0:
+        cut = max(cut, _cut(costs, base, int(budget * low_water)))
+    kept = history[cut:]
+    used = base + sum(costs[cut:])
+    if cut:
+        STATS["trimmed"] += 1
+    STATS["tokens_out"] += used
+    metrics.PROMPT_FITS.labels("trimmed" if cut else "kept").inc()
+    metrics.PROMPT_FIT_TOKENS.labels("in").inc(base + sum(costs))
+    metrics.PROMPT_FIT_TOKENS.labels("out").inc(used)
+    return kept, history[:cut], used
+
+
+def _cut(costs: List[int], used: int, budget: int) -> int:
+    """Index of the oldest turn that still fits when filling the budget from the newest."""
+    cut = len(costs)
+    for i in range(len(costs) - 1, -1, -1):
+        if used + costs[i] > budget:
+            break
+        used += costs[i]
+        cut = i
+    return cut
+
+
+def _summary_key(scope: str, dropped: List[Dict[str, str]]) -> str:
+    raw = json.dumps([scope, dropped], ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+async def summarize(
+    scope: str,
+    dropped: List[Dict[str, str]],
+    complete: Callable[[Dict[str, Any], int], Awaitable[str]],
+) -> Optional[str]:
+    """Summary of dropped turns, cached per conversation scope and dropped prefix.
+
+    `complete` gets the request kwargs and their estimated prompt tokens.
+    """
+    key = _summary_key(scope, dropped)
+    hit = await _summaries.get(key)
+    if hit is not None:
+        return hit["summary"]
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in dropped)
+    messages = [
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {"role": "user", "content": transcript},
+    ]
+    try:
+        summary = await complete(
+            {"model": SUMMARY_MODEL, "messages": messages, "temperature": 0},
+            _tokens(messages, SUMMARY_MODEL),
+        )
+    except Exception as e:  # pragma: no cover
+        log.warning("history summary failed: %s", e)
+        return None
+    await _summaries.set(key, {"summary": summary}, SUMMARY_TTL)
+    STATS["summarized"] += 1
+    metrics.HISTORY_SUMMARIES.inc()
+    return summary
+
+
+def stats() -> Dict[str, Any]:
+    saved = STATS["tokens_in"] - STATS["tokens_out"]
+    return {
+        "scope": "worker",
+        **STATS,
+        "tokens_saved": saved,
+        "saved_ratio": round(saved / STATS["tokens_in"], 4) if STATS["tokens_in"] else 0.0,
+        "tokenizer": "tiktoken" if any(_encodings.values()) else "heuristic",
+        "summaries": SUMMARIZE,
+    }
@@ -0,0 +1,203 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+try:
+    import redis.asyncio as aioredis
+except Exception:  # pragma: no cover
+    aioredis = None
+
+log = logging.getLogger("ai.cache")
+
+# off | memory | redis
+BACKEND = os.getenv("AI_CACHE", "off").lower()
+REDIS_URL = os.getenv("AI_REDIS_URL", os.getenv("REDIS_URL", "redis://redis:6379/0"))
+MAX_ENTRIES = int(os.getenv("AI_CACHE_MAX_ENTRIES", "1000"))
+MAX_VALUE_BYTES = int(os.getenv("AI_CACHE_MAX_VALUE_BYTES", "65536"))
+
+# Builds the new value from the stored one (None when absent)
+Updater = Callable[[Optional[Dict[str, Any]]], Dict[str, Any]]
+
+
+def request_key(payload: Dict[str, Any], system_prompt: str, force_json: bool) -> str:
+    """Canonical hash of everything that influences the completion."""
+    canon = {
+        "model": payload.get("model"),
+        "system": system_prompt,
+        "history": [[m.get("role"), m.get("content")] for m in payload.get("history") or []],
+        "message": payload.get("message"),
+        "context": payload.get("context") or {},
+        "force_json": bool(force_json),
+    }
+    raw = json.dumps(canon, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class MemoryStore:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.items: "OrderedDict[str, tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self.evictions = 0
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        item = self.items.get(key)
+        if item is None:
+            return None
+        expires, value = item
+        if expires < time.monotonic():
+            del self.items[key]
+            return None
+        self.items.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: Dict[str, Any], ttl: int) -> None:
+        self.items[key] = (time.monotonic() + ttl, value)
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_entries:
+            self.items.popitem(last=False)
+            self.evictions += 1
+
+    async def update(self, key: str, fn: Updater, ttl: int) -> Dict[str, Any]:
+        """Store fn(current value or None). Nothing in between yields, so concurrent updates never interleave."""
+        value = fn(await self.get(key))
+        await self.set(key, value, ttl)
+        return value
+
+    async def delete(self, key: str) -> None:
+        self.items.pop(key, None)
+
+    def size(self) -> int:
+        return len(self.items)
+
+
+class _RedisStore:
+    def __init__(self, client, prefix: str):
+        self.client = client
+        self.prefix = prefix
+        self.evictions = 0
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        raw = await self.client.get(self.prefix + key)
+        return json.loads(raw) if raw else None
+
+    async def set(self, key: str, value: Dict[str, Any], ttl: int) -> None:
+        await self.client.set(self.prefix + key, json.dumps(value, ensure_ascii=False), ex=ttl)
+
+    async def update(self, key: str, fn: Updater, ttl: int) -> Dict[str, Any]:
+        """Store fn(current value or None) under WATCH/MULTI, retrying when another writer got in first."""
+        name = self.prefix + key
+        async with self.client.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(name)
+                    raw = await pipe.get(name)
+                    value = fn(json.loads(raw) if raw else None)
+                    pipe.multi()
+                    pipe.set(name, json.dumps(value, ensure_ascii=False), ex=ttl)
+                    await pipe.execute()
+                    return value
+                except aioredis.WatchError:
+                    continue
+
+    async def delete(self, key: str) -> None:
+        await self.client.delete(self.prefix + key)
+
+    def size(self) -> Optional[int]:
+        return None
+
+
+class ResponseCache:
+    """Per-endpoint answer cache. Backend errors are logged and treated as misses."""
+
+    def __init__(self, namespace: str, ttl: int, store):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.store is not None and self.ttl > 0
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        if not self.enabled:
+            return None
+        try:
+            value = await self.store.get(key)
+        except Exception as e:  # pragma: no cover
+            self.errors += 1
+            log.warning("cache get failed: %s", e)
+            value = None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, value: Dict[str, Any]) -> None:
+        if not self.enabled:
+            return
+        if len(json.dumps(value, ensure_ascii=False).encode("utf-8")) > MAX_VALUE_BYTES:
+            return
+        try:
+            await self.store.set(key, value, self.ttl)
+        except Exception as e:  # pragma: no cover
+            self.errors += 1
+            log.warning("cache set failed: %s", e)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "errors": self.errors,
+            "evictions": getattr(self.store, "evictions", 0),
+            "size": self.store.size() if self.store is not None else 0,
+        }
+
+
+_redis = None
+
+
+def redis_client():
+    """Shared Redis client (cache, cross-worker rate limits); None without the redis package."""
+    global _redis
+    if aioredis is None:
+        return None
+    if _redis is None:
+        _redis = aioredis.from_url(REDIS_URL)
+    return _redis
+
+
+def make_store(backend: str, prefix: str, max_entries: int):
+    """memory | redis key-value store with TTLs; None for any other backend."""
+    if backend == "memory":
+        return MemoryStore(max_entries)
+    if backend == "redis":
+        client = redis_client()
+        if client is None:
+            log.warning("redis backend requested but redis package is missing; using memory")
+            return MemoryStore(max_entries)
+        return _RedisStore(client, prefix)
+    return None
+
+
+def make_cache(namespace: str, ttl_env: str, default_ttl: int) -> ResponseCache:
+    store = make_store(BACKEND, f"ai:cache:{namespace}:", MAX_ENTRIES)
+    return ResponseCache(namespace, int(os.getenv(ttl_env, str(default_ttl))), store)
+
+
+async def close() -> None:
+    global _redis
+    if _redis is not None:
+        await _redis.aclose()
+        _redis = None
@@ -0,0 +1,38 @@
+"""Multi-worker serving profile: gunicorn -c gunicorn.conf.py main:app
+
+Each worker is a full uvicorn event loop with its own upstream pools. Cross-worker
+state lives in Redis (AI_CACHE=redis, AI_RATE_BACKEND) and Prometheus samples in
+PROMETHEUS_MULTIPROC_DIR, so /metrics on any worker reports the whole service.
+"""
+import os
+import shutil
+import tempfile
+
+bind = os.getenv("AI_BIND", f"0.0.0.0:{os.getenv('AI_PORT', '8000')}")
+workers = int(os.getenv("AI_WORKERS", "1"))
+worker_class = "uvicorn.workers.UvicornWorker"
+# Upstream calls may take up to AI_UPSTREAM_TIMEOUT; give workers more before killing them
+timeout = int(os.getenv("AI_WORKER_TIMEOUT", "75"))
+graceful_timeout = int(os.getenv("AI_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("AI_KEEPALIVE", "5"))
+max_requests = int(os.getenv("AI_MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.getenv("AI_MAX_REQUESTS_JITTER", "0"))
+accesslog = None
+
+if workers > 1 and os.getenv("AI_METRICS", "1") != "0":
+    os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "ai-prometheus"))
+
+
+def on_starting(server):
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if path:
+        # Stale files from a previous run would be summed into the new counters
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+
+
+def child_exit(server, worker):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
@@ -1,14 +1,38 @@
+import asyncio
+import json
 import os
-from typing import List, Dict, Any
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Dict, Any
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel, Field
 
-try:
-    from openai import OpenAI
-except Exception:  # pragma: no cover
-    OpenAI = None
+import budget
+import cache
+import metrics
+import scheduler
+import sessions
+import upstream
+from resilience import CircuitOpen, RateLimited, status_for
+from singleflight import SingleFlight
 
-app = FastAPI(title="PulBot AI Service")
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    # tiktoken may fetch its BPE tables on first use; load them in the background
+    # so the worker starts serving at once (the length heuristic covers the gap)
+    warm = asyncio.create_task(asyncio.to_thread(budget.warm, os.getenv("OPENAI_MODEL", "gpt-4o")))
+    yield
+    warm.cancel()
+    await upstream.close_clients()
+    await cache.close()
+
+
+metrics.setup_logging()
+app = FastAPI(title="PulBot AI Service", lifespan=lifespan)
+if metrics.ENABLED:
+    app.add_middleware(metrics.MetricsMiddleware)
 
 
 class Message(BaseModel):
@@ -24,64 +48,363 @@ class ChatPayload(BaseModel):
     context: Dict[str, Any] = Field(default_factory=dict)
     # Default to gpt-4o for stronger reasoning/advice
     model: str = Field(default=os.getenv("OPENAI_MODEL", "gpt-4o"))
+    # Server-side conversation: history is kept by the service and only the new message is sent
+    session_id: str | None = Field(default=None, max_length=128)
+
+
+class BatchPayload(BaseModel):
+    items: List[ChatPayload]
+    # Optional per-request overrides, capped by the server-side limits
+    concurrency: int | None = None
+    item_timeout: float | None = None
+    # Stream NDJSON lines in completion order instead of one JSON document
+    stream: bool = False
 
 
 SYSTEM_PROMPT = (
     "Siz PulBot AI assistentisiz. Tizimdagi ombor (inventory), ishlab chiqarish va ta'minot buyurtmalari haqida "
-    "foydalanuvchiga tushunarli, aniq va xavfsiz tavsiyalar bering. Ustida ishlayotgan kontekst: {context}. "
+    "foydalanuvchiga tushunarli, aniq va xavfsiz tavsiyalar bering. "
     "Siz GPT‑4o modelidan foydalanasiz; model versiyasi haqida noto‘g‘ri ma'lumot bermang. Agar model haqida so‘ralsa, "
     "‘GPT‑4o’ deb javob bering. Savollarga aniq javob, kerak bo'lsa bullet nuqtalar bilan qayting. Agar ma'lumot yetarli "
     "bo'lmasa, aniq so'rov bering. Hech qachon maxfiy kalitlarni yoki ichki konfiguratsiyani oshkor etmang."
 )
+# Sent after the history: the context carries a timestamp and changes on every turn, while the
+# static prompt and the append-only history form a prefix the upstream can cache
+CONTEXT_PROMPT = "Ustida ishlayotgan kontekst: {context}"
+
+
+# Opt-in answer caches (AI_CACHE=memory|redis); Codex JSON proposals are the best fit
+CACHES = {
+    "chat": cache.make_cache("chat", "AI_CACHE_TTL_CHAT", 300),
+    "codex": cache.make_cache("codex", "AI_CACHE_TTL_CODEX", 3600),
+}
+
+
+# Identical concurrent requests share one upstream call (AI_COALESCE=0 disables)
+COALESCE = os.getenv("AI_COALESCE", "1") != "0"
+FLIGHTS = SingleFlight(timeout=float(os.getenv("AI_COALESCE_WAIT", "55")))
+
+
+# Conversations kept server-side for clients that send session_id (AI_SESSIONS=off disables)
+SESSIONS = sessions.make_store()
+
+
+# Priority lanes, per-org fair queuing and quotas in front of every upstream call
+SCHEDULER = scheduler.make_scheduler()
+
+
+BATCH_MAX_ITEMS = int(os.getenv("AI_BATCH_MAX_ITEMS", "100"))
+BATCH_CONCURRENCY = int(os.getenv("AI_BATCH_CONCURRENCY", "8"))
+BATCH_ITEM_TIMEOUT = float(os.getenv("AI_BATCH_ITEM_TIMEOUT", "60"))
 
 
-def _chat_with_key(payload: ChatPayload, api_key_env: str = "OPENAI_API_KEY", force_json: bool = False):
+def _resolve_key(api_key_env: str) -> str | None:
     api_key = os.getenv(api_key_env) or os.getenv("OPENAI_API_KEY")
-    if OpenAI is None or not api_key:
-        # Return a deterministic fallback for local runs without API key
-        return {
-            "answer": (
-                "[AI emulyatsiya] OPENAI_API_KEY yo'q. Savol: "
-                f"{payload.message}\nKontekst: {payload.context}"
-            )
-        }
+    if not upstream.available() or not api_key:
+        return None
+    return api_key
+
+
+def _fallback_answer(payload: ChatPayload, reason: str = "OPENAI_API_KEY yo'q.") -> str:
+    # Deterministic fallback for local runs without API key or while the upstream is down
+    return (
+        f"[AI emulyatsiya] {reason} Savol: "
+        f"{payload.message}\nKontekst: {payload.context}"
+    )
+
+
+UNHEALTHY = "AI xizmati vaqtincha ishlamayapti."
+
+
+def _upstream_error(e: Exception) -> HTTPException:
+    if isinstance(e, RateLimited):
+        return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(int(e.retry_after) + 1)})
+    return HTTPException(status_code=status_for(e), detail=str(e))
+
+
+async def _build_kwargs(
+    payload: ChatPayload,
+    force_json: bool,
+    up: "upstream.Upstream | None" = None,
+    session: "sessions.Session | None" = None,
+    lane: str = "interactive",
+):
+    """Returns (chat.completions kwargs, estimated prompt tokens).
+
+    Message order is static system prompt, summary, history, context, new message.
+    """
+    system = {"role": "system", "content": SYSTEM_PROMPT}
+    context = {"role": "system", "content": CONTEXT_PROMPT.format(context=budget.compact_context(payload.context))}
+    history = [{"role": m.role, "content": m.content} for m in payload.history]
+    user = {"role": "user", "content": payload.message}
+
+    # Keep the newest turns that fit the model's prompt budget. Sessions trim in steps so
+    # the kept prefix (and the upstream's prompt cache) survives several turns.
+    low_water = sessions.LOW_WATER if session is not None else 1.0
+    history, dropped, tokens = budget.fit([system, context, user], history, payload.model, low_water)
+    if session is not None:
+        session.start += len(dropped)
+        dropped = session.messages[:session.start]
+    messages = [system]
+    if dropped and budget.SUMMARIZE and up is not None:
+        async def complete(kwargs: Dict[str, Any], cost: int) -> str:
+            # The summary is an upstream call like any other: same lane, same quotas
+            async with SCHEDULER.slot(lane, payload.org_id, payload.user_id, cost):
+                resp = await up.create(cost, **kwargs)
+            metrics.record_usage(kwargs["model"], resp.usage)
+            completion = getattr(resp.usage, "completion_tokens", 0)
+            await SCHEDULER.record_completion(payload.org_id, payload.user_id, completion)
+            return resp.choices[0].message.content
+
+        summary = await budget.summarize(f"{payload.user_id}:{payload.org_id}", dropped, complete)
+        if summary:
+            messages.append({"role": "system", "content": f"Oldingi suhbat xulosasi: {summary}"})
+    messages.extend(history)
+    messages.append(context)
+    messages.append(user)
+
+    # Use chat.completions for broad compatibility
+    kwargs = {
+        "model": payload.model,
+        "messages": messages,
+        "temperature": 0.3,
+    }
+    # In Codex mode we want strict JSON back
+    if force_json:
+        kwargs["response_format"] = {"type": "json_object"}
+    return kwargs, tokens
+
+
+async def _chat_with_key(
+    payload: ChatPayload,
+    api_key_env: str = "OPENAI_API_KEY",
+    force_json: bool = False,
+    cache_name: str = "chat",
+    lane: str = "interactive",
+):
+    t0 = time.perf_counter()
+    outcome = "error"
+    try:
+        result, outcome = await _chat_outcome(payload, api_key_env, force_json, cache_name, lane)
+        return result
+    finally:
+        model = metrics.model_label(payload.model)
+        metrics.CHAT_REQUESTS.labels(cache_name, model, outcome).inc()
+        metrics.CHAT_SECONDS.labels(cache_name, model).observe(time.perf_counter() - t0)
+        metrics.log_event(
+            "chat", endpoint=cache_name, model=payload.model, outcome=outcome,
+            duration_ms=round((time.perf_counter() - t0) * 1000, 1),
+        )
+
+
+async def _open_session(payload: ChatPayload):
+    """Returns (payload with the stored history, session) or (payload, None) without session_id."""
+    if not payload.session_id or not SESSIONS.enabled:
+        return payload, None
+    session = await SESSIONS.open(
+        payload.user_id, payload.session_id, [m.model_dump() for m in payload.history], payload.message
+    )
+    return payload.model_copy(update={"history": [Message(**m) for m in session.window()]}), session
+
+
+async def _chat_outcome(payload: ChatPayload, api_key_env: str, force_json: bool, cache_name: str, lane: str):
+    payload, session = await _open_session(payload)
+    result, outcome = await _answer(payload, api_key_env, force_json, cache_name, lane, session)
+    # session_id tells the client the turn is stored; until then it must keep its own history
+    if session is not None and outcome in ("upstream", "coalesced", "cache"):
+        if await SESSIONS.append(session, payload.message, result.get("answer")):
+            result = {**result, "session_id": payload.session_id}
+    return result, outcome
+
+
+async def _answer(
+    payload: ChatPayload,
+    api_key_env: str,
+    force_json: bool,
+    cache_name: str,
+    lane: str,
+    session: "sessions.Session | None",
+):
+    api_key = _resolve_key(api_key_env)
+    if not api_key:
+        return {"answer": _fallback_answer(payload)}, "fallback"
+
+    answers = CACHES[cache_name]
+    key = cache.request_key(payload.model_dump(), SYSTEM_PROMPT, force_json)
+    hit = await answers.get(key)
+    if answers.enabled:
+        metrics.CACHE_LOOKUPS.labels(cache_name, "hit" if hit is not None else "miss").inc()
+    if hit is not None:
+        return hit, "cache"
+
+    async def complete():
+        up = upstream.get_client(api_key)
+        kwargs, tokens = await _build_kwargs(payload, force_json, up, session, lane)
+        async with SCHEDULER.slot(lane, payload.org_id, payload.user_id, tokens):
+            resp = await up.create(tokens, **kwargs)
+        metrics.record_usage(payload.model, resp.usage)
+        await SCHEDULER.record_completion(payload.org_id, payload.user_id, getattr(resp.usage, "completion_tokens", 0))
+        result = {"answer": resp.choices[0].message.content, "model": payload.model}
+        await answers.set(key, result)
+        return result
 
     try:
-        client = OpenAI(api_key=api_key)
-        messages = [
-            {"role": "system", "content": SYSTEM_PROMPT.format(context=payload.context)},
-        ]
-        # Append history
-        for m in payload.history:
-            messages.append({"role": m.role, "content": m.content})
-        messages.append({"role": "user", "content": payload.message})
-
-        # Use chat.completions for broad compatibility
-        kwargs = {
-            "model": payload.model,
-            "messages": messages,
-            "temperature": 0.3,
-        }
-        # In Codex mode we want strict JSON back
-        if force_json:
-            kwargs["response_format"] = {"type": "json_object"}
-        resp = client.chat.completions.create(**kwargs)
-        answer = resp.choices[0].message.content
-        return {"answer": answer, "model": payload.model}
+        if COALESCE:
+            flight = f"{cache_name}:{key}"
+            role = "shared" if flight in FLIGHTS.inflight else "leader"
+            metrics.COALESCED.labels(cache_name, role).inc()
+            return await FLIGHTS.do(flight, complete), "upstream" if role == "leader" else "coalesced"
+        return await complete(), "upstream"
+    except CircuitOpen as e:
+        if lane == "codex":
+            # A made-up answer reads as "no change" to codex and ends the job; a 503 is retried
+            raise HTTPException(status_code=503, detail=UNHEALTHY, headers={"Retry-After": str(int(e.retry_after) + 1)})
+        return {"answer": _fallback_answer(payload, UNHEALTHY), "degraded": True}, "degraded"
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="upstream timeout")
     except Exception as e:  # pragma: no cover
-        raise HTTPException(status_code=500, detail=str(e))
+        raise _upstream_error(e)
+
+
+def _sse(data: Dict[str, Any], event: str | None = None) -> str:
+    head = f"event: {event}\n" if event else ""
+    return f"{head}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def _stream_with_key(payload: ChatPayload, api_key_env: str = "OPENAI_API_KEY") -> AsyncIterator[str]:
+    payload, session = await _open_session(payload)
+    api_key = _resolve_key(api_key_env)
+    if not api_key:
+        yield _sse({"delta": _fallback_answer(payload)})
+        yield _sse({"model": None, "usage": None}, event="done")
+        metrics.CHAT_REQUESTS.labels("stream", metrics.model_label(payload.model), "fallback").inc()
+        return
+
+    t0 = time.perf_counter()
+    first = None
+    outcome = "error"
+    try:
+        up = upstream.get_client(api_key)
+        kwargs, tokens = await _build_kwargs(payload, False, up, session)
+        usage = None
+        parts = []
+        async with SCHEDULER.slot("interactive", payload.org_id, payload.user_id, tokens):
+            async with up.stream(tokens, **kwargs, stream_options={"include_usage": True}) as stream:
+                async for chunk in stream:
+                    if chunk.usage is not None:
+                        metrics.record_usage(payload.model, chunk.usage)
+                        usage = chunk.usage.model_dump()
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        if first is None:
+                            first = time.perf_counter() - t0
+                        parts.append(delta)
+                        yield _sse({"delta": delta})
+        if usage:
+            await SCHEDULER.record_completion(payload.org_id, payload.user_id, usage.get("completion_tokens", 0))
+        done = {"model": payload.model, "usage": usage}
+        if session is not None and await SESSIONS.append(session, payload.message, "".join(parts)):
+            done["session_id"] = payload.session_id
+        yield _sse(done, event="done")
+        outcome = "upstream"
+    except CircuitOpen:
+        outcome = "degraded"
+        yield _sse({"delta": _fallback_answer(payload, UNHEALTHY)})
+        yield _sse({"model": None, "usage": None, "degraded": True}, event="done")
+    except Exception as e:
+        # Headers are already sent; report the failure in-band
+        yield _sse({"detail": str(e)}, event="error")
+    finally:
+        model = metrics.model_label(payload.model)
+        metrics.CHAT_REQUESTS.labels("stream", model, outcome).inc()
+        metrics.CHAT_SECONDS.labels("stream", model).observe(time.perf_counter() - t0)
+        metrics.log_event(
+            "chat", endpoint="stream", model=payload.model, outcome=outcome,
+            ttft_ms=round(first * 1000, 1) if first is not None else None,
+            duration_ms=round((time.perf_counter() - t0) * 1000, 1),
+        )
 
 
 @app.post("/chat")
-def chat(payload: ChatPayload):
+async def chat(payload: ChatPayload):
     """Default chat using OPENAI_API_KEY."""
-    return _chat_with_key(payload, "OPENAI_API_KEY", force_json=False)
+    return await _chat_with_key(payload, "OPENAI_API_KEY", force_json=False)
+
+
+@app.post("/chat/stream")
+async def chat_stream(payload: ChatPayload):
+    """Same as /chat, but streams completion deltas as Server-Sent Events.
+
+    Frames: `data: {"delta": "..."}` per chunk, then `event: done` with model and usage
+    (or `event: error` with detail).
+    """
+    return StreamingResponse(
+        _stream_with_key(payload, "OPENAI_API_KEY"),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def _batch_item(index: int, payload: ChatPayload, limit: asyncio.Semaphore, timeout: float) -> Dict[str, Any]:
+    async with limit:
+        try:
+            result = await asyncio.wait_for(_chat_with_key(payload, "OPENAI_API_KEY", lane="batch"), timeout)
+            return {"index": index, "ok": True, **result}
+        except asyncio.TimeoutError:
+            return {"index": index, "ok": False, "status": 504, "error": "item timeout"}
+        except HTTPException as e:
+            return {"index": index, "ok": False, "status": e.status_code, "error": e.detail}
+
+
+@app.post("/chat/batch")
+async def chat_batch(batch: BatchPayload):
+    """Run several /chat payloads concurrently under a bounded fan-out.
+
+    Returns `{"results": [...]}` in input order, or with `stream: true` one NDJSON line per item
+    as it completes. Every result carries its input `index` and `ok`; failures carry `status`/`error`.
+    """
+    if len(batch.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"too many items (max {BATCH_MAX_ITEMS})")
+    concurrency = max(1, min(batch.concurrency or BATCH_CONCURRENCY, BATCH_CONCURRENCY))
+    timeout = min(batch.item_timeout or BATCH_ITEM_TIMEOUT, BATCH_ITEM_TIMEOUT)
+    limit = asyncio.Semaphore(concurrency)
+    jobs = [_batch_item(i, item, limit, timeout) for i, item in enumerate(batch.items)]
+
+    if not batch.stream:
+        return {"results": await asyncio.gather(*jobs)}
+
+    async def lines() -> AsyncIterator[str]:
+        tasks = [asyncio.ensure_future(j) for j in jobs]
+        try:
+            for done in asyncio.as_completed(tasks):
+                yield json.dumps(await done, ensure_ascii=False) + "\n"
+        finally:
+            for t in tasks:
+                t.cancel()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
 
 @app.post("/chat-codex")
-def chat_codex(payload: ChatPayload):
+async def chat_codex(payload: ChatPayload):
     """Codex-dedicated chat using OPENAI_FOR_CODEX_API_KEY if present."""
-    return _chat_with_key(payload, "OPENAI_FOR_CODEX_API_KEY", force_json=True)
+    return await _chat_with_key(payload, "OPENAI_FOR_CODEX_API_KEY", force_json=True, cache_name="codex", lane="codex")
+
+
+@app.delete("/sessions/{user_id}/{session_id}")
+async def reset_session(user_id: int, session_id: str):
+    """Forget a server-side conversation (the bot's /reset)."""
+    if SESSIONS.enabled:
+        await SESSIONS.reset(user_id, session_id)
+    return {"ok": True}
+
+
+@app.get("/metrics")
+def prometheus_metrics():
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
 
 
 @app.get("/health")
@@ -89,4 +412,11 @@ def health():
     return {
         "ok": True,
         "default_model": os.getenv("OPENAI_MODEL", "gpt-4o"),
+        "cache": {name: c.stats() for name, c in CACHES.items()},
+        "coalesce": FLIGHTS.stats(),
+        "prompt_budget": budget.stats(),
+        "upstream": upstream.stats(),
+        "scheduler": SCHEDULER.stats(),
+        "sessions": SESSIONS.stats(),
+        "prompt_cache": metrics.prompt_cache_stats(),
     }
@@ -0,0 +1,159 @@
+import contextvars
+import json
+import logging
+import os
+import sys
+import time
+import uuid
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+
+ENABLED = os.getenv("AI_METRICS", "1") != "0"
+# Set by gunicorn.conf.py when running several workers; samples are then aggregated from files
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# Request id from the PHP caller (X-Request-Id), visible to every layer of a request
+request_id: contextvars.ContextVar[str] = contextvars.ContextVar("request_id", default="-")
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+HTTP_REQUESTS = Counter("ai_http_requests_total", "HTTP requests", ["path", "status"])
+HTTP_SECONDS = Histogram("ai_http_request_seconds", "HTTP time to response start", ["path"], buckets=LATENCY_BUCKETS)
+HTTP_REQUEST_BYTES = Histogram("ai_http_request_bytes", "HTTP request body size", ["path"], buckets=BYTES_BUCKETS)
+HTTP_INFLIGHT = Gauge("ai_http_inflight_requests", "HTTP requests in progress", ["path"], multiprocess_mode="livesum")
+
+CHAT_REQUESTS = Counter("ai_chat_requests_total", "Chat requests by outcome", ["endpoint", "model", "outcome"])
+CHAT_SECONDS = Histogram("ai_chat_seconds", "Chat latency until the full answer", ["endpoint", "model"], buckets=LATENCY_BUCKETS)
+UPSTREAM_TTFB = Histogram("ai_upstream_ttfb_seconds", "Upstream time to response headers", buckets=LATENCY_BUCKETS)
+UPSTREAM_INFLIGHT = Gauge("ai_upstream_inflight", "Upstream calls in progress", multiprocess_mode="livesum")
+PROMPT_TOKENS = Counter("ai_prompt_tokens_total", "Prompt tokens reported by the upstream", ["model"])
+COMPLETION_TOKENS = Counter("ai_completion_tokens_total", "Completion tokens reported by the upstream", ["model"])
+CACHED_TOKENS = Counter("ai_cached_prompt_tokens_total", "Prompt tokens served from the upstream prompt cache", ["model"])
+CACHE_LOOKUPS = Counter("ai_cache_lookups_total", "Answer cache lookups", ["cache", "result"])
+COALESCED = Counter("ai_coalesce_total", "Single-flight participation", ["endpoint", "role"])
+SCHED_WAIT = Histogram("ai_sched_wait_seconds", "Scheduler queue wait before an upstream slot", ["lane"], buckets=LATENCY_BUCKETS)
+SCHED_QUEUED = Gauge("ai_sched_queued", "Requests waiting for an upstream slot", ["lane"], multiprocess_mode="livesum")
+SCHED_REJECTED = Counter("ai_sched_rejected_total", "Requests refused by the scheduler", ["lane", "reason"])
+PROMPT_FIT_TOKENS = Counter("ai_prompt_fit_tokens_total", "Prompt tokens before and after history fitting", ["stage"])
+PROMPT_FITS = Counter("ai_prompt_fit_total", "Prompts fitted to the budget", ["result"])
+HISTORY_SUMMARIES = Counter("ai_history_summaries_total", "Summaries of dropped turns made upstream")
+
+_PATHS = {"/chat", "/chat/stream", "/chat/batch", "/chat-codex", "/health", "/metrics"}
+
+# Worker-local totals for /health; Prometheus has the same numbers per model
+_usage = {"prompt_tokens": 0, "cached_tokens": 0}
+
+access_log = logging.getLogger("ai.access")
+
+# `model` comes from the client; cap label cardinality
+MAX_MODELS = 20
+_models: set[str] = set()
+
+
+def model_label(model: str) -> str:
+    if model in _models:
+        return model
+    if len(_models) < MAX_MODELS and len(model) <= 64:
+        _models.add(model)
+        return model
+    return "other"
+
+
+def setup_logging() -> None:
+    root = logging.getLogger("ai")
+    if root.handlers:
+        return
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    root.addHandler(handler)
+    root.setLevel(os.getenv("AI_LOG_LEVEL", "INFO").upper())
+    root.propagate = False
+
+
+def log_event(event: str, **fields) -> None:
+    if access_log.isEnabledFor(logging.INFO):
+        access_log.info(json.dumps({"event": event, "request_id": request_id.get(), **fields}, ensure_ascii=False))
+
+
+def record_usage(model: str, usage) -> None:
+    if usage is None:
+        return
+    model = model_label(model)
+    prompt = getattr(usage, "prompt_tokens", 0) or 0
+    cached = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", 0) or 0
+    PROMPT_TOKENS.labels(model).inc(prompt)
+    COMPLETION_TOKENS.labels(model).inc(getattr(usage, "completion_tokens", 0) or 0)
+    CACHED_TOKENS.labels(model).inc(cached)
+    _usage["prompt_tokens"] += prompt
+    _usage["cached_tokens"] += cached
+
+
+def prompt_cache_stats() -> dict:
+    prompt = _usage["prompt_tokens"]
+    return {**_usage, "cached_ratio": round(_usage["cached_tokens"] / prompt, 4) if prompt else 0.0}
+
+
+async def on_upstream_request(request) -> None:
+    request.extensions["ai_t0"] = time.perf_counter()
+
+
+async def on_upstream_response(response) -> None:
+    t0 = response.request.extensions.get("ai_t0")
+    if t0 is not None:
+        UPSTREAM_TTFB.observe(time.perf_counter() - t0)
+
+
+def render() -> tuple[bytes, str]:
+    if MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware: request id, HTTP metrics and one timing log line per request."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        path = scope["path"] if scope["path"] in _PATHS else "other"
+        rid = None
+        size = 0
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                rid = value.decode("latin-1")[:64]
+            elif name == b"content-length" and value.isdigit():
+                size = int(value)
+        rid = rid or uuid.uuid4().hex
+        token = request_id.set(rid)
+        status = {"code": 500}
+        t0 = time.perf_counter()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                message.setdefault("headers", []).append((b"x-request-id", rid.encode("latin-1")))
+                HTTP_SECONDS.labels(path).observe(time.perf_counter() - t0)
+            await send(message)
+
+        HTTP_INFLIGHT.labels(path).inc()
+        if scope["method"] == "POST":
+            HTTP_REQUEST_BYTES.labels(path).observe(size)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_INFLIGHT.labels(path).dec()
+            HTTP_REQUESTS.labels(path, str(status["code"])).inc()
+            if path not in ("/health", "/metrics"):
+                log_event(
+                    "http", method=scope["method"], path=scope["path"], status=status["code"], bytes_in=size,
+                    duration_ms=round((time.perf_counter() - t0) * 1000, 1),
+                )
+            request_id.reset(token)
@@ -0,0 +1,406 @@
+import asyncio
+import logging
+import os
+import random
+import re
+import sys
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import cache
+
+log = logging.getLogger("ai.resilience")
+
+RPM = int(os.getenv("AI_RPM", "500"))
+TPM = int(os.getenv("AI_TPM", "200000"))
+RATE_WAIT = float(os.getenv("AI_RATE_WAIT", "20"))
+RETRY_ATTEMPTS = int(os.getenv("AI_RETRY_ATTEMPTS", "3"))
+RETRY_BASE = float(os.getenv("AI_RETRY_BASE", "0.5"))
+RETRY_CAP = float(os.getenv("AI_RETRY_CAP", "8"))
+RETRY_BUDGET = float(os.getenv("AI_RETRY_BUDGET", "0.2"))
+BREAKER_FAILURES = int(os.getenv("AI_BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = float(os.getenv("AI_BREAKER_COOLDOWN", "30"))
+# local | redis; with several workers the RPM/TPM buckets must live in Redis to hold per key
+RATE_BACKEND = os.getenv("AI_RATE_BACKEND", "redis" if cache.BACKEND == "redis" else "local").lower()
+
+
+class CircuitOpen(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"upstream circuit open, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after: float, reason: str = "rate limited"):
+        super().__init__(f"{reason}, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+def _seconds(value: Optional[str]) -> Optional[float]:
+    """Parse reset/retry-after values such as '2', '1.5s', '6m0s', '120ms'."""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    total = 0.0
+    for num, unit in re.findall(r"([\d.]+)(ms|s|m|h)", value):
+        total += float(num) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return total or None
+
+
+class TokenBucket:
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.stamp = time.monotonic()
+        self.paused_until = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.stamp) * self.capacity / 60.0)
+        self.stamp = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` is available (0 when it is now)."""
+        now = time.monotonic()
+        self._refill(now)
+        if now < self.paused_until:
+            return self.paused_until - now
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) * 60.0 / self.capacity
+
+    def take(self, amount: float) -> None:
+        self.level -= min(amount, self.capacity)
+
+    def observe(self, limit: Optional[str], remaining: Optional[str], reset: Optional[str]) -> None:
+        """Align the bucket with the upstream's x-ratelimit-* headers."""
+        now = time.monotonic()
+        self._refill(now)
+        if limit and limit.isdigit():
+            self.capacity = float(limit)
+        if remaining and remaining.isdigit():
+            self.level = min(self.level, float(remaining))
+            if int(remaining) == 0:
+                self.pause(_seconds(reset) or 1.0)
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute buckets for one API key."""
+
+    def __init__(self, rpm: int, tpm: int, max_wait: float):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_wait = max_wait
+        self.lock = asyncio.Lock()
+        self.waited = 0.0
+
+    async def acquire(self, tokens: int) -> None:
+        deadline = time.monotonic() + self.max_wait
+        async with self.lock:
+            while True:
+                wait = max(
+                    self.requests.wait_time(1) if self.requests.enabled else 0.0,
+                    self.tokens.wait_time(tokens) if self.tokens.enabled else 0.0,
+                )
+                if wait <= 0:
+                    break
+                if time.monotonic() + wait > deadline:
+                    raise RateLimited(wait)
+                self.waited += wait
+                await asyncio.sleep(wait)
+            if self.requests.enabled:
+                self.requests.take(1)
+            if self.tokens.enabled:
+                self.tokens.take(tokens)
+
+    def pause(self, seconds: float) -> None:
+        self.requests.pause(seconds)
+
+    def observe(self, headers) -> None:
+        self.requests.observe(
+            headers.get("x-ratelimit-limit-requests"),
+            headers.get("x-ratelimit-remaining-requests"),
+            headers.get("x-ratelimit-reset-requests"),
+        )
+        self.tokens.observe(
+            headers.get("x-ratelimit-limit-tokens"),
+            headers.get("x-ratelimit-remaining-tokens"),
+            headers.get("x-ratelimit-reset-tokens"),
+        )
+
+
+# Refill both buckets, then take 1 request + N tokens or return the wait in seconds.
+# KEYS[1] hash; ARGV now, rpm, tpm, tokens, paused_until (wall clock, from local headers)
+_TAKE = """
+local now = tonumber(ARGV[1])
+local rpm = tonumber(ARGV[2])
+local tpm = tonumber(ARGV[3])
+local want = math.min(tonumber(ARGV[4]), tpm)
+local s = redis.call('HMGET', KEYS[1], 'r', 't', 'ts', 'paused')
+local r = tonumber(s[1]) or rpm
+local t = tonumber(s[2]) or tpm
+local dt = math.max(0, now - (tonumber(s[3]) or now))
+local paused = math.max(tonumber(s[4]) or 0, tonumber(ARGV[5]))
+r = math.min(rpm, r + dt * rpm / 60)
+t = math.min(tpm, t + dt * tpm / 60)
+local wait = 0
+if paused > now then wait = paused - now end
+if rpm > 0 and r < 1 then wait = math.max(wait, (1 - r) * 60 / rpm) end
+if tpm > 0 and t < want then wait = math.max(wait, (want - t) * 60 / tpm) end
+if wait <= 0 then
+  if rpm > 0 then r = r - 1 end
+  if tpm > 0 then t = t - want end
+end
+redis.call('HSET', KEYS[1], 'r', r, 't', t, 'ts', now, 'paused', paused)
+redis.call('EXPIRE', KEYS[1], 120)
+return tostring(wait)
+"""
+
+
+class SharedRateLimiter(RateLimiter):
+    """The same buckets kept in Redis so every worker draws from one budget per key.
+
+    Capacities and pauses learned from response headers are pushed with each
+    acquire. If Redis is unreachable the worker falls back to its local buckets.
+    """
+
+    def __init__(self, key_id: str, rpm: int, tpm: int, max_wait: float):
+        super().__init__(rpm, tpm, max_wait)
+        self.key = f"ai:rl:{key_id}"
+        self.script = None
+        self.errors = 0
+
+    async def _shared_wait(self, tokens: int) -> Optional[float]:
+        client = cache.redis_client()
+        if client is None:
+            return None
+        try:
+            if self.script is None:
+                self.script = client.register_script(_TAKE)
+            paused = self.requests.paused_until - time.monotonic()
+            wait = await self.script(
+                keys=[self.key],
+                args=[
+                    time.time(),
+                    self.requests.capacity if self.requests.enabled else 0,
+                    self.tokens.capacity if self.tokens.enabled else 0,
+                    tokens,
+                    time.time() + paused if paused > 0 else 0,
+                ],
+            )
+        except Exception as e:
+            self.errors += 1
+            log.warning("shared rate limiter unavailable, using local buckets: %s", e)
+            return None
+        return float(wait)
+
+    async def acquire(self, tokens: int) -> None:
+        if not (self.requests.enabled or self.tokens.enabled):
+            return
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            wait = await self._shared_wait(tokens)
+            if wait is None:
+                return await super().acquire(tokens)
+            if wait <= 0:
+                return
+            if time.monotonic() + wait > deadline:
+                raise RateLimited(wait)
+            self.waited += wait
+            await asyncio.sleep(wait)
+
+
+class RetryBudget:
+    """Retries may not exceed `ratio` of the requests seen in the last `window` seconds."""
+
+    def __init__(self, ratio: float, minimum: int = 3, window: float = 10.0):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.window = window
+        self.requests: deque = deque()
+        self.retries: deque = deque()
+        self.denied = 0
+
+    def _trim(self, now: float) -> None:
+        for q in (self.requests, self.retries):
+            while q and q[0] < now - self.window:
+                q.popleft()
+
+    def record_request(self) -> None:
+        self.requests.append(time.monotonic())
+
+    def try_retry(self) -> bool:
+        now = time.monotonic()
+        self._trim(now)
+        if len(self.retries) >= max(self.minimum, self.ratio * len(self.requests)):
+            self.denied += 1
+            return False
+        self.retries.append(now)
+        return True
+
+
+class CircuitBreaker:
+    """closed -> open after N consecutive failures -> half-open probe after cooldown."""
+
+    def __init__(self, failures: int, cooldown: float):
+        self.threshold = failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = 0.0
+        self.state = "closed"
+        self.probing = False
+        self.rejected = 0
+
+    def admit(self) -> bool:
+        """Let a call through or raise CircuitOpen; True when the call is the half-open probe.
+
+        Only the probe may clear `probing` when it ends: a call admitted while the circuit was
+        closed can finish after it went half-open, and clearing it then would let in a second probe.
+        """
+        if self.state == "closed":
+            return False
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = "half_open"
+        if self.state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        self.rejected += 1
+        # While a probe is out, its outcome is due well within one cooldown
+        raise CircuitOpen(max(self.cooldown - (time.monotonic() - self.opened_at), 1.0))
+
+    def success(self) -> None:
+        self.failures = 0
+        self.state = "closed"
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.threshold:
+            if self.state != "open":
+                log.warning("circuit opened after %d failures", self.failures)
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+def _openai():
+    # Only consulted for exceptions, which can only come from an already-imported SDK
+    return sys.modules.get("openai")
+
+
+def retryable(exc: BaseException) -> bool:
+    openai = _openai()
+    if openai is None:
+        return False
+    if isinstance(exc, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)):
+        return True
+    return isinstance(exc, openai.APIStatusError) and exc.status_code in (408, 409, 502, 503, 504)
+
+
+def status_for(exc: BaseException) -> int:
+    if isinstance(exc, RateLimited):
+        return 429
+    openai = _openai()
+    if openai is not None:
+        if isinstance(exc, openai.APITimeoutError):
+            return 504
+        if isinstance(exc, openai.RateLimitError):
+            return 429
+        if isinstance(exc, (openai.APIConnectionError, openai.APIStatusError)):
+            return 502
+    return 500
+
+
+def _retry_after(exc: BaseException) -> Optional[float]:
+    response = getattr(exc, "response", None)
+    if response is None:
+        return None
+    ms = response.headers.get("retry-after-ms")
+    if ms:
+        try:
+            return float(ms) / 1000.0
+        except ValueError:
+            pass
+    return _seconds(response.headers.get("retry-after"))
+
+
+class Guard:
+    """Rate limiting, budgeted jittered retries and a circuit breaker around one upstream."""
+
+    def __init__(self, key_id: str = ""):
+        if RATE_BACKEND == "redis" and cache.aioredis is not None:
+            self.limiter = SharedRateLimiter(key_id, RPM, TPM, RATE_WAIT)
+        else:
+            self.limiter = RateLimiter(RPM, TPM, RATE_WAIT)
+        self.budget = RetryBudget(RETRY_BUDGET)
+        self.breaker = CircuitBreaker(BREAKER_FAILURES, BREAKER_COOLDOWN)
+        self.retries = 0
+        self.failures = 0
+
+    async def call(self, fn: Callable[[], Awaitable[Any]], tokens: int) -> Any:
+        probe = self.breaker.admit()
+        self.budget.record_request()
+        try:
+            return await self._attempts(fn, tokens)
+        finally:
+            if probe:
+                # However the probe ended (even cancelled or rate limited), the next call may probe
+                self.breaker.probing = False
+
+    async def _attempts(self, fn: Callable[[], Awaitable[Any]], tokens: int) -> Any:
+        attempt = 0
+        while True:
+            await self.limiter.acquire(tokens)
+            try:
+                raw = await fn()
+            except Exception as e:
+                if not retryable(e):
+                    # Client errors say nothing about upstream health
+                    self.breaker.success()
+                    raise
+                hint = _retry_after(e)
+                limited = getattr(e, "status_code", None) == 429
+                if hint and limited:
+                    self.limiter.pause(hint)
+                if hint is not None and hint > RETRY_CAP:
+                    # Sleeping here would hold the key's concurrency slot; the caller comes back instead
+                    if not limited:
+                        self.failures += 1
+                        self.breaker.failure()
+                    raise RateLimited(hint, "upstream asked to wait") from e
+                attempt += 1
+                if attempt >= RETRY_ATTEMPTS or not self.budget.try_retry():
+                    self.failures += 1
+                    self.breaker.failure()
+                    raise
+                self.retries += 1
+                delay = hint if hint is not None else random.uniform(0, min(RETRY_CAP, RETRY_BASE * 2 ** attempt))
+                await asyncio.sleep(delay)
+                continue
+            headers = getattr(raw, "headers", None)
+            if headers is not None:
+                self.limiter.observe(headers)
+            self.breaker.success()
+            return raw
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "breaker": self.breaker.state,
+            "breaker_rejected": self.breaker.rejected,
+            "retries": self.retries,
+            "retry_budget_denied": self.budget.denied,
+            "failures": self.failures,
+            "rate_wait_s": round(self.limiter.waited, 3),
+            "rate_backend": "redis" if isinstance(self.limiter, SharedRateLimiter) else "local",
+            "rpm_capacity": self.limiter.requests.capacity,
+            "tpm_capacity": self.limiter.tokens.capacity,
+        }
@@ -0,0 +1,300 @@
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+import cache
+import metrics
+from resilience import RateLimited
+
+log = logging.getLogger("ai.scheduler")
+
+# Priority order: Telegram chats first, then Codex, then /chat/batch items
+LANES = ("interactive", "codex", "batch")
+
+CAPACITY = int(os.getenv("AI_SCHED_CONCURRENCY", "32"))
+MAX_QUEUE = int(os.getenv("AI_SCHED_MAX_QUEUE", "1000"))
+MAX_WAIT = float(os.getenv("AI_SCHED_MAX_WAIT", "30"))
+
+# Defaults per scope (0 = unlimited); AI_QUOTAS and Redis hashes override per id
+DEFAULTS = {
+    "org": {
+        "concurrency": int(os.getenv("AI_ORG_CONCURRENCY", "0")),
+        "tpm": int(os.getenv("AI_ORG_TPM", "0")),
+        "weight": float(os.getenv("AI_ORG_WEIGHT", "1")),
+    },
+    "user": {
+        "concurrency": int(os.getenv("AI_USER_CONCURRENCY", "0")),
+        "tpm": int(os.getenv("AI_USER_TPM", "0")),
+        "weight": 1.0,
+    },
+}
+# local | redis; quotas are read from ai:quota:<scope>:<id> and usage counted in Redis
+QUOTA_BACKEND = os.getenv("AI_QUOTA_BACKEND", "redis" if cache.BACKEND == "redis" else "local").lower()
+QUOTA_REFRESH = float(os.getenv("AI_QUOTA_REFRESH", "30"))
+
+
+class QuotaExceeded(RateLimited):
+    def __init__(self, scope: str, retry_after: float):
+        super().__init__(retry_after, f"{scope} token quota exceeded")
+
+
+class QueueFull(RateLimited):
+    def __init__(self, lane: str, retry_after: float):
+        super().__init__(retry_after, f"{lane} queue full")
+
+
+def _parse_overrides(raw: str) -> Dict[Tuple[str, str], Dict[str, float]]:
+    """'org:12=concurrency:4,tpm:50000,weight:2;user:7=concurrency:1' -> {("org", "12"): {...}}"""
+    out: Dict[Tuple[str, str], Dict[str, float]] = {}
+    for item in filter(None, (part.strip() for part in raw.split(";"))):
+        target, _, fields = item.partition("=")
+        scope, _, ident = target.strip().partition(":")
+        values = {}
+        for field in filter(None, fields.split(",")):
+            name, _, value = field.partition(":")
+            values[name.strip()] = float(value)
+        out[(scope, ident)] = values
+    return out
+
+
+OVERRIDES = _parse_overrides(os.getenv("AI_QUOTAS", ""))
+
+
+class Quotas:
+    """Per-org and per-user limits plus per-minute token usage.
+
+    Limits come from the env defaults, AI_QUOTAS, then the Redis hash
+    ai:quota:<scope>:<id> (fields concurrency, tpm, weight). Usage is a fixed
+    one-minute window, in Redis when configured so it holds across workers.
+    Redis errors fall back to the in-process values.
+    """
+
+    def __init__(self, backend: str):
+        self.backend = backend
+        self.limits: Dict[Tuple[str, str], Tuple[float, Dict[str, float]]] = {}
+        self.usage: Dict[Tuple[str, str], Tuple[int, int]] = {}
+        self.errors = 0
+
+    def _redis(self):
+        return cache.redis_client() if self.backend == "redis" else None
+
+    async def get(self, scope: str, ident: str) -> Dict[str, float]:
+        key = (scope, ident)
+        cached = self.limits.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        values = {**DEFAULTS[scope], **OVERRIDES.get(key, {})}
+        client = self._redis()
+        if client is not None:
+            try:
+                stored = await client.hgetall(f"ai:quota:{scope}:{ident}")
+                values.update({k.decode(): float(v) for k, v in stored.items() if k.decode() in values})
+            except Exception as e:
+                self.errors += 1
+                log.warning("quota lookup failed, using defaults: %s", e)
+        self.limits[key] = (time.monotonic() + QUOTA_REFRESH, values)
+        return values
+
+    async def _add(self, scope: str, ident: str, tokens: int) -> int:
+        """Add tokens to this minute's usage and return the new total."""
+        minute = int(time.time() // 60)
+        client = self._redis()
+        if client is not None:
+            key = f"ai:usage:{scope}:{ident}:{minute}"
+            try:
+                async with client.pipeline(transaction=True) as pipe:
+                    used, _ = await pipe.incrby(key, tokens).expire(key, 120).execute()
+                return int(used)
+            except Exception as e:
+                self.errors += 1
+                log.warning("quota usage update failed, counting locally: %s", e)
+        window, used = self.usage.get((scope, ident), (minute, 0))
+        used = (used if window == minute else 0) + tokens
+        self.usage[(scope, ident)] = (minute, used)
+        return used
+
+    async def charge(self, limits: List[Tuple[str, str, Dict[str, float]]], tokens: int, enforce: bool = True) -> None:
+        """Count tokens against every scope; raises QuotaExceeded (and refunds) when one is over."""
+        charged = []
+        for scope, ident, quota in limits:
+            used = await self._add(scope, ident, tokens)
+            charged.append((scope, ident))
+            if enforce and quota["tpm"] and used > quota["tpm"]:
+                for s, i in charged:
+                    await self._add(s, i, -tokens)
+                raise QuotaExceeded(scope, 60 - time.time() % 60)
+
+
+class _Waiter:
+    __slots__ = ("lane", "org", "user", "finish", "seq", "org_cap", "user_cap", "future", "queued_at")
+
+    def __init__(self, lane: str, org: str, user: str, finish: float, seq: int, org_cap: int, user_cap: int):
+        self.lane = lane
+        self.org = org
+        self.user = user
+        self.finish = finish
+        self.seq = seq
+        self.org_cap = org_cap
+        self.user_cap = user_cap
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.queued_at = time.perf_counter()
+
+
+class FairScheduler:
+    """Admission to upstream calls: priority lanes, weighted fair queuing per org, quotas.
+
+    Lanes are served in strict priority order. Inside a lane the waiter with the
+    smallest virtual finish time goes next; an org's finish time advances by
+    tokens / weight per request, so a busy org cannot crowd out a quiet one.
+    Waiters whose org or user is at its concurrency cap are skipped until a slot
+    of theirs frees up.
+    """
+
+    def __init__(self, capacity: int, quotas: Quotas):
+        self.capacity = capacity
+        self.quotas = quotas
+        self.active = 0
+        self.queues: Dict[str, List[_Waiter]] = {lane: [] for lane in LANES}
+        self.vtime: Dict[str, float] = {lane: 0.0 for lane in LANES}
+        self.last_finish: Dict[Tuple[str, str], float] = {}
+        self.org_active: Counter = Counter()
+        self.user_active: Counter = Counter()
+        self.seq = 0
+        self.dispatched: Counter = Counter()
+        self.rejected: Counter = Counter()
+        self.waited: Counter = Counter()
+
+    @asynccontextmanager
+    async def slot(self, lane: str, org_id: Optional[int], user_id: int, tokens: int):
+        """Hold one upstream slot for the body; raises QuotaExceeded or QueueFull (HTTP 429)."""
+        org = str(org_id) if org_id is not None else "-"
+        user = str(user_id)
+        org_quota = await self.quotas.get("org", org)
+        user_quota = await self.quotas.get("user", user)
+        try:
+            await self.quotas.charge([("user", user, user_quota), ("org", org, org_quota)], tokens)
+        except QuotaExceeded:
+            self._reject(lane, "quota")
+            raise
+        try:
+            waiter = await self._acquire(lane, org, user, tokens, org_quota, user_quota)
+        except BaseException:
+            # Never admitted: give the tokens back
+            await self.quotas.charge([("user", user, user_quota), ("org", org, org_quota)], -tokens, enforce=False)
+            raise
+        try:
+            yield
+        finally:
+            self._release(waiter)
+
+    async def record_completion(self, org_id: Optional[int], user_id: int, tokens: int) -> None:
+        """Charge completion tokens after the fact; they never reject the finished call."""
+        if tokens:
+            org = str(org_id) if org_id is not None else "-"
+            await self.quotas.charge(
+                [("user", str(user_id), DEFAULTS["user"]), ("org", org, DEFAULTS["org"])], tokens, enforce=False
+            )
+
+    def _reject(self, lane: str, reason: str) -> None:
+        self.rejected[reason] += 1
+        metrics.SCHED_REJECTED.labels(lane, reason).inc()
+
+    async def _acquire(self, lane: str, org: str, user: str, tokens: int, org_quota, user_quota) -> _Waiter:
+        queue = self.queues[lane]
+        if len(queue) >= MAX_QUEUE:
+            self._reject(lane, "queue_full")
+            raise QueueFull(lane, 1.0)
+        key = (lane, org)
+        start = max(self.vtime[lane], self.last_finish.get(key, 0.0))
+        finish = start + max(tokens, 1) / max(org_quota["weight"], 0.01)
+        self.last_finish[key] = finish
+        self.seq += 1
+        waiter = _Waiter(lane, org, user, finish, self.seq, int(org_quota["concurrency"]), int(user_quota["concurrency"]))
+        queue.append(waiter)
+        metrics.SCHED_QUEUED.labels(lane).inc()
+        self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), MAX_WAIT)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            granted = waiter.future.done() and not waiter.future.cancelled()
+            if isinstance(e, asyncio.TimeoutError):
+                if granted:
+                    return waiter
+                self._withdraw(waiter)
+                self._reject(lane, "timeout")
+                raise QueueFull(lane, MAX_WAIT) from None
+            if granted:
+                # Granted at the same moment the caller went away; hand the slot back
+                self._release(waiter)
+            else:
+                self._withdraw(waiter)
+            raise
+        return waiter
+
+    def _withdraw(self, waiter: _Waiter) -> None:
+        waiter.future.cancel()
+        self.queues[waiter.lane].remove(waiter)
+        metrics.SCHED_QUEUED.labels(waiter.lane).dec()
+
+    def _eligible(self, waiter: _Waiter) -> bool:
+        if waiter.org_cap and self.org_active[waiter.org] >= waiter.org_cap:
+            return False
+        return not (waiter.user_cap and self.user_active[waiter.user] >= waiter.user_cap)
+
+    def _dispatch(self) -> None:
+        while self.active < self.capacity:
+            waiter = None
+            for lane in LANES:
+                candidates = [w for w in self.queues[lane] if self._eligible(w)]
+                if candidates:
+                    waiter = min(candidates, key=lambda w: (w.finish, w.seq))
+                    break
+            if waiter is None:
+                return
+            self.queues[waiter.lane].remove(waiter)
+            self.vtime[waiter.lane] = max(self.vtime[waiter.lane], waiter.finish)
+            self.active += 1
+            self.org_active[waiter.org] += 1
+            self.user_active[waiter.user] += 1
+            wait = time.perf_counter() - waiter.queued_at
+            self.dispatched[waiter.lane] += 1
+            self.waited[waiter.lane] += wait
+            metrics.SCHED_QUEUED.labels(waiter.lane).dec()
+            metrics.SCHED_WAIT.labels(waiter.lane).observe(wait)
+            waiter.future.set_result(None)
+
+    def _release(self, waiter: _Waiter) -> None:
+        self.active -= 1
+        self.org_active[waiter.org] -= 1
+        self.user_active[waiter.user] -= 1
+        if self.org_active[waiter.org] <= 0:
+            del self.org_active[waiter.org]
+        if self.user_active[waiter.user] <= 0:
+            del self.user_active[waiter.user]
+        if not any(self.queues.values()):
+            # Idle: restart virtual time so finish tags do not grow without bound
+            self.vtime = {lane: 0.0 for lane in LANES}
+            self.last_finish.clear()
+        self._dispatch()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "capacity": self.capacity,
+            "active": self.active,
+            "queued": {lane: len(q) for lane, q in self.queues.items()},
+            "dispatched": dict(self.dispatched),
+            "avg_wait_ms": {
+                lane: round(self.waited[lane] / n * 1000, 1) for lane, n in self.dispatched.items() if n
+            },
+            "rejected": dict(self.rejected),
+            "quota_backend": self.quotas.backend,
+            "quota_errors": self.quotas.errors,
+        }
+
+
+def make_scheduler() -> FairScheduler:
+    return FairScheduler(CAPACITY, Quotas(QUOTA_BACKEND))
@@ -0,0 +1,112 @@
+import logging
+import os
+from typing import Any, Dict, List, Optional
+
+import cache
+
+log = logging.getLogger("ai.sessions")
+
+# off | memory | redis; defaults to Redis when the answer cache uses it
+BACKEND = os.getenv("AI_SESSIONS", "redis" if cache.BACKEND == "redis" else "memory").lower()
+TTL = int(os.getenv("AI_SESSION_TTL", "86400"))
+MAX_SESSIONS = int(os.getenv("AI_SESSION_MAX_ENTRIES", "10000"))
+# Older turns are discarded; the prompt budget usually keeps far fewer
+MAX_MESSAGES = int(os.getenv("AI_SESSION_MAX_MESSAGES", "200"))
+# Once turns must be dropped, refill only this share of the prompt budget
+LOW_WATER = float(os.getenv("AI_SESSION_LOW_WATER", "0.7"))
+
+
+class Session:
+    """Conversation kept by the service: all turns plus the index of the first one still sent."""
+
+    def __init__(self, key: str, messages: List[Dict[str, str]], start: int = 0, new: bool = False):
+        self.key = key
+        self.messages = messages
+        self.start = start
+        self.new = new
+
+    def window(self) -> List[Dict[str, str]]:
+        return self.messages[self.start:]
+
+
+class SessionStore:
+    """Sessions keyed by user and client chat id, expiring `ttl` seconds after the last turn.
+
+    Backend errors are logged; the turn is then answered as a new conversation.
+    """
+
+    def __init__(self, store, ttl: int):
+        self.store = store
+        self.ttl = ttl
+        self.created = 0
+        self.resumed = 0
+        self.errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.store is not None
+
+    async def open(self, user_id: int, session_id: str, seed: List[Dict[str, str]], message: str) -> Session:
+        key = f"{user_id}:{session_id}"
+        try:
+            stored = await self.store.get(key)
+        except Exception as e:  # pragma: no cover
+            self.errors += 1
+            log.warning("session load failed: %s", e)
+            stored = None
+        if stored and stored.get("messages"):
+            self.resumed += 1
+            return Session(key, list(stored["messages"]), int(stored.get("start", 0)))
+        self.created += 1
+        # First turn of a client that still sends history; older clients append the new message too
+        if seed and seed[-1] == {"role": "user", "content": message}:
+            seed = seed[:-1]
+        return Session(key, list(seed), new=True)
+
+    async def append(self, session: Session, message: str, answer: Optional[str]) -> bool:
+        """Add the turn to the stored conversation; True once it is saved.
+
+        The stored copy is re-read and extended in one step, so turns answered concurrently for the
+        same session all land instead of the last one overwriting the others.
+        """
+        if answer is None:
+            return False
+        turn = [{"role": "user", "content": message}, {"role": "assistant", "content": answer}]
+
+        def extend(stored: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+            if stored and stored.get("messages"):
+                messages, start = list(stored["messages"]), max(int(stored.get("start", 0)), session.start)
+            else:
+                messages, start = list(session.messages), session.start
+            messages += turn
+            excess = len(messages) - MAX_MESSAGES
+            if excess > 0:
+                del messages[:excess]
+                start = max(0, start - excess)
+            return {"messages": messages, "start": start}
+
+        try:
+            saved = await self.store.update(session.key, extend, self.ttl)
+        except Exception as e:  # pragma: no cover
+            self.errors += 1
+            log.warning("session save failed: %s", e)
+            return False
+        session.messages, session.start = saved["messages"], saved["start"]
+        return True
+
+    async def reset(self, user_id: int, session_id: str) -> None:
+        await self.store.delete(f"{user_id}:{session_id}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": BACKEND if self.enabled else "off",
+            "ttl": self.ttl,
+            "created": self.created,
+            "resumed": self.resumed,
+            "errors": self.errors,
+            "size": self.store.size() if self.store is not None else 0,
+        }
+
+
+def make_store() -> SessionStore:
+    return SessionStore(cache.make_store(BACKEND, "ai:session:", MAX_SESSIONS), TTL)
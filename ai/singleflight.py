@@ -0,0 +1,44 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key into one upstream call.
+
+    The call runs as its own task, so a disconnecting caller does not cancel it
+    for the other waiters. Every waiter gets the same result or exception and
+    waits at most `timeout` seconds.
+    """
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.inflight: Dict[str, asyncio.Task] = {}
+        self.calls = 0
+        self.shared = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self.inflight.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(fn())
+            self.inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            self.shared += 1
+        return await asyncio.wait_for(asyncio.shield(task), self.timeout)
+
+    def _done(self, key: str, task: asyncio.Task) -> None:
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+        # Mark the exception as retrieved even if every waiter timed out
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.calls + self.shared
+        return {
+            "calls": self.calls,
+            "shared": self.shared,
+            "shared_rate": round(self.shared / total, 4) if total else 0.0,
+            "inflight": len(self.inflight),
+        }
@@ -0,0 +1,21 @@
+import httpx
+from fastapi import FastAPI
+from openai import AsyncOpenAI
+
+import main
+import upstream
+
+API_KEY = "sk-test"
+
+
+def use_upstream(app: FastAPI) -> None:
+    """Route the service's pooled client for API_KEY to an in-process ASGI upstream."""
+    client = AsyncOpenAI(
+        api_key=API_KEY, base_url="http://stub/v1", max_retries=0,
+        http_client=httpx.AsyncClient(transport=httpx.ASGITransport(app=app)),
+    )
+    upstream._clients[API_KEY] = upstream.Upstream(client)
+
+
+def service_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://ai")
@@ -0,0 +1,58 @@
+import json
+import os
+import unittest
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+import upstream
+from bench import stub_upstream
+from tests.support import API_KEY, service_client, use_upstream
+
+
+def _items(n: int) -> list[dict]:
+    return [{"user_id": 1, "org_id": 1, "message": f"supply order #{i}"} for i in range(n)]
+
+
+class BatchTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        os.environ["OPENAI_API_KEY"] = API_KEY
+        stub_upstream.LATENCY = 0.05
+
+    async def asyncTearDown(self):
+        await upstream.close_clients()
+
+    async def test_results_keep_input_order(self):
+        use_upstream(stub_upstream.app)
+        async with service_client() as c:
+            r = await c.post("/chat/batch", json={"items": _items(12), "concurrency": 4})
+        results = r.json()["results"]
+        self.assertEqual([x["index"] for x in results], list(range(12)))
+        self.assertTrue(all(x["ok"] for x in results))
+        self.assertIn("supply order #7", results[7]["answer"])
+
+    async def test_item_errors_do_not_fail_the_batch(self):
+        flaky = FastAPI()
+
+        @flaky.post("/v1/chat/completions")
+        async def completions(request: Request):
+            body = await request.json()
+            if body["messages"][-1]["content"].endswith("#1"):
+                return JSONResponse({"error": {"message": "boom"}}, status_code=400)
+            return await stub_upstream.completions(request)
+
+        use_upstream(flaky)
+        async with service_client() as c:
+            r = await c.post("/chat/batch", json={"items": _items(3), "stream": True})
+        lines = sorted((json.loads(x) for x in r.text.splitlines()), key=lambda x: x["index"])
+        self.assertEqual([x["ok"] for x in lines], [True, False, True])
+        self.assertEqual(lines[1]["status"], 502)
+
+    async def test_rejects_oversized_batch(self):
+        async with service_client() as c:
+            r = await c.post("/chat/batch", json={"items": _items(101)})
+        self.assertEqual(r.status_code, 413)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from unittest import mock
+
+import budget
+import main
+
+
+def _payload(turns: int, size: int = 40) -> main.ChatPayload:
+    history = [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"{i}:" + "x" * size}
+        for i in range(turns)
+    ]
+    return main.ChatPayload(
+        user_id=1, org_id=2, message="oxirgi savol", history=history,
+        context={"org": "Pul", "ids": [1, 2]}, model="test-model",
+    )
+
+
+class BudgetTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        # Deterministic length heuristic regardless of tiktoken availability
+        budget._encodings["test-model"] = None
+        budget.BUDGETS["test-model"] = 600
+
+    async def test_short_conversation_is_unchanged(self):
+        payload = _payload(4)
+        kwargs, _ = await main._build_kwargs(payload, force_json=False)
+        self.assertEqual([m["content"] for m in kwargs["messages"][1:-2]], [m.content for m in payload.history])
+        self.assertEqual(kwargs["messages"][-1], {"role": "user", "content": "oxirgi savol"})
+
+    async def test_long_conversation_keeps_newest_turns_within_budget(self):
+        payload = _payload(60)
+        kwargs, _ = await main._build_kwargs(payload, force_json=False)
+        messages = kwargs["messages"]
+        kept = messages[1:-2]
+        self.assertLess(len(kept), 60)
+        self.assertEqual(kept[-1]["content"], payload.history[-1].content)
+        self.assertLessEqual(budget._tokens(messages, "test-model"), 600)
+
+    async def test_context_is_compact_json_after_the_history(self):
+        kwargs, _ = await main._build_kwargs(_payload(2), force_json=False)
+        # The static system prompt leads so the upstream can cache the prefix
+        self.assertEqual(kwargs["messages"][0]["content"], main.SYSTEM_PROMPT)
+        self.assertIn('{"org":"Pul","ids":[1,2]}', kwargs["messages"][-2]["content"])
+
+    async def test_history_summary_goes_through_the_scheduler(self):
+        slots = []
+
+        @asynccontextmanager
+        async def slot(lane, org_id, user_id, tokens):
+            slots.append((lane, org_id, user_id, tokens))
+            yield
+
+        class Up:
+            async def create(self, tokens, **kwargs):
+                choice = SimpleNamespace(message=SimpleNamespace(content="xulosa"))
+                return SimpleNamespace(choices=[choice], usage=SimpleNamespace(completion_tokens=7))
+
+        completions = mock.AsyncMock()
+        with mock.patch.object(budget, "SUMMARIZE", True), \
+                mock.patch.object(main.SCHEDULER, "slot", slot), \
+                mock.patch.object(main.SCHEDULER, "record_completion", completions):
+            kwargs, _ = await main._build_kwargs(_payload(60), False, Up(), lane="codex")
+        self.assertIn("xulosa", kwargs["messages"][1]["content"])
+        self.assertEqual(len(slots), 1)
+        self.assertEqual(slots[0][:3], ("codex", 2, 1))
+        self.assertGreater(slots[0][3], 0)
+        completions.assert_awaited_once_with(2, 1, 7)
+
+    def test_low_water_trims_in_steps(self):
+        system = {"role": "system", "content": "s"}
+        history = [{"role": "user", "content": "x" * 60} for _ in range(40)]
+        kept, dropped, _ = budget.fit([system], history, "test-model")
+        stepped, _, _ = budget.fit([system], history, "test-model", low_water=0.5)
+        self.assertTrue(dropped)
+        self.assertLess(len(stepped), len(kept))
+        self.assertGreater(len(stepped), 0)
+
+    def test_dated_snapshot_uses_family_budget(self):
+        self.assertEqual(budget.budget_for("gpt-4o-2024-08-06"), budget.BUDGETS["gpt-4o"])
+        self.assertEqual(budget.budget_for("unknown"), budget.DEFAULT_BUDGET)
+        self.assertEqual(budget.budget_for("gpt-4o-mini-2024-07-18"), 8000)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import os
+import unittest
+from unittest import mock
+
+import cache
+import main
+import upstream
+from bench import stub_upstream
+from tests.support import API_KEY, service_client, use_upstream
+
+
+def _payload(**extra) -> dict:
+    return {"model": "gpt-4o", "history": [], "message": "qoldiq", "context": {"org": "Pul", "day": 1}, **extra}
+
+
+class RequestKeyTest(unittest.TestCase):
+    def _key(self, force_json: bool = False, **extra) -> str:
+        return cache.request_key(_payload(**extra), "system", force_json)
+
+    def test_equal_requests_share_a_key(self):
+        self.assertEqual(self._key(), self._key())
+        # Key order in the context says nothing about the request
+        self.assertEqual(self._key(), self._key(context={"day": 1, "org": "Pul"}))
+
+    def test_anything_that_changes_the_answer_changes_the_key(self):
+        base = self._key()
+        self.assertNotEqual(base, self._key(force_json=True))
+        self.assertNotEqual(base, self._key(context={"org": "Pul", "day": 2}))
+        self.assertNotEqual(base, self._key(message="boshqa"))
+        self.assertNotEqual(base, self._key(model="gpt-4o-mini"))
+        self.assertNotEqual(base, self._key(history=[{"role": "user", "content": "avval"}]))
+        self.assertNotEqual(base, cache.request_key(_payload(), "other system", False))
+
+
+class MemoryStoreTest(unittest.IsolatedAsyncioTestCase):
+    async def test_entries_expire_after_their_ttl(self):
+        store = cache.MemoryStore(10)
+        with mock.patch.object(cache.time, "monotonic", return_value=100.0):
+            await store.set("k", {"v": 1}, 5)
+            self.assertEqual(await store.get("k"), {"v": 1})
+        with mock.patch.object(cache.time, "monotonic", return_value=106.0):
+            self.assertIsNone(await store.get("k"))
+        self.assertEqual(store.size(), 0)
+
+    async def test_least_recently_used_entry_is_evicted(self):
+        store = cache.MemoryStore(2)
+        await store.set("a", {"v": "a"}, 60)
+        await store.set("b", {"v": "b"}, 60)
+        await store.get("a")
+        await store.set("c", {"v": "c"}, 60)
+        self.assertIsNone(await store.get("b"))
+        self.assertEqual(await store.get("a"), {"v": "a"})
+        self.assertEqual(store.evictions, 1)
+
+    async def test_oversized_answers_are_not_cached(self):
+        answers = cache.ResponseCache("chat", 60, cache.MemoryStore(10))
+        with mock.patch.object(cache, "MAX_VALUE_BYTES", 100):
+            await answers.set("big", {"answer": "x" * 200})
+            await answers.set("small", {"answer": "x"})
+        self.assertIsNone(await answers.get("big"))
+        self.assertEqual(await answers.get("small"), {"answer": "x"})
+
+
+class HealthCountersTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        os.environ["OPENAI_API_KEY"] = API_KEY
+        stub_upstream.LATENCY = 0.01
+        stub_upstream.FAULTS.update(fail_rate=0.0)
+        use_upstream(stub_upstream.app)
+
+    async def asyncTearDown(self):
+        await upstream.close_clients()
+
+    async def test_hits_misses_and_evictions_are_reported(self):
+        answers = cache.ResponseCache("chat", 60, cache.MemoryStore(1))
+        with mock.patch.dict(main.CACHES, chat=answers):
+            async with service_client() as c:
+                for message in ("bir", "bir", "ikki"):
+                    r = await c.post("/chat", json={"user_id": 1, "org_id": 1, "message": message})
+                    self.assertEqual(r.status_code, 200)
+                stats = (await c.get("/health")).json()["cache"]["chat"]
+        self.assertEqual((stats["hits"], stats["misses"], stats["evictions"]), (1, 2, 1))
+        self.assertEqual(stats["hit_rate"], round(1 / 3, 4))
+        self.assertEqual(stats["size"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import json
+import os
+import re
+import unittest
+
+import upstream
+from bench import stub_upstream
+from tests.support import API_KEY, service_client, use_upstream
+
+
+def _payload() -> dict:
+    return {"user_id": 1, "org_id": 1, "message": "kirim-chiqim", "model": "gpt-4o-mini"}
+
+
+class MetricsTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        os.environ["OPENAI_API_KEY"] = API_KEY
+        stub_upstream.LATENCY = 0.01
+        stub_upstream.FAULTS.update(fail_rate=0.0)
+        use_upstream(stub_upstream.app)
+
+    async def asyncTearDown(self):
+        await upstream.close_clients()
+
+    async def test_request_id_is_echoed_or_generated(self):
+        async with service_client() as c:
+            given = await c.post("/chat", json=_payload(), headers={"X-Request-Id": "php-123"})
+            generated = await c.post("/chat", json=_payload())
+        self.assertEqual(given.headers["x-request-id"], "php-123")
+        self.assertRegex(generated.headers["x-request-id"], r"^[0-9a-f]{32}$")
+
+    async def test_one_log_line_per_request_carries_the_request_id(self):
+        with self.assertLogs("ai.access", "INFO") as logs:
+            async with service_client() as c:
+                await c.post("/chat", json=_payload(), headers={"X-Request-Id": "php-456"})
+                await c.get("/health")
+        events = [json.loads(line.split(":", 2)[2]) for line in logs.output]
+        http = [e for e in events if e["event"] == "http"]
+        self.assertEqual(len(http), 1)
+        self.assertEqual(http[0]["request_id"], "php-456")
+        self.assertEqual((http[0]["method"], http[0]["path"], http[0]["status"]), ("POST", "/chat", 200))
+        self.assertGreater(http[0]["bytes_in"], 0)
+        self.assertIn("duration_ms", http[0])
+        chat = [e for e in events if e["event"] == "chat"]
+        self.assertEqual(chat[0]["request_id"], "php-456")
+        self.assertEqual(chat[0]["outcome"], "upstream")
+
+    async def test_metrics_exposition(self):
+        async with service_client() as c:
+            await c.post("/chat", json=_payload())
+            r = await c.get("/metrics")
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.headers["content-type"].startswith("text/plain"))
+        body = r.text
+        for series in (
+            'ai_http_requests_total{path="/chat",status="200"}',
+            'ai_http_request_seconds_bucket{le="0.05",path="/chat"}',
+            'ai_http_request_bytes_count{path="/chat"}',
+            'ai_chat_requests_total{endpoint="chat",model="gpt-4o-mini",outcome="upstream"}',
+            'ai_prompt_tokens_total{model="gpt-4o-mini"}',
+            'ai_completion_tokens_total{model="gpt-4o-mini"}',
+            "ai_upstream_ttfb_seconds_count",
+            'ai_prompt_fit_total{result="kept"}',
+            'ai_prompt_fit_tokens_total{stage="in"}',
+        ):
+            self.assertRegex(body, re.escape(series) + r" [0-9.e+]+\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+import asyncio
+import os
+import time
+import unittest
+from unittest import mock
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+import resilience
+import upstream
+from bench import stub_upstream
+from tests.support import API_KEY, service_client, use_upstream
+
+
+def _payload(i: int) -> dict:
+    return {"user_id": 1, "org_id": 1, "message": f"savol {i}"}
+
+
+class GuardTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        os.environ["OPENAI_API_KEY"] = API_KEY
+        stub_upstream.LATENCY = 0.01
+        stub_upstream.CALLS["count"] = 0
+        self.faults = dict(stub_upstream.FAULTS)
+
+    async def asyncTearDown(self):
+        stub_upstream.FAULTS.update(self.faults)
+        await upstream.close_clients()
+
+    async def test_breaker_opens_then_serves_fallback_and_recovers(self):
+        stub_upstream.FAULTS.update(fail_rate=1.0, status=503)
+        with mock.patch.multiple(resilience, RETRY_ATTEMPTS=1, BREAKER_FAILURES=3, BREAKER_COOLDOWN=0.2):
+            use_upstream(stub_upstream.app)
+            async with service_client() as c:
+                codes = [(await c.post("/chat", json=_payload(i))).status_code for i in range(3)]
+                self.assertEqual(codes, [502, 502, 502])
+
+                r = await c.post("/chat", json=_payload(3))
+                self.assertEqual(r.status_code, 200)
+                self.assertTrue(r.json()["degraded"])
+                self.assertEqual(stub_upstream.CALLS["count"], 3)
+
+                # Codex must not take the placeholder for an answer
+                r = await c.post("/chat-codex", json=_payload(5))
+                self.assertEqual(r.status_code, 503)
+                self.assertIn("Retry-After", r.headers)
+                self.assertEqual(stub_upstream.CALLS["count"], 3)
+
+                stub_upstream.FAULTS.update(fail_rate=0.0)
+                await asyncio.sleep(0.25)
+                r = await c.post("/chat", json=_payload(4))
+                self.assertNotIn("degraded", r.json())
+                self.assertEqual(upstream.stats()["client_0"]["breaker"], "closed")
+
+    async def test_transient_fault_is_retried(self):
+        flaky = FastAPI()
+        calls = []
+
+        @flaky.post("/v1/chat/completions")
+        async def completions(request: Request):
+            calls.append(1)
+            if len(calls) == 1:
+                return JSONResponse({"error": {"message": "busy"}}, status_code=503)
+            return await stub_upstream.completions(request)
+
+        with mock.patch.object(resilience, "RETRY_BASE", 0.01):
+            use_upstream(flaky)
+            async with service_client() as c:
+                r = await c.post("/chat", json=_payload(0))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(calls), 2)
+
+    async def test_long_retry_after_is_passed_on_instead_of_slept(self):
+        calls = []
+        limited = FastAPI()
+
+        @limited.post("/v1/chat/completions")
+        async def completions(request: Request):
+            calls.append(1)
+            return JSONResponse({"error": {"message": "slow down"}}, status_code=429, headers={"Retry-After": "60"})
+
+        use_upstream(limited)
+        started = time.monotonic()
+        async with service_client() as c:
+            r = await c.post("/chat", json=_payload(0))
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(r.status_code, 429)
+        self.assertGreaterEqual(int(r.headers["Retry-After"]), 60)
+        self.assertEqual(len(calls), 1)
+
+    async def test_a_call_from_before_the_probe_does_not_admit_another(self):
+        guard = resilience.Guard()
+        guard.breaker = resilience.CircuitBreaker(failures=1, cooldown=0.05)
+        hang = asyncio.Event()
+        old = asyncio.create_task(guard.call(hang.wait, 1))
+        await asyncio.sleep(0)
+        guard.breaker.failure()
+        await asyncio.sleep(0.06)
+        probe = asyncio.create_task(guard.call(hang.wait, 1))
+        await asyncio.sleep(0)
+        self.assertTrue(guard.breaker.probing)
+        # Admitted while closed, it ends while the probe is still out
+        old.cancel()
+        await asyncio.gather(old, return_exceptions=True)
+        with self.assertRaises(resilience.CircuitOpen):
+            await guard.call(hang.wait, 1)
+        probe.cancel()
+        await asyncio.gather(probe, return_exceptions=True)
+        self.assertFalse(guard.breaker.probing)
+
+    def test_retry_budget_caps_retries(self):
+        budget = resilience.RetryBudget(ratio=0.1, minimum=2)
+        for _ in range(5):
+            budget.record_request()
+        self.assertEqual([budget.try_retry() for _ in range(3)], [True, True, False])
+        self.assertEqual(budget.denied, 1)
+
+    async def test_limiter_follows_rate_limit_headers(self):
+        limiter = resilience.RateLimiter(rpm=600, tpm=0, max_wait=1.0)
+        limiter.observe({
+            "x-ratelimit-limit-requests": "600",
+            "x-ratelimit-remaining-requests": "0",
+            "x-ratelimit-reset-requests": "200ms",
+        })
+        t0 = time.monotonic()
+        await limiter.acquire(10)
+        self.assertGreaterEqual(time.monotonic() - t0, 0.19)
+
+        limiter.requests.pause(5)
+        with self.assertRaises(resilience.RateLimited):
+            await limiter.acquire(10)
+
+
+if __name__ == "__main__":
+    unittest.main()
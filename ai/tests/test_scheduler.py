@@ -0,0 +1,110 @@
+import asyncio
+import os
+import unittest
+from unittest import mock
+
+import main
+import scheduler
+import upstream
+from bench import stub_upstream
+from tests.support import API_KEY, service_client, use_upstream
+
+
+async def _hold(sched: scheduler.FairScheduler, order: list, name: str, lane: str, org: int, release: asyncio.Event):
+    async with sched.slot(lane, org, org, 10):
+        order.append(name)
+        await release.wait()
+
+
+class FairSchedulerTest(unittest.IsolatedAsyncioTestCase):
+    def _scheduler(self, capacity: int = 1) -> scheduler.FairScheduler:
+        return scheduler.FairScheduler(capacity, scheduler.Quotas("local"))
+
+    async def _drain(self, sched, jobs):
+        """Start jobs one after another behind a blocker, then let them run one at a time."""
+        order: list = []
+        gate = asyncio.Event()
+        blocker = asyncio.create_task(_hold(sched, order, "blocker", "interactive", 0, gate))
+        await asyncio.sleep(0)
+        events = []
+        for name, lane, org in jobs:
+            event = asyncio.Event()
+            event.set()
+            events.append(asyncio.create_task(_hold(sched, order, name, lane, org, event)))
+            await asyncio.sleep(0)
+        gate.set()
+        await asyncio.gather(blocker, *events)
+        return order[1:]
+
+    async def test_interactive_lane_jumps_ahead(self):
+        order = await self._drain(self._scheduler(), [
+            ("batch-1", "batch", 1), ("codex-1", "codex", 1), ("chat-1", "interactive", 2), ("batch-2", "batch", 1),
+        ])
+        self.assertEqual(order, ["chat-1", "codex-1", "batch-1", "batch-2"])
+
+    async def test_orgs_share_a_lane_fairly(self):
+        # Org 1 queues five requests before org 2's first; org 2 still gets every other slot
+        jobs = [(f"a{i}", "batch", 1) for i in range(5)] + [(f"b{i}", "batch", 2) for i in range(2)]
+        order = await self._drain(self._scheduler(), jobs)
+        self.assertEqual(order[:4], ["a0", "b0", "a1", "b1"])
+
+    async def test_org_concurrency_cap(self):
+        sched = self._scheduler(capacity=4)
+        with mock.patch.dict(scheduler.OVERRIDES, {("org", "1"): {"concurrency": 1}}):
+            order: list = []
+            gate = asyncio.Event()
+            tasks = [asyncio.create_task(_hold(sched, order, f"a{i}", "interactive", 1, gate)) for i in range(2)]
+            tasks.append(asyncio.create_task(_hold(sched, order, "b0", "interactive", 2, gate)))
+            await asyncio.sleep(0.01)
+            self.assertEqual(order, ["a0", "b0"])
+            self.assertEqual(sched.stats()["queued"]["interactive"], 1)
+            gate.set()
+            await asyncio.gather(*tasks)
+        self.assertEqual(order, ["a0", "b0", "a1"])
+
+    async def test_token_quota_rejects_with_retry_after(self):
+        sched = self._scheduler(capacity=4)
+        with mock.patch.dict(scheduler.OVERRIDES, {("user", "7"): {"tpm": 25}}):
+            async with sched.slot("interactive", 1, 7, 10):
+                pass
+            async with sched.slot("interactive", 1, 7, 10):
+                pass
+            with self.assertRaises(scheduler.QuotaExceeded) as err:
+                async with sched.slot("interactive", 1, 7, 10):
+                    pass
+        self.assertGreater(err.exception.retry_after, 0)
+        self.assertEqual(sched.stats()["rejected"], {"quota": 1})
+
+    async def test_queue_timeout_frees_the_waiter(self):
+        sched = self._scheduler()
+        gate = asyncio.Event()
+        blocker = asyncio.create_task(_hold(sched, [], "blocker", "interactive", 1, gate))
+        await asyncio.sleep(0)
+        with mock.patch.object(scheduler, "MAX_WAIT", 0.05):
+            with self.assertRaises(scheduler.QueueFull):
+                async with sched.slot("batch", 2, 2, 10):
+                    pass
+        self.assertEqual(sched.stats()["queued"]["batch"], 0)
+        gate.set()
+        await blocker
+        self.assertEqual(sched.active, 0)
+
+
+class QuotaEndpointTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        os.environ["OPENAI_API_KEY"] = API_KEY
+        stub_upstream.LATENCY = 0.01
+        main.SCHEDULER = self.sched = scheduler.FairScheduler(4, scheduler.Quotas("local"))
+
+    async def asyncTearDown(self):
+        main.SCHEDULER = scheduler.make_scheduler()
+        await upstream.close_clients()
+
+    async def test_quota_exceeded_is_429(self):
+        use_upstream(stub_upstream.app)
+        with mock.patch.dict(scheduler.OVERRIDES, {("org", "5"): {"tpm": 1}}):
+            async with service_client() as c:
+                r = await c.post("/chat", json={"user_id": 1, "org_id": 5, "message": "salom"})
+        self.assertEqual(r.status_code, 429)
+        self.assertIn("Retry-After", r.headers)
+        self.assertIn("org token quota", r.json()["detail"])
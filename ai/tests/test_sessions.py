@@ -0,0 +1,105 @@
+import asyncio
+import os
+import unittest
+from unittest import mock
+
+from fastapi import FastAPI, Request
+
+import cache
+import main
+import upstream
+from bench import stub_upstream
+from tests.support import API_KEY, service_client, use_upstream
+
+
+class SessionTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        os.environ["OPENAI_API_KEY"] = API_KEY
+        stub_upstream.LATENCY = 0.01
+        self.sent = []
+        recorder = FastAPI()
+
+        @recorder.post("/v1/chat/completions")
+        async def completions(request: Request):
+            self.sent.append((await request.json())["messages"])
+            return await stub_upstream.completions(request)
+
+        use_upstream(recorder)
+
+    async def asyncTearDown(self):
+        await upstream.close_clients()
+
+    def _turn(self, message: str, **extra) -> dict:
+        return {"user_id": 3, "org_id": 1, "session_id": "tg-42", "message": message, "context": {"t": message}, **extra}
+
+    async def test_history_is_kept_by_the_service(self):
+        async with service_client() as c:
+            await c.delete("/sessions/3/tg-42")
+            r1 = await c.post("/chat", json=self._turn("birinchi"))
+            r2 = await c.post("/chat", json=self._turn("ikkinchi"))
+        self.assertEqual(r2.json()["session_id"], "tg-42")
+        second = self.sent[1]
+        self.assertEqual(second[0]["content"], main.SYSTEM_PROMPT)
+        self.assertEqual(
+            [(m["role"], m["content"]) for m in second[1:-2]],
+            [("user", "birinchi"), ("assistant", r1.json()["answer"])],
+        )
+        # The first request is a prefix of the second, apart from the per-turn context
+        self.assertEqual(self.sent[0][:1], second[:1])
+
+    async def test_concurrent_turns_are_all_kept(self):
+        async with service_client() as c:
+            await c.delete("/sessions/3/tg-42")
+            # Both turns load the empty session before either is answered
+            await asyncio.gather(c.post("/chat", json=self._turn("bir")), c.post("/chat", json=self._turn("ikki")))
+            await c.post("/chat", json=self._turn("uch"))
+        kept = [m["content"] for m in self.sent[-1][1:-2] if m["role"] == "user"]
+        self.assertEqual(sorted(kept), ["bir", "ikki"])
+
+    async def test_redis_update_retries_when_another_writer_got_in_first(self):
+        data = {"ai:session:k": '{"n": 1}'}
+        conflicts = [True]
+
+        class Pipe:
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *exc):
+                return False
+
+            async def watch(self, name):
+                pass
+
+            async def get(self, name):
+                return data.get(name)
+
+            def multi(self):
+                pass
+
+            def set(self, name, raw, ex):
+                self.pending = (name, raw)
+
+            async def execute(self):
+                if conflicts and conflicts.pop():
+                    data["ai:session:k"] = '{"n": 5}'
+                    raise cache.aioredis.WatchError()
+                data[self.pending[0]] = self.pending[1]
+
+        client = mock.Mock(pipeline=lambda transaction: Pipe())
+        value = await cache._RedisStore(client, "ai:session:").update("k", lambda v: {"n": v["n"] + 1}, 60)
+        self.assertEqual(value, {"n": 6})
+        self.assertEqual(data["ai:session:k"], '{"n": 6}')
+
+    async def test_reset_and_seed_from_legacy_history(self):
+        legacy = [{"role": "user", "content": "eski"}, {"role": "assistant", "content": "javob"},
+                  {"role": "user", "content": "yangi"}]
+        async with service_client() as c:
+            await c.post("/chat", json=self._turn("avval"))
+            await c.delete("/sessions/3/tg-42")
+            await c.post("/chat", json=self._turn("yangi", history=legacy))
+        # Seeded from the client history without duplicating the new message
+        self.assertEqual([m["content"] for m in self.sent[-1][1:-2]], ["eski", "javob"])
+
+
+if __name__ == "__main__":
+    unittest.main()
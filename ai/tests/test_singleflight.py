@@ -0,0 +1,69 @@
+import asyncio
+import os
+import unittest
+
+import httpx
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+
+import upstream
+from bench import stub_upstream
+from singleflight import SingleFlight
+from tests.support import API_KEY, service_client, use_upstream
+
+N = 10
+
+
+def _payload() -> dict:
+    return {"user_id": 1, "org_id": 1, "message": "ombor qoldig'i qancha?", "context": {"screen": "inventory"}}
+
+
+class CoalescingTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        os.environ["OPENAI_API_KEY"] = API_KEY
+        stub_upstream.LATENCY = 0.2
+        stub_upstream.CALLS["count"] = 0
+        self.fail_calls = 0
+
+    async def asyncTearDown(self):
+        await upstream.close_clients()
+
+    async def _fire(self) -> list[httpx.Response]:
+        async with service_client() as c:
+            return await asyncio.gather(*(c.post("/chat", json=_payload()) for _ in range(N)))
+
+    async def test_identical_requests_share_one_upstream_call(self):
+        use_upstream(stub_upstream.app)
+        responses = await self._fire()
+        self.assertTrue(all(r.status_code == 200 for r in responses))
+        self.assertEqual(len({r.json()["answer"] for r in responses}), 1)
+        self.assertEqual(stub_upstream.CALLS["count"], 1)
+
+    async def test_upstream_error_reaches_every_waiter(self):
+        broken = FastAPI()
+
+        @broken.post("/v1/chat/completions")
+        async def fail():
+            self.fail_calls += 1
+            await asyncio.sleep(0.2)
+            return JSONResponse({"error": {"message": "boom"}}, status_code=400)
+
+        use_upstream(broken)
+        responses = await self._fire()
+        self.assertTrue(all(r.status_code == 502 for r in responses))
+        self.assertEqual(self.fail_calls, 1)
+
+    async def test_waiters_are_bounded(self):
+        flights = SingleFlight(timeout=0.05)
+
+        async def slow():
+            await asyncio.sleep(1)
+
+        results = await asyncio.gather(*(flights.do("k", slow) for _ in range(3)), return_exceptions=True)
+        self.assertTrue(all(isinstance(r, asyncio.TimeoutError) for r in results))
+        self.assertEqual(flights.calls, 1)
+        self.assertEqual(flights.shared, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import json
+import os
+import unittest
+from unittest import mock
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+import upstream
+from bench import stub_upstream
+from tests.support import API_KEY, service_client, use_upstream
+
+
+def _payload() -> dict:
+    return {"user_id": 1, "org_id": 1, "message": "bugungi savdo", "model": "gpt-4o-mini"}
+
+
+def _frames(body: str) -> list:
+    """(event, data) per SSE frame; event is None for plain data frames."""
+    frames = []
+    for block in body.strip().split("\n\n"):
+        event = None
+        data = None
+        for line in block.splitlines():
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                data = json.loads(line[len("data: "):])
+        frames.append((event, data))
+    return frames
+
+
+class StreamTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        os.environ["OPENAI_API_KEY"] = API_KEY
+        stub_upstream.LATENCY = 0.01
+        stub_upstream.FAULTS.update(fail_rate=0.0)
+
+    async def asyncTearDown(self):
+        await upstream.close_clients()
+
+    async def _stream(self) -> list:
+        async with service_client() as c:
+            r = await c.post("/chat/stream", json=_payload())
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.headers["content-type"].startswith("text/event-stream"))
+        return _frames(r.text)
+
+    async def test_deltas_then_done_with_model_and_usage(self):
+        use_upstream(stub_upstream.app)
+        frames = await self._stream()
+        deltas = [data["delta"] for event, data in frames if event is None]
+        self.assertEqual("".join(deltas), "".join(f"tok{i} " for i in range(stub_upstream.TOKENS)))
+        event, done = frames[-1]
+        self.assertEqual(event, "done")
+        self.assertEqual(done["model"], "gpt-4o-mini")
+        self.assertEqual(done["usage"]["completion_tokens"], stub_upstream.TOKENS)
+
+    async def test_fallback_frames_without_a_key(self):
+        with mock.patch.dict(os.environ):
+            os.environ.pop("OPENAI_API_KEY")
+            os.environ.pop("OPENAI_FOR_CODEX_API_KEY", None)
+            frames = await self._stream()
+        self.assertEqual(len(frames), 2)
+        self.assertIsNone(frames[0][0])
+        self.assertIn("bugungi savdo", frames[0][1]["delta"])
+        self.assertEqual(frames[1], ("done", {"model": None, "usage": None}))
+
+    async def test_upstream_failure_mid_stream_is_an_error_frame(self):
+        broken = FastAPI()
+
+        @broken.post("/v1/chat/completions")
+        async def completions(request: Request):
+            async def chunks():
+                chunk = {"id": "c", "object": "chat.completion.chunk", "created": 0, "model": "m",
+                         "choices": [{"index": 0, "delta": {"content": "yarim"}, "finish_reason": None}]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+                yield f"data: {json.dumps({'error': {'message': 'upstream broke'}})}\n\n"
+
+            return StreamingResponse(chunks(), media_type="text/event-stream")
+
+        use_upstream(broken)
+        frames = await self._stream()
+        self.assertEqual(frames[0], (None, {"delta": "yarim"}))
+        event, error = frames[-1]
+        self.assertEqual(event, "error")
+        self.assertIn("upstream broke", error["detail"])
+        self.assertNotIn("done", [event for event, _ in frames])
+
+
+if __name__ == "__main__":
+    unittest.main()
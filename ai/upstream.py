@@ -0,0 +1,104 @@
+import asyncio
+import hashlib
+import importlib.util
+import os
+from contextlib import asynccontextmanager
+from typing import Any, Dict
+
+import httpx
+
+import metrics
+from resilience import Guard
+
+# The OpenAI SDK takes ~0.5 s to import; it is loaded on the first upstream call
+_sdk_present = importlib.util.find_spec("openai") is not None
+
+# Connection pool / concurrency knobs (per API key)
+MAX_CONNECTIONS = int(os.getenv("AI_MAX_CONNECTIONS", "100"))
+MAX_KEEPALIVE = int(os.getenv("AI_MAX_KEEPALIVE", "20"))
+KEEPALIVE_EXPIRY = float(os.getenv("AI_KEEPALIVE_EXPIRY", "30"))
+MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "32"))
+UPSTREAM_TIMEOUT = float(os.getenv("AI_UPSTREAM_TIMEOUT", "55"))
+
+
+class Upstream:
+    """Pooled client for one API key: concurrency cap plus the resilience guard."""
+
+    def __init__(self, client, key_id: str = ""):
+        self.client = client
+        self.limit = asyncio.Semaphore(MAX_CONCURRENCY)
+        self.guard = Guard(key_id)
+
+    async def create(self, tokens: int, **kwargs) -> Any:
+        """chat.completions.create with rate limiting, retries and the circuit breaker.
+
+        `tokens` is the estimated prompt size for the tokens-per-minute bucket. With
+        stream=True the returned stream is open once the upstream answered with headers.
+        """
+        async def attempt():
+            async with self.limit:
+                with metrics.UPSTREAM_INFLIGHT.track_inprogress():
+                    return await self.client.chat.completions.with_raw_response.create(**kwargs)
+
+        raw = await self.guard.call(attempt, tokens)
+        return raw.parse()
+
+    @asynccontextmanager
+    async def stream(self, tokens: int, **kwargs):
+        """Streaming variant; the concurrency slot is held until the stream is consumed."""
+        async with self.limit:
+            with metrics.UPSTREAM_INFLIGHT.track_inprogress():
+                raw = await self.guard.call(
+                    lambda: self.client.chat.completions.with_raw_response.create(stream=True, **kwargs), tokens
+                )
+                stream = raw.parse()
+                try:
+                    yield stream
+                finally:
+                    await stream.close()
+
+    async def close(self) -> None:
+        await self.client.close()
+
+
+# api_key -> Upstream; one long-lived client per key
+_clients: Dict[str, Upstream] = {}
+
+
+def available() -> bool:
+    return _sdk_present
+
+
+def get_client(api_key: str) -> Upstream:
+    entry = _clients.get(api_key)
+    if entry is None:
+        from openai import AsyncOpenAI
+
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_KEEPALIVE,
+                keepalive_expiry=KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(UPSTREAM_TIMEOUT, connect=5.0),
+            event_hooks={
+                "request": [metrics.on_upstream_request],
+                "response": [metrics.on_upstream_response],
+            },
+        )
+        # Retries are handled by the guard under a shared retry budget
+        client = AsyncOpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+        entry = Upstream(client, hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12])
+        _clients[api_key] = entry
+    return entry
+
+
+def stats() -> Dict[str, Any]:
+    # Index rather than key, so /health never exposes API keys
+    return {f"client_{i}": u.guard.stats() for i, u in enumerate(_clients.values())}
+
+
+async def close_clients() -> None:
+    for entry in list(_clients.values()):
+        await entry.close()
+    _clients.clear()
@@ -0,0 +1,96 @@
+<?php
+
+namespace App\Jobs;
+
+use App\Services\Handler\Codex\CodexHandler;
+use App\Services\TgBot\TgBot;
+use Illuminate\Bus\Queueable;
+use Illuminate\Contracts\Queue\ShouldQueue;
+use Illuminate\Foundation\Bus\Dispatchable;
+use Illuminate\Queue\InteractsWithQueue;
+use Illuminate\Queue\SerializesModels;
+use Illuminate\Support\Facades\Http;
+
+/**
+ * Follows a Codex job (GET /jobs/{id} long poll) and reports the outcome in the chat.
+ */
+class PollCodexJob implements ShouldQueue
+{
+    use Dispatchable, InteractsWithQueue, Queueable, SerializesModels;
+
+    public int $tries = 1;
+    public int $timeout = 900;
+
+    protected const DEADLINE = 840;
+
+    public function __construct(
+        public int|string $chatId,
+        public ?int $messageId,
+        public string $jobId,
+        public string $kind,
+    ) {}
+
+    public function handle(TgBot $tgBot): void
+    {
+        $url = rtrim(config('services.codex.url', 'http://codex:8090'), '/') . '/jobs/' . $this->jobId;
+        $secret = (string) config('services.codex.secret');
+        $deadline = time() + self::DEADLINE;
+        $job = ['state' => 'queued'];
+
+        while (!in_array($job['state'] ?? '', ['succeeded', 'failed', 'dead'], true) && time() < $deadline) {
+            try {
+                // The server holds the request until the state changes (up to 25 s)
+                $resp = Http::withHeaders(['X-Codex-Token' => $secret])
+                    ->timeout(30)
+                    ->get($url, ['wait' => 25, 'state' => $job['state']]);
+            } catch (\Throwable $e) {
+                sleep(2);
+                continue;
+            }
+            if ($resp->status() === 404) {
+                $job = ['state' => 'failed', 'error' => 'job not found'];
+            } elseif ($resp->successful()) {
+                $job = $resp->json();
+            } else {
+                sleep(2);
+            }
+        }
+
+        $tgBot->chatId = $this->chatId;
+        $this->report($tgBot, $this->message($job));
+    }
+
+    private function message(array $job): array
+    {
+        $state = $job['state'] ?? '';
+        $error = (string) ($job['error'] ?? '');
+        if ($this->kind === 'propose') {
+            return match ($state) {
+                'succeeded' => CodexHandler::proposalMessage($job['result'] ?? []),
+                'failed', 'dead' => ['text' => 'Propose muvaffaqiyatsiz: ' . $error],
+                default => ['text' => "⏳ Codex hali ishlayapti (job {$this->jobId})."],
+            };
+        }
+        return match ($state) {
+            'succeeded' => ['text' => "✅ O'zgarishlar qo'llandi."],
+            'failed', 'dead' => ['text' => "❌ Qo'llash muvaffaqiyatsiz: " . $error],
+            default => ['text' => "⏳ Codex hali ishlayapti (job {$this->jobId})."],
+        };
+    }
+
+    private function report(TgBot $tgBot, array $params): void
+    {
+        if ($this->messageId) {
+            try {
+                $tgBot->sendRequest('editMessageText', $params + [
+                    'chat_id' => $this->chatId,
+                    'message_id' => $this->messageId,
+                ]);
+                return;
+            } catch (\Throwable $e) {
+                // fall through to a new message
+            }
+        }
+        $tgBot->answerMsg($params);
+    }
+}
@@ -5,12 +5,25 @@
 use App\Models\User;
 use Illuminate\Support\Arr;
 use Illuminate\Support\Facades\Http;
+use Illuminate\Support\Str;
 
 class AiService
 {
-    public function chat(User $user, string $message, array $history = [], array $context = []): string
+    /**
+     * With $sessionId the AI service keeps the conversation and only the new message is sent;
+     * $history then only seeds a session the service does not know yet. $stored is set once the
+     * service confirms it saved the turn under $sessionId.
+     */
+    public function chat(
+        User $user,
+        string $message,
+        array $history = [],
+        array $context = [],
+        ?string $sessionId = null,
+        ?bool &$stored = null
+    ): string
     {
-        $url = rtrim(config('services.ai.url', env('AI_SERVICE_URL', 'http://ai:8000')), '/').'/chat';
+        $url = $this->baseUrl().'/chat';
 
         $payload = [
             'user_id' => $user->id,
@@ -21,13 +34,34 @@ public function chat(User $user, string $message, array $history = [], array $co
             // Default to gpt-4o for stronger reasoning/advice unless overridden in .env
             'model' => env('OPENAI_MODEL', 'gpt-4o'),
         ];
+        if ($sessionId !== null) {
+            $payload['session_id'] = $sessionId;
+        }
 
-        $resp = Http::timeout(60)->post($url, $payload);
+        // Correlates the AI service's timing logs with this call
+        $resp = Http::withHeaders(['X-Request-Id' => (string) Str::uuid()])
+            ->timeout(60)
+            ->post($url, $payload);
         if (!$resp->successful()) {
             return 'AI service is unavailable right now.';
         }
 
         $data = $resp->json();
+        $stored = $sessionId !== null && Arr::get($data, 'session_id') === $sessionId;
         return (string) Arr::get($data, 'answer', 'No answer.');
     }
+
+    public function resetSession(User $user, string $sessionId): void
+    {
+        try {
+            Http::timeout(5)->delete($this->baseUrl().'/sessions/'.$user->id.'/'.rawurlencode($sessionId));
+        } catch (\Throwable $e) {
+            // The session expires on its own
+        }
+    }
+
+    private function baseUrl(): string
+    {
+        return rtrim(config('services.ai.url', env('AI_SERVICE_URL', 'http://ai:8000')), '/');
+    }
 }
@@ -22,6 +22,7 @@ public function handleText(string $text): void
     {
         if (in_array($text, ['/reset', '/cancel'])) {
             $this->forgetCache(self::HISTORY_KEY);
+            app(AiService::class)->resetSession($this->user, $this->sessionId());
             $this->tgBot->answerMsg(['text' => 'Suhbat tozalandi. Yangi savol yuboring.']);
             return;
         }
@@ -44,12 +45,8 @@ public function handleText(string $text): void
             $this->setCache('edit_msg_id', $editMsgId);
         }
 
-        // Build history
+        // The AI service keeps the conversation; the cached history seeds it and covers turns it did not store
         $history = $this->getCacheArray(self::HISTORY_KEY) ?? [];
-        $history[] = ['role' => 'user', 'content' => $text];
-
-        // Keep last 20 messages
-        $history = array_slice($history, -20);
 
         /** @var AiContextService $ctx */
         $ctx = app(AiContextService::class);
@@ -57,10 +54,20 @@ public function handleText(string $text): void
 
         /** @var AiService $ai */
         $ai = app(AiService::class);
-        $answer = $ai->chat($this->user, $text, $history, $context);
+        $answer = $ai->chat($this->user, $text, $history, $context, $this->sessionId(), $stored);
+
+        // Until the service confirms it stored the turn, the cached history is the only copy
+        if ($stored) {
+            if ($history) {
+                $this->forgetCache(self::HISTORY_KEY);
+            }
+        } else {
+            $history[] = ['role' => 'user', 'content' => $text];
+            $history[] = ['role' => 'assistant', 'content' => $answer];
 
-        $history[] = ['role' => 'assistant', 'content' => $answer];
-        $this->setCacheArray(self::HISTORY_KEY, $history);
+            // Keep last 20 messages
+            $this->setCacheArray(self::HISTORY_KEY, array_slice($history, -20));
+        }
 
         // Escape HTML to avoid invalid tags in Telegram HTML mode
         $safeAnswer = htmlspecialchars($answer, ENT_QUOTES | ENT_SUBSTITUTE, 'UTF-8');
@@ -107,6 +114,11 @@ public function getMainKb(): array
         ];
     }
 
+    private function sessionId(): string
+    {
+        return 'tg-'.$this->tgBot->chatId;
+    }
+
     private function chunkTelegram(string $text): array
     {
         // Telegram limit ~4096 chars.
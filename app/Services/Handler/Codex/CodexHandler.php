@@ -2,6 +2,7 @@
 
 namespace App\Services\Handler\Codex;
 
+use App\Jobs\PollCodexJob;
 use App\Services\Handler\BaseHandler;
 use Illuminate\Support\Arr;
 
@@ -58,53 +59,33 @@ private function proposeAndAsk(string $text): void
 
             $placeholder = $this->tgBot->answerMsg(['text' => "🧠 O'ylayapman..."], false);
             $editMsgId = Arr::get($placeholder, 'result.message_id');
+            // Codex answers at once with a job; quick proposals come back within `wait` seconds
             $resp = \Illuminate\Support\Facades\Http::withHeaders([
                 'X-Codex-Token' => (string) $secret,
             ])->timeout(20)->post($url, [
                 'prompt' => $text,
+                'wait' => 15,
             ]);
-            if ((int) $resp->status() !== 200) {
+            $status = (int) $resp->status();
+            if ($status === 202) {
+                PollCodexJob::dispatch($this->tgBot->chatId, $editMsgId, (string) $resp->json('job_id'), 'propose');
+                return;
+            }
+            if ($status !== 200) {
+                $error = 'Propose muvaffaqiyatsiz (HTTP ' . $status . ').';
                 if ($editMsgId) {
                     $this->tgBot->sendRequest('editMessageText', [
                         'chat_id' => $this->tgBot->chatId,
                         'message_id' => $editMsgId,
-                        'text' => 'Propose muvaffaqiyatsiz (HTTP ' . $resp->status() . ').',
+                        'text' => $error,
                     ]);
                 } else {
-                    $this->tgBot->answerMsg(['text' => 'Propose muvaffaqiyatsiz (HTTP ' . $resp->status() . ').']);
+                    $this->tgBot->answerMsg(['text' => $error]);
                 }
                 return;
             }
-            $meta = $resp->json();
-            $files = $meta['files'] ?? [];
-            $title = $meta['title'] ?? 'Taklif';
-            $summary = $meta['summary'] ?? '';
-            $id = $meta['id'] ?? '';
-
-            $list = '';
-            foreach (array_slice($files, 0, 10) as $f) {
-                $list .= "\n• " . $f;
-            }
-            if (count($files) > 10) {
-                $list .= "\n… va yana " . (count($files) - 10) . " ta fayl";
-            }
-
-            $textOut = "<b>" . htmlspecialchars($title) . "</b>\n" .
-                htmlspecialchars($summary) . "\n\n<b>Fayllar:</b>" . htmlspecialchars($list);
 
-            $params = [
-                'chat_id' => $this->tgBot->chatId,
-                'text' => $textOut,
-                'parse_mode' => 'HTML',
-                'reply_markup' => [
-                    'inline_keyboard' => [
-                        [
-                            ['text' => '✅ Tasdiqlash', 'callback_data' => 'codex_apply:' . $id],
-                            ['text' => '❌ Bekor', 'callback_data' => 'codex_cancel'],
-                        ],
-                    ],
-                ],
-            ];
+            $params = self::proposalMessage($resp->json()) + ['chat_id' => $this->tgBot->chatId];
             if ($editMsgId) {
                 $params['message_id'] = $editMsgId;
                 $this->tgBot->sendRequest('editMessageText', $params);
@@ -128,6 +109,12 @@ private function dispatchApply(string $id): void
             ]);
             if ((int) $resp->status() === 202) {
                 $this->tgBot->answerMsg(['text' => '✅ Tasdiq qabul qilindi. Codex o\'zgarishlarni qo\'llamoqda.']);
+                if ($jobId = $resp->json('job_id')) {
+                    PollCodexJob::dispatch($this->tgBot->chatId, null, (string) $jobId, 'apply');
+                }
+            } elseif ((int) $resp->status() === 200 && $resp->json('state') === 'succeeded') {
+                // Codex applies a proposal once; a repeated tap gets the earlier job back
+                $this->tgBot->answerMsg(['text' => '✅ Bu o\'zgarishlar allaqachon qo\'llangan.']);
             } else {
                 $this->tgBot->answerMsg(['text' => 'Qo\'llash muvaffaqiyatsiz (HTTP ' . $resp->status() . ').']);
             }
@@ -136,6 +123,39 @@ private function dispatchApply(string $id): void
         }
     }
 
+    /**
+     * Telegram message (text + approve/cancel buttons) for a proposal's meta: id, title, summary, files.
+     */
+    public static function proposalMessage(array $meta): array
+    {
+        $files = $meta['files'] ?? [];
+        $title = $meta['title'] ?? 'Taklif';
+        $summary = $meta['summary'] ?? '';
+        $id = $meta['id'] ?? '';
+
+        $list = '';
+        foreach (array_slice($files, 0, 10) as $f) {
+            $list .= "\n• " . $f;
+        }
+        if (count($files) > 10) {
+            $list .= "\n… va yana " . (count($files) - 10) . " ta fayl";
+        }
+
+        return [
+            'text' => "<b>" . htmlspecialchars($title) . "</b>\n" .
+                htmlspecialchars($summary) . "\n\n<b>Fayllar:</b>" . htmlspecialchars($list),
+            'parse_mode' => 'HTML',
+            'reply_markup' => [
+                'inline_keyboard' => [
+                    [
+                        ['text' => '✅ Tasdiqlash', 'callback_data' => 'codex_apply:' . $id],
+                        ['text' => '❌ Bekor', 'callback_data' => 'codex_cancel'],
+                    ],
+                ],
+            ],
+        ];
+    }
+
     public function getMainKb(): array
     {
         return [
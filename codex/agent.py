@@ -1,33 +1,80 @@
 from __future__ import annotations
 import os
+import re
 import json
 import time
-import glob
+import shlex
 import shutil
+import sqlite3
+import threading
 import typer
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import replace
 from datetime import datetime
 from rich import print as rprint
+from rich.markup import escape
 from pathlib import Path
 from typing import Optional
 
 from .config import CodexConfig
-from .executor import run
+from .jobs import JobRunner, JobStore, annotate, count, default_path, in_job, log, span, traced
+from .executor import CANCELLED, TIMEOUT, cancellable, run
 from .git_utils import (
     current_sha, current_branch, create_branch, add_all, commit, push,
-    tag, hard_reset, revert_last, has_changes
+    tag, hard_reset, revert_last, has_changes, fast_forward, cherry_pick, common_root, tree_sha, changed_paths,
+    diff_paths
 )
 from .ai_client import propose
+from .impact import build as impact_map
+from .repo_index import index_for
+from . import patches, precheck, shards
+from .deploy import healthy, plan as deploy_plan
+from .testcache import cache_for, result_key
+from .worktree import workspaces
 
 
 app = typer.Typer(add_help_option=True, no_args_is_help=True)
 
+# Lines of a command's stdout and of its stderr held in memory; the job's log has everything
+OUTPUT_LINES = int(os.environ.get("CODEX_OUTPUT_LINES", "2000"))
+
+# AI candidates validated side by side per attempt of a nudge or proposal apply; 1 is the one-at-a-time flow
+CANDIDATES = int(os.environ.get("CODEX_CANDIDATES", "1"))
+# Added to the prompt of candidate n; the AI service runs at a fixed temperature and caches by prompt,
+# so different candidates need different prompts
+VARIANTS = (
+    "",
+    "\nKeep the change as small as possible.",
+    "\nPrefer a different approach than the most obvious one.",
+    "\nTouch as few files as possible and keep behaviour elsewhere unchanged.",
+)
+# Parsed configs by path with the (mtime, size, AI_SERVICE_URL) they were parsed at
+_configs: dict = {}
+_configs_lock = threading.Lock()
+# tests.shards.setup commands that succeeded in this process, by (main checkout, shard, command)
+_shards_ready: set = set()
+
 
 def load_config(path: str | None) -> CodexConfig:
+    """The config at `path`, parsed again only when the file (or AI_SERVICE_URL) has changed.
+
+    Every job and server request asks for it, so the result is shared; treat it as read-only
+    (`dataclasses.replace` for a variant).
+    """
     cfg_path = path or os.environ.get("CODEX_CONFIG", "codex/config.yml")
     if not os.path.exists(cfg_path):
         # fallback to example if not present
         cfg_path = "codex/config.example.yml"
-    return CodexConfig.load(cfg_path)
+    st = os.stat(cfg_path)
+    stamp = (st.st_mtime_ns, st.st_size, os.getenv("AI_SERVICE_URL"))
+    with _configs_lock:
+        cached = _configs.get(cfg_path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    cfg = CodexConfig.load(cfg_path)
+    with _configs_lock:
+        _configs[cfg_path] = (stamp, cfg)
+    return cfg
 
 
 def save_last_good(repo: str, sha: str) -> None:
@@ -39,243 +86,596 @@ def read_last_good(repo: str) -> str:
     return p.read_text(encoding="utf-8").strip() if p.exists() else ""
 
 
-def run_cmd(cmd: list[str], cwd: str) -> tuple[int, str, str]:
-    return run(cmd, cwd=cwd, timeout=3600)
+def _watch(stop_on: Optional[str], echo: bool):
+    """An output callback for executor.run: logs each line to the job, prints it with `echo`, and stops
+    the command at the first line matching the `stop_on` regex.
+    """
+    pattern = re.compile(stop_on) if stop_on else None
+
+    def on_line(line: str) -> bool:
+        log(line)
+        if echo:
+            print(line, end="", flush=True)
+        if pattern is not None and pattern.search(line):
+            count("early_stops")
+            rprint(f"[red]Stopped at:[/red] {escape(line.strip())}")
+            return True
+        return False
+    return on_line
+
+
+def _fill_paths(text: str, checkout: str) -> str:
+    """Fill "{repo}" (the checkout a command runs in: a job's worktree or the main repo) and "{root}"
+    (the main repo) into a command. Both are absolute, so a container can mount them.
+    """
+    if "{root}" in text:
+        text = text.replace("{root}", common_root(checkout))
+    return text.replace("{repo}", os.path.abspath(checkout))
+
+
+def run_cmd(cmd: list[str], cwd: str, echo: bool = False, stop_on: Optional[str] = None) -> tuple[int, str, str]:
+    """Run a stage command; only the last OUTPUT_LINES lines of each stream are kept, all of it is logged."""
+    cmd = [_fill_paths(part, cwd) for part in cmd]
+    with span("exec", cmd=shlex.join(cmd)[:300]) as record:
+        code, out, err = run(cmd, cwd=cwd, timeout=3600, on_line=_watch(stop_on, echo), keep=OUTPUT_LINES)
+        record["exit"] = code
+    return code, out, err
+
+
+def _test_fingerprint(cfg: CodexConfig) -> Optional[str]:
+    """What a test result depends on besides the tree: env vars in tests.cache_env and tests.fingerprint's output."""
+    parts = [f"{name}={os.environ.get(name, '')}" for name in cfg.tests.get("cache_env") or []]
+    probe = cfg.tests.get("fingerprint")
+    if probe:
+        code, out, _ = run_cmd(probe, cfg.repo_root)
+        if code != 0:
+            return None
+        parts.append(out.strip())
+    return "\n".join(parts)
+
 
+@traced("test_suite")
+def test_suite(cfg: CodexConfig, command: Optional[list[str]] = None) -> bool:
+    """Run the tests, or reuse the result for a tree already tested with the same command and environment.
 
-def test_suite(cfg: CodexConfig) -> bool:
+    `command` defaults to tests.command, the full suite.
+    """
     if not cfg.tests or not cfg.tests.get("command"):
         return True
-    code, out, err = run_cmd(cfg.tests["command"], cfg.repo_root)
-    rprint(out)
+    command = command or cfg.tests["command"]
+    cache, key, tree = None, "", ""
+    if cfg.tests.get("cache", True) and os.environ.get("CODEX_TEST_CACHE", "1") != "0":
+        tree = tree_sha(cfg.repo_root)
+        fingerprint = _test_fingerprint(cfg)
+        if tree and fingerprint is not None:
+            cache, key = cache_for(common_root(cfg.repo_root)), result_key(tree, command, fingerprint)
+    hit = cache.get(key) if cache else None
+    annotate(cache="hit" if hit else "miss" if cache else "off")
+    if hit:
+        count("test_cache_hits")
+        count("test_seconds_saved", hit["duration"])
+        outcome = "passed" if hit["passed"] else "failed"
+        rprint(f"[cyan]Tests {outcome} for tree {tree[:12]} (cached, {hit['duration']:.1f}s saved)[/cyan]")
+        if not hit["passed"]:
+            rprint(hit["output"])
+        return hit["passed"]
+
+    started = time.monotonic()
+    sharded = command == cfg.tests["command"] and int((cfg.tests.get("shards") or {}).get("count", 0)) > 1
+    code, out, err = sharded_suite(cfg) if sharded else \
+        run_cmd(command, cfg.repo_root, echo=True, stop_on=cfg.tests.get("stop_on"))
+    duration = time.monotonic() - started
+    count("test_runs")
+    count("test_seconds", duration)
+    # A timeout says more about the machine than the tree, a cancelled run nothing at all
+    if cache and code not in (TIMEOUT, CANCELLED):
+        count("test_cache_misses")
+        cache.put(key, tree, code == 0, duration, out + err)
     if code != 0:
-        rprint(f"[red]Tests failed[/red]\n{err}")
+        rprint("[red]Tests failed[/red]")
         return False
     return True
 
 
-def deploy(cfg: CodexConfig) -> bool:
+@traced("test_shards")
+def sharded_suite(cfg: CodexConfig) -> tuple[int, str, str]:
+    """The full suite split over tests.shards.count concurrent commands; the first failure cancels the rest.
+
+    Shards are balanced by the per-file durations of earlier runs, read back
+    from the JUnit report each shard writes to "{junit}". tests.shards.setup
+    (e.g. creating the shard's database) runs once per shard and process first.
+    """
+    spec = cfg.tests["shards"]
+    root = common_root(cfg.repo_root)
+    tests = shards.test_files(cfg.repo_root)
+    if not tests:
+        return run_cmd(cfg.tests["command"], cfg.repo_root, echo=True, stop_on=cfg.tests.get("stop_on"))
+    groups = shards.split(tests, shards.load_durations(root), int(spec["count"]))
+    junit_dir = Path(cfg.repo_root) / shards.JUNIT_DIR
+    shutil.rmtree(junit_dir, ignore_errors=True)
+    junit_dir.mkdir(parents=True)
+    commands, envs, reports, setups = [], [], [], []
+    for i, group in enumerate(groups, 1):
+        report = f"{shards.JUNIT_DIR}/shard-{i}.xml"
+
+        def fill(text: str) -> str:
+            return _fill_paths(text.replace("{shard}", str(i)).replace("{junit}", report), cfg.repo_root)
+
+        if spec.get("setup"):
+            setup = [fill(part) for part in spec["setup"]]
+            setups.append(((root, i, tuple(setup)), setup))
+        commands.append([fill(part) for part in _expand_tests(spec["command"], group)])
+        envs.append({name: fill(str(value)) for name, value in (spec.get("env") or {}).items()})
+        reports.append(str(Path(cfg.repo_root) / report))
+    for key, setup in setups:
+        if key in _shards_ready:
+            continue
+        code, out, err = run_cmd(setup, cfg.repo_root, echo=True)
+        if code != 0:
+            rprint(f"[red]Setup of shard {key[1]} failed[/red]")
+            return code, out, err
+        _shards_ready.add(key)
+    rprint(f"[cyan]Running {len(tests)} test files in {len(groups)} shards...[/cyan]")
+    started = time.monotonic()
+    code, out = shards.run_all(commands, cfg.repo_root, envs, timeout=3600,
+                               on_line=_watch(cfg.tests.get("stop_on"), echo=False))
+    elapsed = time.monotonic() - started
+
+    totals = {"tests": 0, "failures": 0, "errors": 0, "skipped": 0}
+    times: dict[str, float] = {}
+    for report, group in zip(reports, groups):
+        counts, seconds = shards.read_junit(report, group)
+        for name, value in counts.items():
+            totals[name] += value
+        times.update(seconds)
+    if not code:
+        shards.record_durations(root, times)
+        # A shard that exits 0 with failures in its report still fails the run
+        if totals["failures"] or totals["errors"]:
+            code = 1
+    count("test_shards", len(groups))
+    summary = (f"{len(groups)} shards: {totals['tests']} tests, {totals['failures']} failures, "
+               f"{totals['errors']} errors, {totals['skipped']} skipped in {elapsed:.1f}s")
+    if times:
+        summary += f" (serial {sum(times.values()):.1f}s)"
+    rprint(f"[cyan]{summary}[/cyan]" if not code else f"[red]{summary}[/red]")
+    return code, out, "" if not code else summary
+
+
+def _expand_tests(command: list[str], tests: list[str]) -> list[str]:
+    """Fill "{tests}" (the test files) and "{filter}" (a --filter regex of their classes) into a command."""
+    names = "|".join(Path(t).stem for t in tests)
+    out: list[str] = []
+    for part in command:
+        if part == "{tests}":
+            out += tests
+        else:
+            out.append(part.replace("{tests}", " ".join(shlex.quote(t) for t in tests)).replace("{filter}", f"({names})"))
+    return out
+
+
+@traced("impacted_tests")
+def impacted_tests(cfg: CodexConfig) -> Optional[bool]:
+    """Run only the tests affected by the checkout's uncommitted changes.
+
+    Returns None when there is no such stage: no tests.impacted_command, no
+    changes, a change the map cannot place (config, migrations, ...), or
+    no test reaching the changed code.
+    """
+    command = (cfg.tests or {}).get("impacted_command")
+    changed = changed_paths(cfg.repo_root) if command else []
+    if not changed:
+        return None
+    tests = impact_map(common_root(cfg.repo_root), cfg.repo_root, cfg.tests.get("coverage_map")).impacted(changed)
+    if not tests:
+        return None
+    rprint(f"[cyan]Running {len(tests)} impacted test file(s) first...[/cyan]")
+    count("impacted_test_files", len(tests))
+    return test_suite(cfg, _expand_tests(command, tests))
+
+
+@traced("prompt_context")
+def prompt_context(cfg: CodexConfig, sha: str, query: str) -> dict:
+    """Context for an AI request: the base commit plus the code in cfg.repo_root most relevant to `query`."""
+    context: dict = {"last_sha": sha}
+    if os.environ.get("CODEX_CONTEXT", "1") == "0":
+        return context
+    try:
+        snippets = index_for(common_root(cfg.repo_root)).search(cfg.repo_root, query)
+    except (OSError, sqlite3.Error) as e:
+        rprint(f"[yellow]Repository index unavailable: {e}[/yellow]")
+        return context
+    if snippets:
+        context["snippets"] = snippets
+    return context
+
+
+def _first_try(applied: bool) -> bool:
+    """Record whether the AI's diffs applied as returned, before any fix round."""
+    count("first_try_applied" if applied else "first_try_rejected")
+    return applied
+
+
+@traced("precheck")
+def prechecks(cfg: CodexConfig) -> list[str]:
+    """Problems the cheap checks (config.yml `precheck`) find in the checkout's changed files."""
+    if not cfg.precheck:
+        return []
+    started = time.monotonic()
+    errors = precheck.run(cfg.repo_root, cfg.precheck, changed_paths(cfg.repo_root),
+                          lambda cmd: run_cmd(cmd, cfg.repo_root),
+                          cache_for(common_root(cfg.repo_root), "precheck_cache.db"))
+    count("precheck_seconds", time.monotonic() - started)
+    annotate(errors=len(errors))
+    if errors:
+        count("precheck_failures")
+        rprint("[red]Pre-checks failed:[/red]\n" + "\n".join(f"  {e}" for e in errors))
+    return errors
+
+
+def check(cfg: CodexConfig) -> bool:
+    """Impacted tests first to fail fast, then the full suite as the gate."""
+    if impacted_tests(cfg) is False:
+        return False
+    return test_suite(cfg)
+
+
+@traced("deploy")
+def deploy(cfg: CodexConfig, since: str = "") -> Optional[bool]:
+    """Bring the services up to date with the checkout; None when the changes since `since` need nothing.
+
+    With deploy.rules, only the services the changed paths need are rebuilt ("{services}" in
+    deploy.command) or restarted (deploy.restart_command). Without rules or `since`, deploy.command
+    runs for all of restart_services.
+    """
     if not cfg.deploy or not cfg.deploy.get("command"):
         return True
-    code, out, err = run_cmd(cfg.deploy["command"], cfg.repo_root)
-    rprint(out)
-    if code != 0:
-        rprint(f"[red]Deploy failed[/red]\n{err}")
-        return False
+    rules, restart_command = cfg.deploy.get("rules"), cfg.deploy.get("restart_command")
+    paths = diff_paths(cfg.repo_root, since) if rules is not None and since else None
+    build, restart = list(cfg.restart_services), []
+    if paths is not None:
+        build, restart = deploy_plan(paths, rules, cfg.restart_services)
+        if not restart_command:
+            build, restart = build + restart, []
+        if not build and not restart:
+            rprint(f"[cyan]No runtime files changed since {since[:12]}; skipping deploy.[/cyan]")
+            count("deploys_skipped")
+            annotate(skipped=True)
+            return None
+    annotate(build=build, restart=restart)
+    started = time.monotonic()
+    steps = [(cfg.deploy["command"], build)] if build or paths is None else []
+    steps += [(restart_command, restart)] if restart else []
+    for command, services in steps:
+        rprint(f"[cyan]Deploying {' '.join(services) or 'all services'}...[/cyan]")
+        command = [part.replace("{services}", " ".join(services)) for part in command]
+        code, _, _ = run_cmd(command, cfg.repo_root, echo=True, stop_on=cfg.deploy.get("stop_on"))
+        if code != 0:
+            rprint("[red]Deploy failed[/red]")
+            return False
+    count("deploy_seconds", time.monotonic() - started)
     return True
 
 
+@traced("health_check")
 def health_check(cfg: CodexConfig) -> bool:
-    url = (cfg.health or {}).get("url")
-    if not url:
+    """All of health.urls (and health.url) answering below 500, probed at once with backing-off retries."""
+    health = cfg.health or {}
+    urls = list(health.get("urls") or []) + ([health["url"]] if health.get("url") else [])
+    if not urls:
         return True
     try:
         import requests
-        retries = int((cfg.health or {}).get("retries", 10))
-        timeout = int((cfg.health or {}).get("timeout", 5))
-        for _ in range(retries):
-            try:
-                r = requests.get(url, timeout=timeout)
-                if r.status_code < 500:
-                    return True
-            except Exception:
-                pass
-            time.sleep(2)
-        return False
-    except Exception:
+    except ImportError:
         return True
+    started = time.monotonic()
+    ok = healthy(urls, requests.get, float(health.get("timeout", 5)), int(health.get("retries", 16)),
+                 float(health.get("backoff", 0.25)), float(health.get("max_backoff", 2)))
+    count("health_seconds", time.monotonic() - started)
+    return ok
 
 
+@traced("apply_diffs")
 def apply_diffs(cfg: CodexConfig, diffs: list[dict]) -> bool:
-    # Prefer git apply for safety
-    import fnmatch
-    for d in diffs:
-        diff_text = d.get("unified_diff", "").strip()
-        if not diff_text:
-            continue
-        path = (d.get("path") or "").strip()
-        # Protect critical files
-        for pat in cfg.protected_paths or []:
-            if fnmatch.fnmatch(path, pat):
-                rprint(f"[yellow]Skipping protected path: {path}[/yellow]")
-                return False
-        # Enforce allow-list if provided
-        if cfg.allow_paths:
-            if not any(fnmatch.fnmatch(path, pat) for pat in cfg.allow_paths):
-                rprint(f"[yellow]Skipping not-allowed path: {path}[/yellow]")
-                return False
-        tmp = Path(cfg.repo_root) / "codex" / ".tmp.patch"
-        tmp.write_text(diff_text, encoding="utf-8")
-        code, out, err = run_cmd(["bash","-lc", f"git apply --whitespace=fix {tmp}"], cfg.repo_root)
-        if code != 0:
-            rprint(f"[yellow]Could not apply a diff for {d.get('path')}[/yellow]\n{err}")
-            return False
+    """Apply all diffs or none; see patches.apply."""
+    errors = patches.apply(cfg.repo_root, diffs, cfg.protected_paths or [], cfg.allow_paths or [])
+    if errors:
+        rprint("[yellow]Diffs not applied:[/yellow]\n" + "\n".join(f"  {e}" for e in errors))
+        return False
     return True
 
 
 @app.command()
 def once(config: Optional[str] = typer.Option(None, help="Path to config.yml")):
     cfg = load_config(config)
-    repo = cfg.repo_root
-    start_sha = current_sha(repo)
+    start_sha = current_sha(cfg.repo_root)
     rprint(f"Start SHA: [bold]{start_sha}[/bold]")
 
-    rprint("[cyan]Running tests...[/cyan]")
-    if not test_suite(cfg):
-        # Ask AI to fix failing tests
-        prompt = "Repo tests failed. Provide minimal safe patch as unified diff to fix failures."
-        context = {"last_sha": start_sha}
-        suggestion = propose(cfg.ai_url, prompt, context)
-        if not apply_diffs(cfg, suggestion.get("diffs", [])):
-            raise SystemExit(1)
-        if not test_suite(cfg):
-            raise SystemExit(1)
-        rprint("[green]Tests fixed by AI.[/green]")
-    else:
-        # Optionally propose safe improvements even when green
-        if getattr(cfg, "improve_when_green", True):
-            rprint("[cyan]Tests green. Proposing safe improvements...[/cyan]")
-            prompt = (
-                "Tests pass. Propose small, safe improvements (performance, readability, minor bugs) "
-                "as minimal unified diffs. Do not change behavior."
-            )
-            context = {"last_sha": start_sha}
+    suggestion = None
+    with workspaces(cfg.repo_root).checkout(start_sha) as path:
+        wt = replace(cfg, repo_root=path)
+        rprint("[cyan]Running tests...[/cyan]")
+        if not test_suite(wt):
+            # Ask AI to fix failing tests
+            prompt = "Repo tests failed. Provide minimal safe patch as unified diff to fix failures."
+            context = prompt_context(wt, start_sha, prompt)
             suggestion = propose(cfg.ai_url, prompt, context)
-            diffs = suggestion.get("diffs", [])
-            if diffs:
-                if not apply_diffs(cfg, diffs):
-                    rprint("[yellow]No improvements applied.[/yellow]")
-                else:
-                    # Re-run tests after applying improvements
-                    if not test_suite(cfg):
-                        rprint("[red]Improvements broke tests, reverting...[/red]")
-                        hard_reset(repo, start_sha)
+            if not _first_try(apply_diffs(wt, suggestion.get("diffs", []))):
+                raise SystemExit(1)
+            if prechecks(wt) or not check(wt):
+                raise SystemExit(1)
+            rprint("[green]Tests fixed by AI.[/green]")
+        else:
+            # Optionally propose safe improvements even when green
+            if getattr(cfg, "improve_when_green", True):
+                rprint("[cyan]Tests green. Proposing safe improvements...[/cyan]")
+                prompt = (
+                    "Tests pass. Propose small, safe improvements (performance, readability, minor bugs) "
+                    "as minimal unified diffs. Do not change behavior."
+                )
+                context = prompt_context(wt, start_sha, prompt)
+                suggestion = propose(cfg.ai_url, prompt, context)
+                diffs = suggestion.get("diffs", [])
+                if diffs:
+                    if not _first_try(apply_diffs(wt, diffs)):
+                        rprint("[yellow]No improvements applied.[/yellow]")
                     else:
-                        rprint("[green]Improvements validated by tests.[/green]")
-
-    # Optional lint step (placeholder)
-    if cfg.lint and cfg.lint.get("command"):
-        code, out, err = run_cmd(cfg.lint["command"], repo)
-        rprint(out)
-        if code != 0:
-            rprint("[red]Lint failed, reverting...[/red]")
-            hard_reset(repo, start_sha)
+                        # Re-run tests after applying improvements
+                        if prechecks(wt) or not check(wt):
+                            rprint("[red]Improvements broke tests, reverting...[/red]")
+                            hard_reset(path, start_sha)
+                        else:
+                            rprint("[green]Improvements validated by tests.[/green]")
+
+        # Optional lint step (placeholder)
+        if not lint_ok(wt):
             raise SystemExit(1)
 
-    # Commit & push (only if there are changes)
-    ts = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
-    current = current_branch(repo)
-    branch = current
-    if cfg.push_mode != "direct":
-        branch = f"{cfg.branch_prefix}/{ts}"
-        create_branch(repo, branch)
-    if has_changes(repo):
-        add_all(repo)
-        # Try to read last suggestion if any, else default
-        try:
-            title = suggestion.get("title", "automated update") if 'suggestion' in locals() else "automated update"
-            summary = suggestion.get("summary", "applied minimal safe changes") if 'suggestion' in locals() else "applied minimal safe changes"
-        except Exception:
-            title, summary = "automated update", "applied minimal safe changes"
-        msg = cfg.commit_message_template.format(title=title, summary=summary)
-        if not commit(repo, msg):
-            rprint("[yellow]Nothing to commit or commit failed.[/yellow]")
-        else:
-            push(repo, cfg.remote, branch)
-    else:
-        rprint("[yellow]No changes detected; skipping commit/push.[/yellow]")
+        title = (suggestion or {}).get("title", "automated update")
+        summary = (suggestion or {}).get("summary", "applied minimal safe changes")
+        change = _commit_job(wt, title, summary)
 
-    # Deploy
-    rprint("[cyan]Deploying...[/cyan]")
-    if not deploy(cfg):
-        raise SystemExit(1)
+    _publish(cfg, start_sha, change, "codex-good")
+
+
+@traced("lint")
+def lint_ok(cfg: CodexConfig) -> bool:
+    if not cfg.lint or not cfg.lint.get("command"):
+        return True
+    code, _, _ = run_cmd(cfg.lint["command"], cfg.repo_root, echo=True)
+    if code != 0:
+        rprint("[red]Lint failed, discarding changes...[/red]")
+        return False
+    return True
 
-    # Health check
-    if not health_check(cfg):
-        rprint("[red]Health check failed, rolling back...[/red]")
-        last_good = read_last_good(repo) or start_sha
-        if (cfg.rollback or {}).get("strategy", "git_reset") == "git_reset":
-            hard_reset(repo, last_good)
+
+@traced("commit")
+def _commit_job(wt: CodexConfig, title: str, summary: str) -> str:
+    """Commit a job's changes in its worktree; returns the commit, or "" when nothing changed."""
+    if not has_changes(wt.repo_root):
+        return ""
+    add_all(wt.repo_root)
+    msg = wt.commit_message_template.format(title=title, summary=summary)
+    if not commit(wt.repo_root, msg):
+        rprint("[yellow]Nothing to commit or commit failed.[/yellow]")
+        return ""
+    return current_sha(wt.repo_root)
+
+
+@traced("publish")
+def _publish(cfg: CodexConfig, start_sha: str, change: str, tag_prefix: str) -> None:
+    """Land a validated commit in the main checkout, then push, deploy and check health.
+
+    Runs under the repo lock; everything before it happens in the job's own worktree.
+    """
+    repo = cfg.repo_root
+    with workspaces(repo).repo_lock():
+        head = current_sha(repo)
+        ts = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+        branch = current_branch(repo) if cfg.push_mode == "direct" else f"{cfg.branch_prefix}/{ts}"
+        if cfg.push_mode != "direct":
+            create_branch(repo, branch)
+        if change:
+            if head == start_sha:
+                landed = fast_forward(repo, change)
+            else:
+                # Other jobs were published since this one started: replay on top and test again
+                rprint(f"[cyan]HEAD moved to {head}; replaying {change}...[/cyan]")
+                landed = cherry_pick(repo, change)
+                if landed and not test_suite(cfg):
+                    rprint("[red]Changes fail on top of newer commits, reverting...[/red]")
+                    hard_reset(repo, head)
+                    raise SystemExit(1)
+            if not landed:
+                raise SystemExit(f"changes conflict with commits published since {start_sha[:12]}")
+            push(repo, cfg.remote, branch)
         else:
-            revert_last(repo)
-        deploy(cfg)
-        raise SystemExit(1)
+            rprint("[yellow]No changes detected; skipping commit/push.[/yellow]")
 
-    # Tag as last good
-    good_sha = current_sha(repo)
-    save_last_good(repo, good_sha)
-    tag(repo, f"codex-good-{ts}")
-    rprint(f"[green]Success. Last good: {good_sha}[/green]")
+        # Deploy what changed since the last good (deployed) commit, then check health
+        last_good = read_last_good(repo)
+        deployed = deploy(cfg, last_good)
+        if deployed is False:
+            raise SystemExit(1)
+        if deployed and not health_check(cfg):
+            rprint("[red]Health check failed, rolling back...[/red]")
+            failed = current_sha(repo)
+            if (cfg.rollback or {}).get("strategy", "git_reset") == "git_reset":
+                hard_reset(repo, last_good or start_sha)
+            else:
+                revert_last(repo)
+            # The same services again, back at the old code
+            deploy(cfg, failed)
+            raise SystemExit(1)
+        good_sha = current_sha(repo)
+        save_last_good(repo, good_sha)
+        tag(repo, f"{tag_prefix}-{ts}")
+        rprint(f"[green]Success. Last good: {good_sha}[/green]")
 
 
 def _run_prompt(cfg: CodexConfig, prompt: str) -> None:
-    repo = cfg.repo_root
-    start_sha = current_sha(repo)
+    start_sha = current_sha(cfg.repo_root)
     rprint(f"Start SHA: [bold]{start_sha}[/bold]")
 
-    context = {"last_sha": start_sha}
+    context = prompt_context(cfg, start_sha, prompt)
+    if CANDIDATES > 1:
+        rprint(f"[cyan]Proposing {CANDIDATES} candidate changes from custom prompt...[/cyan]")
+        candidates = [([], lambda n=n: propose(cfg.ai_url, _variant(prompt, n), context), "codex nudge", prompt[:200])
+                      for n in range(CANDIDATES)]
+        change = _speculate(cfg, start_sha, candidates, "Tests failing after prompt changes.")
+        if change is None:
+            rprint("[yellow]No diffs from prompt; exiting.[/yellow]")
+            return
+        _publish(cfg, start_sha, change, "codex-nudge")
+        return
     rprint("[cyan]Proposing changes from custom prompt...[/cyan]")
     suggestion = propose(cfg.ai_url, prompt, context)
     diffs = suggestion.get("diffs", [])
     if not diffs:
         rprint("[yellow]No diffs from prompt; exiting.[/yellow]")
         return
-    if not apply_diffs(cfg, diffs):
+    with workspaces(cfg.repo_root).checkout(start_sha) as path:
+        wt = replace(cfg, repo_root=path)
+        _validate(wt, diffs, start_sha, "Tests failing after prompt changes.")
+        change = _commit_job(wt, suggestion.get("title", "codex nudge"), suggestion.get("summary", prompt[:200]))
+    _publish(cfg, start_sha, change, "codex-nudge")
+
+
+def _validate(wt: CodexConfig, diffs: list[dict], start_sha: str, failing: str) -> None:
+    """Apply diffs in a worktree and get tests and lint green, asking the AI for up to 2 fixes."""
+    if not _first_try(apply_diffs(wt, diffs)):
         raise SystemExit(1)
-    # If tests fail, ask AI for minimal fixes up to 2 attempts
     attempts = 0
-    while not test_suite(cfg) and attempts < 2:
+    # A broken patch goes back to the AI with the exact errors, without a test run
+    errors = prechecks(wt)
+    passed = not errors and check(wt)
+    while not passed and attempts < 2:
         attempts += 1
-        rprint(f"[yellow]Tests failing. Attempting AI fix #{attempts}...[/yellow]")
-        fix = propose(cfg.ai_url,
-                      "Tests failing after prompt changes. Provide minimal unified diff to fix failures only.",
-                      {"last_sha": start_sha})
-        if not apply_diffs(cfg, fix.get("diffs", [])):
+        rprint(f"[yellow]{'Pre-checks' if errors else 'Tests'} failing. Attempting AI fix #{attempts}...[/yellow]")
+        prompt = _fix_prompt(errors, failing)
+        fix = propose(wt.ai_url, prompt, prompt_context(wt, start_sha, prompt))
+        if not apply_diffs(wt, fix.get("diffs", [])):
             break
-    if not test_suite(cfg):
-        rprint("[red]Custom prompt changes still failing, reverting...[/red]")
-        hard_reset(repo, start_sha)
+        errors = prechecks(wt)
+        passed = not errors and check(wt)
+    if not passed:
+        rprint("[red]Changes still failing, discarding...[/red]")
+        raise SystemExit(1)
+    if not lint_ok(wt):
         raise SystemExit(1)
 
-    # Lint
-    if cfg.lint and cfg.lint.get("command"):
-        code, out, err = run_cmd(cfg.lint["command"], repo)
-        rprint(out)
-        if code != 0:
-            rprint("[red]Lint failed, reverting...[/red]")
-            hard_reset(repo, start_sha)
-            raise SystemExit(1)
 
-    # Commit & push
-    ts = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
-    current = current_branch(repo)
-    branch = current if cfg.push_mode == "direct" else f"{cfg.branch_prefix}/{ts}"
-    if cfg.push_mode != "direct":
-        create_branch(repo, branch)
-    if has_changes(repo):
-        add_all(repo)
-        title = suggestion.get("title", "codex nudge")
-        summary = suggestion.get("summary", prompt[:200])
-        msg = cfg.commit_message_template.format(title=title, summary=summary)
-        if commit(repo, msg):
-            push(repo, cfg.remote, branch)
-    # Deploy and health
-    rprint("[cyan]Deploying...[/cyan]")
-    if not deploy(cfg):
-        raise SystemExit(1)
-    if not health_check(cfg):
-        rprint("[red]Health check failed, rolling back...[/red]")
-        last_good = read_last_good(repo) or start_sha
-        if (cfg.rollback or {}).get("strategy", "git_reset") == "git_reset":
-            hard_reset(repo, last_good)
-        else:
-            revert_last(repo)
-        deploy(cfg)
+def _fix_prompt(errors: list[str], failing: str) -> str:
+    detail = "".join(f"\n- {e}" for e in errors)
+    prompt = f"The changes do not pass these checks:{detail}\n" if errors else f"{failing} "
+    return prompt + "Provide minimal unified diff to fix failures only."
+
+
+def _variant(prompt: str, n: int) -> str:
+    return prompt + VARIANTS[n % len(VARIANTS)] + (f"\n(Alternative #{n + 1}.)" if n >= len(VARIANTS) else "")
+
+
+@traced("candidate")
+def _attempt(cfg: CodexConfig, start_sha: str, batches: list[list[dict]], cancel: threading.Event,
+             title: str, summary: str, failing: str, first: bool) -> dict:
+    """Apply the diff batches in order in a fresh worktree and run the checks; stops early once `cancel` is set.
+
+    Returns {"change": sha} when everything passes, otherwise the stage that failed, with a fix prompt and
+    its context taken from the failing tree.
+    """
+    with cancellable(cancel), workspaces(cfg.repo_root).checkout(start_sha) as path:
+        wt = replace(cfg, repo_root=path)
+        for n, diffs in enumerate(batches):
+            applied = apply_diffs(wt, diffs)
+            if first and n == 0:
+                _first_try(applied)
+            if not applied:
+                return {"stage": "apply"}
+        errors = prechecks(wt)
+        stage = "precheck" if errors else "tests" if not check(wt) else "lint" if not lint_ok(wt) else ""
+        if cancel.is_set():
+            return {"stage": "cancelled"}
+        if stage:
+            prompt = _fix_prompt(errors, failing)
+            return {"stage": stage, "batches": batches, "prompt": prompt,
+                    "context": prompt_context(wt, start_sha, prompt), "title": title, "summary": summary}
+        return {"change": _commit_job(wt, title, summary)}
+
+
+def _race(cfg: CodexConfig, start_sha: str, candidates: list[tuple], failing: str, first: bool) -> tuple:
+    """Validate candidates concurrently, each in its own worktree; the first to pass cancels the rest.
+
+    A candidate is (diff batches already in hand, AI request or None, title, summary); the diffs its
+    request returns, if any, go on top. Returns the winning commit (None if none passed) and the failures.
+    """
+    cancel = threading.Event()
+    lock = threading.Lock()
+    failures: list[dict] = []
+    winner: list[str] = []
+
+    def candidate(n: int, batches: list, ask, title: str, summary: str) -> None:
+        try:
+            suggestion = ask() if ask else {}
+            if first:
+                title, summary = suggestion.get("title", title), suggestion.get("summary", summary)
+            diffs = suggestion.get("diffs") or []
+            if ask and not diffs:
+                result = {"stage": "empty"}
+            elif cancel.is_set():
+                result = {"stage": "cancelled"}
+            else:
+                batches = batches + [diffs] if ask else batches
+                result = _attempt(cfg, start_sha, batches, cancel, title, summary, failing, first)
+        except Exception as e:
+            rprint(f"[red]Candidate {n + 1} failed: {e}[/red]")
+            result = {"stage": "error"}
+        with lock:
+            if "change" in result and not cancel.is_set():
+                rprint(f"[green]Candidate {n + 1} passed.[/green]")
+                winner.append(result["change"])
+                cancel.set()
+            elif result["stage"] != "cancelled":
+                failures.append(result)
+            else:
+                count("candidates_cancelled")
+
+    count("candidates", len(candidates))
+    pool = ThreadPoolExecutor(max_workers=len(candidates), thread_name_prefix="codex-candidate")
+    futures = [pool.submit(in_job(candidate), n, *c) for n, c in enumerate(candidates)]
+    for _ in as_completed(futures):
+        if winner:
+            break
+    # Losers wind down on their own: cancelled checks exit within executor.CANCEL_POLL
+    pool.shutdown(wait=False)
+    return (winner[0] if winner else None), failures
+
+
+def _speculate(cfg: CodexConfig, start_sha: str, candidates: list[tuple], failing: str) -> Optional[str]:
+    """The commit of the first candidate to pass, after up to 2 rounds of parallel AI fixes for the most
+    promising failure; None when the AI had no diffs at all.
+    """
+    change, failures = _race(cfg, start_sha, candidates, failing, first=True)
+    if change is None and failures and all(f["stage"] == "empty" for f in failures):
+        return None
+    for attempt in (1, 2):
+        if change is not None:
+            return change
+        # A test failure is closer to green than a pre-check failure; lint and apply failures get no fix
+        fixable = [f for f in failures if f["stage"] in ("tests", "precheck")]
+        if not fixable:
+            break
+        best = max(fixable, key=lambda f: f["stage"] == "tests")
+        rprint(f"[yellow]No candidate passed. Attempting {CANDIDATES} AI fixes #{attempt} in parallel...[/yellow]")
+        candidates = [
+            (best["batches"], lambda n=n: propose(cfg.ai_url, _variant(best["prompt"], n), best["context"]),
+             best["title"], best["summary"])
+            for n in range(CANDIDATES)
+        ]
+        change, failures = _race(cfg, start_sha, candidates, failing, first=False)
+    if change is None:
+        rprint("[red]No candidate passed, discarding...[/red]")
         raise SystemExit(1)
-    good_sha = current_sha(repo)
-    save_last_good(repo, good_sha)
-    tag(repo, f"codex-nudge-{ts}")
-    rprint(f"[green]Success. Last good: {good_sha}[/green]")
+    return change
 
 
 def _queue_dir(root: str) -> Path:
@@ -290,23 +690,52 @@ def _processed_dir(root: str) -> Path:
     return d
 
 
-def process_queue(cfg: CodexConfig) -> None:
+def make_runner(config_path: Optional[str]) -> JobRunner:
+    """Job runner over the shared queue (codex/jobs.db) used by both `run-loop` and the HTTP server."""
+    def propose_job(payload: dict) -> dict:
+        return propose_changes(load_config(config_path), payload["prompt"])
+
+    def apply_job(payload: dict) -> dict:
+        cfg = load_config(config_path)
+        apply_proposal(cfg, payload["id"])
+        return {"id": payload["id"], "head": current_sha(cfg.repo_root)}
+
+    def nudge_job(payload: dict) -> dict:
+        cfg = load_config(config_path)
+        _run_prompt(cfg, payload["prompt"])
+        return {"head": current_sha(cfg.repo_root)}
+
+    def maintenance_job(payload: dict) -> dict:
+        once(config_path)
+        return {"head": current_sha(load_config(config_path).repo_root)}
+
+    store = JobStore(default_path(load_config(config_path).repo_root))
+    return JobRunner(
+        store,
+        {"propose": propose_job, "apply": apply_job, "nudge": nudge_job, "maintenance": maintenance_job},
+        # Jobs work in their own worktree; only _publish takes the repo lock
+        serial=(),
+        # Proposals only read the tree, so transient AI errors are retried; the rest may have published
+        attempts={"propose": 3},
+        # Applying a proposal again after it landed would apply its diffs twice
+        once=("apply",),
+    )
+
+
+def process_queue(cfg: CodexConfig, runner: JobRunner) -> None:
+    """Move prompts dropped into codex/queue/*.json (the old file queue) onto the job queue."""
     qdir = _queue_dir(cfg.repo_root)
     pdir = _processed_dir(cfg.repo_root)
-    files = sorted(glob.glob(str(qdir / "*.json")))
-    if not files:
-        return
-    rprint(f"[cyan]Processing {len(files)} queued Codex job(s)...[/cyan]")
-    for f in files:
+    for f in sorted(qdir.glob("*.json")):
         try:
-            data = json.loads(Path(f).read_text(encoding="utf-8"))
+            data = json.loads(f.read_text(encoding="utf-8"))
             prompt = (data.get("prompt") or "").strip()
             if not prompt:
-                rprint(f"[yellow]Skipping empty prompt in {os.path.basename(f)}[/yellow]")
+                rprint(f"[yellow]Skipping empty prompt in {f.name}[/yellow]")
             else:
-                _run_prompt(cfg, prompt)
-            # move to processed
-            shutil.move(f, pdir / os.path.basename(f))
+                job = runner.submit("nudge", {"prompt": prompt})
+                rprint(f"[cyan]Queued {f.name} as {job['id']}[/cyan]")
+            shutil.move(str(f), pdir / f.name)
         except Exception as e:
             rprint(f"[red]Failed processing queue file {f}: {e}[/red]")
 
@@ -314,21 +743,21 @@ def process_queue(cfg: CodexConfig) -> None:
 @app.command()
 def run_loop(
     interval: int = typer.Option(86400, help="Seconds between maintenance runs; default daily"),
-    queue_poll: int = typer.Option(60, help="Seconds between queue checks"),
+    queue_poll: int = typer.Option(60, help="Seconds between checks of the legacy codex/queue directory"),
     config: Optional[str] = typer.Option(None, help="Path to config.yml")
 ):
+    # Queued jobs are picked up by the runner's workers as soon as they are submitted
+    runner = make_runner(config).start()
     last_maintenance = 0
     while True:
         try:
             cfg = load_config(config)
-            # Process queued jobs frequently
-            process_queue(cfg)
+            process_queue(cfg, runner)
             now = time.time()
             if now - last_maintenance >= interval:
-                once(config)
+                # Queued so it runs on the shared workers; a pending run is not queued twice
+                runner.submit("maintenance", {})
                 last_maintenance = now
-        except SystemExit as e:
-            rprint(f"[red]Codex once failed with code {e.code}[/red]")
         except Exception as e:
             rprint(f"[red]Unexpected error: {e}[/red]")
         time.sleep(queue_poll)
@@ -351,8 +780,12 @@ def _proposals_dir(root: str) -> Path:
 def propose_changes(cfg: CodexConfig, prompt: str) -> dict:
     ts = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
     start_sha = current_sha(cfg.repo_root)
-    suggestion = propose(cfg.ai_url, prompt, {"last_sha": start_sha})
+    suggestion = propose(cfg.ai_url, prompt, prompt_context(cfg, start_sha, prompt))
     diffs = suggestion.get("diffs", []) or []
+    # Checked against the main checkout, so the reviewer knows up front whether it will apply
+    apply_errors = patches.dry_run(cfg.repo_root, diffs, cfg.protected_paths or [], cfg.allow_paths or [])
+    if diffs:
+        _first_try(not apply_errors)
     files = []
     for d in diffs:
         p = (d.get("path") or "").strip()
@@ -366,6 +799,7 @@ def propose_changes(cfg: CodexConfig, prompt: str) -> dict:
         "prompt": prompt,
         "suggestion": suggestion,
         "files": files,
+        "apply_errors": apply_errors,
     }
     (_proposals_dir(cfg.repo_root) / f"{pid}.json").write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
     return {
@@ -373,77 +807,36 @@ def propose_changes(cfg: CodexConfig, prompt: str) -> dict:
         "title": suggestion.get("title", "proposal"),
         "summary": suggestion.get("summary", ""),
         "files": files,
+        "apply_errors": apply_errors,
     }
 
 
 def apply_proposal(cfg: CodexConfig, proposal_id: str) -> None:
-    repo = cfg.repo_root
-    pfile = _proposals_dir(repo) / f"{proposal_id}.json"
+    pfile = _proposals_dir(cfg.repo_root) / f"{proposal_id}.json"
     if not pfile.exists():
         raise SystemExit(f"proposal not found: {proposal_id}")
     data = json.loads(pfile.read_text(encoding="utf-8"))
-    start_sha = data.get("base_sha") or current_sha(repo)
+    start_sha = data.get("base_sha") or current_sha(cfg.repo_root)
     suggestion = data.get("suggestion") or {}
     diffs = suggestion.get("diffs", []) or []
     if not diffs:
         rprint("[yellow]Proposal contains no diffs; aborting[/yellow]")
         return
-    if not apply_diffs(cfg, diffs):
-        raise SystemExit(1)
-    attempts = 0
-    while not test_suite(cfg) and attempts < 2:
-        attempts += 1
-        rprint(f"[yellow]Tests failing. Attempting AI fix #{attempts}...[/yellow]")
-        fix = propose(cfg.ai_url,
-                      "Tests failing after proposal apply. Provide minimal unified diff to fix failures only.",
-                      {"last_sha": start_sha})
-        if not apply_diffs(cfg, fix.get("diffs", [])):
-            break
-    if not test_suite(cfg):
-        rprint("[red]Changes still failing, reverting...[/red]")
-        hard_reset(repo, start_sha)
-        raise SystemExit(1)
-
-    # Strict lint
-    if cfg.lint and cfg.lint.get("command"):
-        code, out, err = run_cmd(cfg.lint["command"], repo)
-        rprint(out)
-        if code != 0:
-            rprint("[red]Lint failed, reverting...[/red]")
-            hard_reset(repo, start_sha)
-            raise SystemExit(1)
-
-    # Commit & push
-    ts = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
-    current = current_branch(repo)
-    branch = current if cfg.push_mode == "direct" else f"{cfg.branch_prefix}/{ts}"
-    if cfg.push_mode != "direct":
-        create_branch(repo, branch)
-    if has_changes(repo):
-        add_all(repo)
+    # Validate against the commit the proposal was made for; _publish replays it if HEAD has moved
+    if CANDIDATES > 1:
+        # The approved diffs are the only first-round candidate; fixes for them are raced
         title = suggestion.get("title", "codex proposal")
         summary = suggestion.get("summary", "applied approved changes")
-        msg = cfg.commit_message_template.format(title=title, summary=summary)
-        if commit(repo, msg):
-            push(repo, cfg.remote, branch)
-
-    # Deploy & health
-    rprint("[cyan]Deploying...[/cyan]")
-    if not deploy(cfg):
-        raise SystemExit(1)
-    if not health_check(cfg):
-        rprint("[red]Health check failed, rolling back...[/red]")
-        last_good = read_last_good(repo) or start_sha
-        if (cfg.rollback or {}).get("strategy", "git_reset") == "git_reset":
-            hard_reset(repo, last_good)
-        else:
-            revert_last(repo)
-        deploy(cfg)
-        raise SystemExit(1)
-    good_sha = current_sha(repo)
-    save_last_good(repo, good_sha)
-    tag(repo, f"codex-prop-{ts}")
-    rprint(f"[green]Success. Last good: {good_sha}[/green]")
+        change = _speculate(cfg, start_sha, [([diffs], None, title, summary)], "Tests failing after proposal apply.")
+        _publish(cfg, start_sha, change, "codex-prop")
+        return
+    with workspaces(cfg.repo_root).checkout(start_sha) as path:
+        wt = replace(cfg, repo_root=path)
+        _validate(wt, diffs, start_sha, "Tests failing after proposal apply.")
+        change = _commit_job(
+            wt, suggestion.get("title", "codex proposal"), suggestion.get("summary", "applied approved changes")
+        )
+    _publish(cfg, start_sha, change, "codex-prop")
 
 
 @app.command()
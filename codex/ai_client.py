@@ -1,7 +1,9 @@
 from __future__ import annotations
 import requests
 from typing import Dict, Any
-from tenacity import retry, stop_after_attempt, wait_exponential
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+
+from .jobs import traced
 
 
 SYSTEM = (
@@ -9,11 +11,22 @@ SYSTEM = (
     "(1) mavjud test xatolarini tuzatish uchun minimal patch taklif qiling; "
     "(2) agar testlar o'tsa, xavfsiz optimallashtirishlar taklif qiling; "
     "(3) Faqat ruxsat etilgan yo'llarda o'zgartiring; (4) .env va maxfiy fayllarga tegmang; "
-    "(5) Natija JSON formatida qayting: {title, summary, diffs: [{path, unified_diff}]}."
+    "(5) Natija JSON formatida qayting: {title, summary, diffs: [{path, unified_diff}]}; "
+    "(6) kontekstdagi `snippets` repodagi joriy kod (path, qatorlar): diff'larni aynan shu kodga mos yozing."
 )
 
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=1, max=8))
+def _retryable(exc: BaseException) -> bool:
+    # The AI service already retries upstream faults under a budget and fails fast
+    # while its circuit is open; only retry when the service itself was unreachable.
+    if isinstance(exc, requests.HTTPError):
+        return exc.response is not None and exc.response.status_code in (429, 503)
+    return isinstance(exc, requests.ConnectionError)
+
+
+@traced("propose")
+@retry(stop=stop_after_attempt(2), wait=wait_exponential(multiplier=1, min=1, max=8),
+       retry=retry_if_exception(_retryable), reraise=True)
 def propose(ai_url: str, prompt: str, context: Dict[str, Any]) -> Dict[str, Any]:
     # Use Codex-dedicated endpoint to allow separate API key
     payload = {
@@ -23,7 +36,7 @@ def propose(ai_url: str, prompt: str, context: Dict[str, Any]) -> Dict[str, Any]
         "history": [{"role": "system", "content": SYSTEM}],
         "context": context,
     }
-    r = requests.post(ai_url.rstrip("/") + "/chat-codex", json=payload, timeout=60)
+    r = requests.post(ai_url.rstrip("/") + "/chat-codex", json=payload, timeout=(5, 60))
     r.raise_for_status()
     data = r.json()
     # The service returns {answer: "..."}. Expect JSON string in answer.
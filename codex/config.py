@@ -18,6 +18,7 @@ class CodexConfig:
     health: Dict[str, Any] = field(default_factory=dict)
     tests: Dict[str, Any] = field(default_factory=dict)
     lint: Dict[str, Any] = field(default_factory=dict)
+    precheck: Dict[str, Any] = field(default_factory=dict)
     deploy: Dict[str, Any] = field(default_factory=dict)
     restart_services: List[str] = field(default_factory=list)
     protected_paths: List[str] = field(default_factory=list)
@@ -1,8 +1,55 @@
 from __future__ import annotations
-from .executor import run
-from typing import List, Tuple
+import fnmatch
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
 
 
-def run_cmd(cmd: List[str], cwd: str) -> Tuple[int, str, str]:
-    return run(cmd, cwd=cwd, timeout=1800)
+def plan(paths: List[str], rules: List[Dict], services: List[str]) -> Tuple[List[str], List[str]]:
+    """(services to rebuild, services only to restart) for a change to `paths`.
 
+    Each path takes the first rule with a matching `paths` glob; the rule's `build` and `restart`
+    list what it needs, and empty lists mean nothing (tests, docs). A path no rule matches needs
+    all of `services` rebuilt.
+    """
+    build, restart = set(), set()
+    for path in paths:
+        rule = next((r for r in rules if any(fnmatch.fnmatch(path, p) for p in r.get("paths") or [])), None)
+        if rule is None:
+            build.update(services)
+        else:
+            build.update(rule.get("build") or [])
+            restart.update(rule.get("restart") or [])
+    order = {name: i for i, name in enumerate(services)}
+
+    def ordered(names: set) -> List[str]:
+        return sorted(names, key=lambda name: (order.get(name, len(order)), name))
+    return ordered(build), ordered(restart - build)
+
+
+def healthy(urls: List[str], get: Callable[..., object], timeout: float, retries: int,
+            backoff: float = 0.25, max_backoff: float = 2.0) -> bool:
+    """Probe all `urls` at once until each answers with a status below 500.
+
+    Each URL gets `retries` attempts, waiting `backoff` seconds after the first failure and twice as
+    long after each next one, up to `max_backoff`. The check fails as soon as one URL runs out.
+    """
+    failed = threading.Event()
+
+    def probe(url: str) -> bool:
+        delay = backoff
+        for attempt in range(retries):
+            try:
+                if get(url, timeout=timeout).status_code < 500:
+                    return True
+            except Exception:
+                pass
+            # The wait ends early once another URL has failed for good
+            if attempt + 1 == retries or failed.wait(delay):
+                break
+            delay = min(delay * 2, max_backoff)
+        failed.set()
+        return False
+
+    with ThreadPoolExecutor(max_workers=len(urls)) as pool:
+        return all(list(pool.map(probe, urls)))
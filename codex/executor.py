@@ -1,14 +1,138 @@
+import os
+import signal
 import subprocess
-from typing import List, Optional, Tuple
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, suppress
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 
+# Exit codes for runs that say nothing about the code: timed out, or cancelled by the caller
+TIMEOUT = 124
+CANCELLED = 130
+# How often a cancellable run checks its cancel event
+CANCEL_POLL = 0.2
+# Seconds a killed command gets to exit after SIGTERM before SIGKILL
+CANCEL_GRACE = 5
+# Longest line read at once; longer ones (progress output without newlines) arrive in pieces
+MAX_LINE = 8192
 
-def run(cmd: List[str], cwd: Optional[str] = None, timeout: Optional[int] = None) -> Tuple[int, str, str]:
-    proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+_scope = threading.local()
+
+
+@contextmanager
+def cancellable(event: threading.Event) -> Iterator[None]:
+    """Commands run by this thread inside the block are killed once `event` is set."""
+    previous = getattr(_scope, "event", None)
+    _scope.event = event
     try:
-        out, err = proc.communicate(timeout=timeout)
-        return proc.returncode, out, err
-    except subprocess.TimeoutExpired:
-        proc.kill()
-        out, err = proc.communicate()
-        return 124, out, err
+        yield
+    finally:
+        _scope.event = previous
+
+
+def cancel_event() -> Optional[threading.Event]:
+    """The cancel event of the enclosing `cancellable` block in this thread, if any."""
+    return getattr(_scope, "event", None)
+
+
+class _Tail:
+    """The last `keep` lines of a stream (all of them if `keep` is None)."""
+
+    def __init__(self, keep: Optional[int]):
+        self.lines: deque = deque(maxlen=keep)
+        self.dropped = 0
+
+    def add(self, line: str) -> None:
+        if self.lines.maxlen is not None and len(self.lines) == self.lines.maxlen:
+            self.dropped += 1
+        self.lines.append(line)
 
+    def text(self) -> str:
+        head = f"[{self.dropped} earlier lines not kept]\n" if self.dropped else ""
+        return head + "".join(self.lines)
+
+
+def _kill(proc: subprocess.Popen, group: bool) -> None:
+    """SIGTERM, then SIGKILL after CANCEL_GRACE; `docker compose run --rm` only removes its container on the first."""
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            if group:
+                os.killpg(proc.pid, sig)
+            else:
+                proc.send_signal(sig)
+        except ProcessLookupError:
+            return
+        try:
+            proc.wait(CANCEL_GRACE)
+            return
+        except subprocess.TimeoutExpired:
+            pass
+
+
+def run(cmd: List[str], cwd: Optional[str] = None, timeout: Optional[int] = None,
+        env: Optional[Dict[str, str]] = None, input: Optional[str] = None,
+        on_line: Optional[Callable[[str], bool]] = None, keep: Optional[int] = None) -> Tuple[int, str, str]:
+    """Run a command; `env` adds to (not replaces) the current environment, `input` is fed to stdin.
+
+    Output is read line by line as it arrives. `on_line` sees each line of stdout and stderr; when it
+    returns True the command is killed and the run fails with exit code 1. With `keep`, only the last
+    `keep` lines of each stream are held and returned.
+    """
+    event = cancel_event()
+    if event is not None and event.is_set():
+        return CANCELLED, "", "cancelled"
+    # Own process group, so a kill also reaches whatever a shell started
+    group = event is not None or on_line is not None
+    proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, errors="replace",
+                            stdin=subprocess.PIPE if input is not None else None,
+                            env={**os.environ, **env} if env else None, start_new_session=group)
+    tails = (_Tail(keep), _Tail(keep))
+    stopped = threading.Event()
+    lock = threading.Lock()
+
+    def pump(stream, tail: _Tail) -> None:
+        for line in iter(lambda: stream.readline(MAX_LINE), ""):
+            tail.add(line)
+            if on_line is not None:
+                with lock:
+                    if on_line(line):
+                        # Killed by the waiting thread, so both streams keep draining during the grace period
+                        stopped.set()
+        stream.close()
+
+    pumps = [threading.Thread(target=pump, args=pair, daemon=True) for pair in zip((proc.stdout, proc.stderr), tails)]
+    for thread in pumps:
+        thread.start()
+    deadline = time.monotonic() + timeout if timeout else None
+    status = 0
+    try:
+        if input is not None:
+            # The command may exit without reading it all
+            with suppress(BrokenPipeError):
+                proc.stdin.write(input)
+            with suppress(BrokenPipeError):
+                proc.stdin.close()
+        poll = event is not None or deadline is not None or on_line is not None
+        while status == 0 and not stopped.is_set():
+            try:
+                proc.wait(CANCEL_POLL if poll else None)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            if deadline is not None and time.monotonic() > deadline:
+                status = TIMEOUT
+            elif event is not None and event.is_set():
+                status = CANCELLED
+        if status or stopped.is_set():
+            _kill(proc, group)
+    except BaseException:
+        # Interrupted (Ctrl-C): a command in its own session would not get the signal otherwise
+        _kill(proc, group)
+        raise
+    finally:
+        proc.wait()
+        for thread in pumps:
+            thread.join()
+    code = status or (1 if stopped.is_set() else proc.returncode)
+    return code, tails[0].text(), tails[1].text()
@@ -1,10 +1,18 @@
 from __future__ import annotations
+import os
+import shutil
+import tempfile
 from .executor import run
-from typing import Optional
+from .jobs import span
+from typing import Dict, Optional
 
 
-def git(cmd: list[str], cwd: str) -> tuple[int, str, str]:
-    return run(["git", *cmd], cwd=cwd)
+def git(cmd: list[str], cwd: str, env: Optional[Dict[str, str]] = None,
+        input: Optional[str] = None) -> tuple[int, str, str]:
+    with span(f"git {cmd[0]}") as record:
+        code, out, err = run(["git", *cmd], cwd=cwd, env=env, input=input)
+        record["exit"] = code
+    return code, out, err
 
 
 def current_sha(cwd: str) -> str:
@@ -62,3 +70,55 @@ def has_changes(cwd: str) -> bool:
     if code != 0:
         return False
     return bool(out.strip())
+
+
+def fast_forward(cwd: str, sha: str) -> bool:
+    code, _, _ = git(["merge", "--ff-only", sha], cwd)
+    return code == 0
+
+
+def cherry_pick(cwd: str, sha: str) -> bool:
+    code, _, _ = git(["cherry-pick", sha], cwd)
+    if code != 0:
+        git(["cherry-pick", "--abort"], cwd)
+    return code == 0
+
+
+def changed_paths(cwd: str) -> list[str]:
+    """Paths with uncommitted changes, untracked files included; both sides of a rename."""
+    code, out, _ = git(["status", "--porcelain", "-uall"], cwd)
+    if code != 0:
+        return []
+    paths: list[str] = []
+    for line in out.splitlines():
+        paths += [p.strip('"') for p in line[3:].split(" -> ")]
+    return paths
+
+
+def diff_paths(cwd: str, since: str, until: str = "HEAD") -> Optional[list[str]]:
+    """Paths that differ between two commits, both sides of a rename; None if either is unknown."""
+    code, out, _ = git(["diff", "--name-only", "--no-renames", since, until], cwd)
+    return out.splitlines() if code == 0 else None
+
+
+def common_root(cwd: str) -> str:
+    """The main checkout of a repository, also when `cwd` is one of its worktrees."""
+    code, out, _ = git(["rev-parse", "--git-common-dir"], cwd)
+    return os.path.dirname(os.path.abspath(os.path.join(cwd, out.strip()))) if code == 0 else cwd
+
+
+def tree_sha(cwd: str) -> str:
+    """Hash of the working tree as it would be committed (tracked and untracked, not ignored files).
+
+    Uses a copy of the index so the checkout's own staging area is left alone.
+    """
+    _, index, _ = git(["rev-parse", "--git-path", "index"], cwd)
+    index = os.path.join(cwd, index.strip())
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {"GIT_INDEX_FILE": os.path.join(tmp, "index")}
+        if os.path.exists(index):
+            shutil.copyfile(index, env["GIT_INDEX_FILE"])
+        if git(["add", "-A"], cwd, env)[0] != 0:
+            return ""
+        code, out, _ = git(["write-tree"], cwd, env)
+    return out.strip() if code == 0 else ""
@@ -1,66 +1,401 @@
 from __future__ import annotations
-import os
+import asyncio
+import functools
 import json
+import os
 import threading
-from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
-from typing import Optional
-
-from .agent import _run_prompt, load_config, propose_changes, apply_proposal
-
-
-def make_handler(config_path: Optional[str]):
-    secret = os.environ.get("CODEX_SECRET", "")
-
-    class NudgeHandler(BaseHTTPRequestHandler):
-        def _send(self, code: int, body: dict):
-            data = json.dumps(body).encode("utf-8")
-            self.send_response(code)
-            self.send_header("Content-Type", "application/json")
-            self.send_header("Content-Length", str(len(data)))
-            self.end_headers()
-            self.wfile.write(data)
-
-        def log_message(self, fmt, *args):
-            return
-
-        def do_POST(self):  # noqa: N802
-            if self.path not in ("/nudge", "/propose", "/apply"):
-                return self._send(404, {"error": "not found"})
-            if secret:
-                token = self.headers.get("X-Codex-Token", "")
-                if token != secret:
-                    return self._send(403, {"error": "forbidden"})
-            length = int(self.headers.get("Content-Length", "0") or 0)
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from rich import print as rprint
+
+from .agent import make_runner
+from .jobs import TERMINAL, JobRunner, QueueFull
+
+# Longest a request may block waiting for a job (POST "wait", GET ?wait=)
+MAX_WAIT = 25.0
+SSE_PING = 15.0
+# How often a log tail looks for new output, and the most it reads at once
+LOG_POLL = 0.5
+LOG_CHUNK = 64 * 1024
+# Threads for blocking work (SQLite, log files); requests queue for them instead of starting their own
+THREADS = int(os.environ.get("CODEX_HTTP_THREADS", "4"))
+# Largest request line plus headers, and largest body, accepted
+MAX_HEAD = 16 * 1024
+MAX_BODY = 1024 * 1024
+# Seconds a connection may sit idle between requests
+IDLE = 30.0
+
+
+def _wait_arg(value, default: float = 0.0) -> float:
+    try:
+        return max(0.0, min(float(value), MAX_WAIT))
+    except (TypeError, ValueError):
+        return default
+
+
+def read_log(path: Path, offset: int, partial: bool = False) -> Tuple[str, int]:
+    """Log text from byte `offset` on, up to LOG_CHUNK bytes, and the offset after it.
+
+    Only whole lines are returned while the job may still be writing; `partial` also takes a
+    trailing unfinished one.
+    """
+    try:
+        with path.open("rb") as f:
+            f.seek(offset)
+            data = f.read(LOG_CHUNK)
+    except OSError:
+        return "", offset
+    end = len(data) if partial or len(data) == LOG_CHUNK else data.rfind(b"\n") + 1
+    return data[:end].decode("utf-8", "replace"), offset + end
+
+
+class _BadRequest(Exception):
+    def __init__(self, code: int, error: str):
+        super().__init__(error)
+        self.code = code
+
+
+class Request:
+    def __init__(self, method: str, target: str, version: str, headers: Dict[str, str], body: bytes):
+        url = urlsplit(target)
+        self.method = method
+        self.path = url.path
+        self.query = parse_qs(url.query)
+        self.headers = headers
+        self.body = body
+        connection = headers.get("connection", "").lower()
+        self.keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+
+    def arg(self, name: str, default: Any = None) -> Any:
+        return (self.query.get(name) or [default])[0]
+
+
+async def _read_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> Optional[Request]:
+    """The next request on the connection, or None once the client has closed it.
+
+    Only Content-Length bodies are read; a chunked one is refused, as its bytes would otherwise be
+    taken for the next request.
+    """
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError as e:
+        if not e.partial.strip():
+            return None
+        raise _BadRequest(400, "incomplete request")
+    except asyncio.LimitOverrunError:
+        raise _BadRequest(431, "request header too large")
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, target, version = lines[0].split(" ")
+    except ValueError:
+        raise _BadRequest(400, "bad request line")
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(":")
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    if "transfer-encoding" in headers:
+        raise _BadRequest(411, "Content-Length required; chunked bodies are not supported")
+    try:
+        length = int(headers.get("content-length") or 0)
+    except ValueError:
+        raise _BadRequest(400, "bad content-length")
+    if length > MAX_BODY:
+        raise _BadRequest(413, "request body too large")
+    if length > 0 and headers.get("expect", "").lower() == "100-continue":
+        # curl waits for this before sending a larger body
+        writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        await writer.drain()
+    body = await reader.readexactly(length) if length > 0 else b""
+    return Request(method, target, version, headers, body)
+
+
+class CodexServer:
+    """The Codex HTTP API, served by one asyncio loop on a background thread.
+
+    An open connection costs a coroutine, not a thread. Store and log reads run on a pool of
+    `threads` threads, and requests waiting for a job to change are woken through one watcher
+    thread on the store's condition. New jobs are refused with 429 while the queue is full.
+    """
+
+    def __init__(self, runner: JobRunner, host: str = "0.0.0.0", port: int = 8090, threads: int = THREADS):
+        self.runner = runner
+        self.store = runner.store
+        self.secret = os.environ.get("CODEX_SECRET", "")
+        self.host, self.port = host, port
+        self.pool = ThreadPoolExecutor(threads, thread_name_prefix="codex-http")
+        self.loop = asyncio.new_event_loop()
+        self.stopping = threading.Event()
+        self.threads: list = []
+        self.connections: set = set()
+        self.changed: Optional[asyncio.Event] = None
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    def start(self) -> "CodexServer":
+        t = threading.Thread(target=self.loop.run_forever, name="codex-http-loop", daemon=True)
+        t.start()
+        self.threads.append(t)
+        asyncio.run_coroutine_threadsafe(self._listen(), self.loop).result()
+        t = threading.Thread(target=self._watch, name="codex-http-watch", daemon=True)
+        t.start()
+        self.threads.append(t)
+        return self
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self.stopping.set()
+        with self.store.changed:
+            self.store.changed.notify_all()
+        asyncio.run_coroutine_threadsafe(self._close(), self.loop).result(timeout)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        for t in self.threads:
+            t.join(timeout)
+        self.loop.close()
+        self.pool.shutdown(wait=False)
+
+    async def _listen(self) -> None:
+        self.changed = asyncio.Event()
+        self.server = await asyncio.start_server(self._connection, self.host, self.port, limit=MAX_HEAD)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def _close(self) -> None:
+        self.server.close()
+        for task in list(self.connections):
+            task.cancel()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+
+    def _watch(self) -> None:
+        """Wake waiting requests on every store change, and at least once a second for changes
+        made by other processes.
+        """
+        while not self.stopping.is_set():
+            with self.store.changed:
+                self.store.changed.wait(1.0)
+            if not self.stopping.is_set():
+                self.loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self) -> None:
+        event, self.changed = self.changed, asyncio.Event()
+        event.set()
+
+    async def _blocking(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        return await self.loop.run_in_executor(self.pool, functools.partial(fn, *args, **kwargs))
+
+    async def _until(self, job_id: str, timeout: float, done: Callable[[dict], bool]) -> dict:
+        """The job once `done(job)` holds or `timeout` seconds have passed."""
+        deadline = self.loop.time() + timeout
+        while True:
+            # Taken before the read, so a change made during it still wakes this wait
+            changed = self.changed
+            job = await self._blocking(self.store.get, job_id)
+            left = deadline - self.loop.time()
+            if done(job) or left <= 0:
+                return job
             try:
-                payload = json.loads(self.rfile.read(length).decode("utf-8")) if length else {}
-            except Exception:
-                return self._send(400, {"error": "invalid json"})
-            cfg = load_config(config_path)
-            if self.path == "/nudge":
-                prompt = (payload.get("prompt") or "").strip()
-                if not prompt:
-                    return self._send(400, {"error": "prompt required"})
-                threading.Thread(target=_run_prompt, args=(cfg, prompt), daemon=True).start()
-                return self._send(202, {"status": "accepted"})
-            if self.path == "/propose":
-                prompt = (payload.get("prompt") or "").strip()
-                if not prompt:
-                    return self._send(400, {"error": "prompt required"})
-                meta = propose_changes(cfg, prompt)
-                return self._send(200, meta)
-            if self.path == "/apply":
-                pid = (payload.get("id") or "").strip()
-                if not pid:
-                    return self._send(400, {"error": "id required"})
-                threading.Thread(target=apply_proposal, args=(cfg, pid), daemon=True).start()
-                return self._send(202, {"status": "accepted", "id": pid})
-
-    return NudgeHandler
-
-
-def start_http_server(config_path: Optional[str], host: str = "0.0.0.0", port: int = None):
+                await asyncio.wait_for(changed.wait(), left)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections.add(asyncio.current_task())
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(_read_request(reader, writer), IDLE)
+                except _BadRequest as e:
+                    await self._send(writer, e.code, {"error": str(e)}, keep_alive=False)
+                    break
+                if request is None or not await self._handle(request, writer):
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        except Exception as e:
+            rprint(f"[red]Codex HTTP request failed: {type(e).__name__}: {e}[/red]")
+            try:
+                await self._send(writer, 500, {"error": "internal error"}, keep_alive=False)
+            except ConnectionError:
+                pass
+        finally:
+            self.connections.discard(asyncio.current_task())
+            writer.close()
+
+    async def _send(self, writer: asyncio.StreamWriter, code: int, body: dict, headers: Optional[dict] = None,
+                    keep_alive: bool = True) -> bool:
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        head = [f"HTTP/1.1 {code} {HTTPStatus(code).phrase}", "Content-Type: application/json",
+                f"Content-Length: {len(data)}", *(f"{name}: {value}" for name, value in (headers or {}).items())]
+        if not keep_alive:
+            head.append("Connection: close")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + data)
+        await writer.drain()
+        return keep_alive
+
+    def _authorized(self, request: Request) -> bool:
+        return not self.secret or request.headers.get("x-codex-token", "") == self.secret
+
+    async def _handle(self, request: Request, writer: asyncio.StreamWriter) -> bool:
+        """Answer one request; False when the connection is to be closed."""
+        keep = request.keep_alive
+
+        def send(code: int, body: dict, headers: Optional[dict] = None):
+            return self._send(writer, code, body, headers, keep)
+        if request.method == "POST":
+            return await self._post(request, send)
+        if request.method != "GET":
+            return await send(501, {"error": "unsupported method"})
+        parts = request.path.strip("/").split("/")
+        if parts == ["stats"]:
+            if not self._authorized(request):
+                return await send(403, {"error": "forbidden"})
+            return await self._stats(request, send)
+        if len(parts) not in (2, 3) or parts[0] != "jobs" or \
+                parts[2:] not in ([], ["events"], ["log"], ["timeline"]):
+            return await send(404, {"error": "not found"})
+        if not self._authorized(request):
+            return await send(403, {"error": "forbidden"})
+        job = await self._blocking(self.store.get, parts[1])
+        if job is None:
+            return await send(404, {"error": "job not found"})
+        if parts[2:] == ["timeline"]:
+            spans = await self._blocking(self.store.timeline, job["id"])
+            return await send(200, {"job_id": job["id"], "state": job["state"], "spans": spans})
+        if parts[2:] == ["events"]:
+            await self._events(job, request, writer)
+            return False
+        if parts[2:] == ["log"]:
+            return await self._log(job, request, send)
+        wait = _wait_arg(request.arg("wait", 0))
+        if wait:
+            # Long poll: return as soon as the job leaves the state the client last saw
+            seen = request.arg("state") or job["state"]
+            job = await self._until(job["id"], wait, lambda j: j["state"] != seen or j["state"] in TERMINAL)
+        return await send(200, job)
+
+    async def _post(self, request: Request, send) -> bool:
+        if request.path not in ("/nudge", "/propose", "/apply"):
+            return await send(404, {"error": "not found"})
+        if not self._authorized(request):
+            return await send(403, {"error": "forbidden"})
+        try:
+            payload = json.loads(request.body.decode("utf-8")) if request.body else {}
+        except Exception:
+            return await send(400, {"error": "invalid json"})
+        wait = _wait_arg(payload.get("wait"))
+        if request.path in ("/nudge", "/propose"):
+            prompt = (payload.get("prompt") or "").strip()
+            if not prompt:
+                return await send(400, {"error": "prompt required"})
+            kind, args, extra = request.path.strip("/"), {"prompt": prompt}, {}
+        else:
+            pid = (payload.get("id") or "").strip()
+            if not pid:
+                return await send(400, {"error": "id required"})
+            # A proposal that was applied before returns that job (the runner runs "apply" once)
+            kind, args, extra = "apply", {"id": pid}, {"id": pid}
+        try:
+            job = await self._blocking(self.runner.submit, kind, args)
+        except QueueFull as e:
+            return await send(429, {"error": "queue full", "queued": e.depth, "retry_after": e.retry_after},
+                              {"Retry-After": str(e.retry_after)})
+        if wait:
+            job = await self._until(job["id"], wait, lambda j: j["state"] in TERMINAL)
+        return await self._job_reply(job, extra, send)
+
+    async def _job_reply(self, job: dict, extra: dict, send) -> bool:
+        """200 with the result once a job is done, otherwise 202 with where to poll."""
+        if job["state"] == "succeeded":
+            result = job["result"] if isinstance(job["result"], dict) else {"result": job["result"]}
+            return await send(200, {**result, "job_id": job["id"], "state": job["state"]})
+        if job["state"] in ("failed", "dead"):
+            return await send(500, {"error": job["error"], "job_id": job["id"], "state": job["state"]})
+        body = {"status": "accepted", "job_id": job["id"], "state": job["state"], **extra}
+        return await send(202, body, {"Location": f"/jobs/{job['id']}"})
+
+    async def _stats(self, request: Request, send) -> bool:
+        """Where the pipeline spent its time over the last `days` (default 7): per stage, and the slowest spans."""
+        try:
+            days = float(request.arg("days", 7))
+            slowest = max(0, int(request.arg("slowest", 10)))
+        except ValueError:
+            return await send(400, {"error": "invalid days or slowest"})
+
+        def stats() -> dict:
+            since = time.time() - days * 86400
+            return {"jobs": self.store.counts(), **self.store.span_stats(since, slowest)}
+        return await send(200, await self._blocking(stats))
+
+    async def _log(self, job: dict, request: Request, send) -> bool:
+        """Long poll of the job's output: the text after byte `offset`, once there is some or the job is done."""
+        try:
+            offset = max(0, int(request.arg("offset", 0)))
+        except ValueError:
+            return await send(400, {"error": "invalid offset"})
+        deadline = self.loop.time() + _wait_arg(request.arg("wait", 0))
+        path = self.store.log_path(job["id"])
+        text, end = await self._blocking(read_log, path, offset, job["state"] in TERMINAL)
+        while not text and job["state"] not in TERMINAL and deadline > self.loop.time():
+            seen = job["state"]
+            job = await self._until(job["id"], min(LOG_POLL, deadline - self.loop.time()),
+                                    lambda j: j["state"] != seen)
+            text, end = await self._blocking(read_log, path, offset, job["state"] in TERMINAL)
+        return await send(200, {"job_id": job["id"], "state": job["state"], "offset": end, "text": text})
+
+    async def _events(self, job: dict, request: Request, writer: asyncio.StreamWriter) -> None:
+        """Server-Sent Events: one `state` event per transition, closed after the terminal one.
+
+        With ?log=1, `log` events carry the job's output as it is written. Their id is the log offset
+        after them, so a reconnecting client resumes where it left off.
+        """
+        try:
+            offset = max(0, int(request.headers.get("last-event-id") or 0))
+        except ValueError:
+            offset = 0
+        path = self.store.log_path(job["id"]) if request.arg("log") == "1" else None
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                     b"Connection: close\r\n\r\n")
+        await self._event(writer, job)
+        quiet = self.loop.time()
+        while True:
+            offset, sent = await self._log_events(writer, path, offset, job["state"] in TERMINAL)
+            if job["state"] in TERMINAL:
+                break
+            seen = job["state"]
+            job = await self._until(job["id"], LOG_POLL, lambda j: j["state"] != seen)
+            if job["state"] != seen:
+                # Output written before the transition goes first
+                offset, _ = await self._log_events(writer, path, offset, job["state"] in TERMINAL)
+                await self._event(writer, job)
+                quiet = self.loop.time()
+            elif sent:
+                quiet = self.loop.time()
+            elif self.loop.time() - quiet >= SSE_PING:
+                writer.write(b": ping\n\n")
+                await writer.drain()
+                quiet = self.loop.time()
+
+    async def _event(self, writer: asyncio.StreamWriter, job: dict) -> None:
+        data = json.dumps(job, ensure_ascii=False)
+        writer.write(f"event: state\ndata: {data}\n\n".encode("utf-8"))
+        await writer.drain()
+
+    async def _log_events(self, writer: asyncio.StreamWriter, path: Optional[Path], offset: int,
+                          partial: bool) -> Tuple[int, bool]:
+        """Send the log from `offset` on; returns the new offset and whether anything was sent."""
+        sent = False
+        text, end = await self._blocking(read_log, path, offset, partial) if path else ("", offset)
+        while text:
+            data = "".join(f"data: {line}\n" for line in text.splitlines())
+            writer.write(f"id: {end}\nevent: log\n{data}\n".encode("utf-8"))
+            await writer.drain()
+            offset, sent = end, True
+            text, end = await self._blocking(read_log, path, offset, partial)
+        return offset, sent
+
+
+def start_http_server(config_path: Optional[str], host: str = "0.0.0.0", port: int = None) -> CodexServer:
     port = port or int(os.environ.get("CODEX_PORT", "8090"))
-    server = ThreadingHTTPServer((host, port), make_handler(config_path))
-    t = threading.Thread(target=server.serve_forever, daemon=True)
-    t.start()
-    return server
+    return CodexServer(make_runner(config_path).start(), host, port).start()
@@ -0,0 +1,190 @@
+from __future__ import annotations
+import json
+import os
+import re
+import threading
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from .git_utils import git
+
+# Per-file parse results are kept by blob hash, so only new or edited files are read again
+CACHE_FILE = "impact_cache.json"
+
+NAMESPACE = re.compile(r"^\s*namespace\s+([\w\\]+)\s*;", re.M)
+DECLARATION = re.compile(r"^\s*(?:(?:abstract|final|readonly)\s+)*(?:class|trait|interface|enum)\s+(\w+)", re.M)
+EXTENDS = re.compile(r"\bclass\s+\w+\s+extends\s+([\w\\]+)")
+IMPORT = re.compile(r"^\s*use\s+([\w\\]+)(?:\s*\{([^}]*)\})?(?:\s+as\s+(\w+))?\s*;", re.M)
+TRAIT_USE = re.compile(r"^\s+use\s+([\w\\]+(?:\s*,\s*[\w\\]+)*)\s*[;{]", re.M)
+QUALIFIED = re.compile(r"\\?\b((?:[A-Z]\w*\\)+[A-Z]\w*)")
+NAME = re.compile(r"\b([A-Z]\w*)\b")
+PROPERTY = re.compile(r"(?:public|protected|private)\s+(?:readonly\s+)?\??([\w\\]+)\s+\$(\w+)")
+THIS_PROPERTY = re.compile(r"\$this->(\w+)")
+COMMENT = re.compile(r"/\*.*?\*/|(?<![:\w])//[^\n]*|^\s*#[^\n]*", re.S | re.M)
+# Eloquent relations only load the related model when used; counting them links every model to every other
+RELATION = re.compile(
+    r"->(?:hasOne|hasMany|belongsTo|belongsToMany|hasOneThrough|hasManyThrough|morph\w*)\(\s*\\?[\w\\]+::class"
+)
+
+
+def resolver(source: str) -> Tuple[str, Dict[str, str], Callable[[str], str]]:
+    """(namespace, imported aliases, name -> fully qualified class name) for one PHP file."""
+    ns = NAMESPACE.search(source)
+    namespace = ns.group(1) if ns else ""
+    aliases: Dict[str, str] = {}
+    for m in IMPORT.finditer(source):
+        base, group, alias = m.group(1), m.group(2), m.group(3)
+        if group is not None:
+            for part in filter(None, (p.strip() for p in group.split(","))):
+                name, _, short = part.partition(" as ")
+                aliases[(short or name.split("\\")[-1]).strip()] = f"{base.rstrip(chr(92))}\\{name.strip()}"
+        else:
+            aliases[alias or base.split("\\")[-1]] = base
+
+    def resolve(name: str) -> str:
+        if name.startswith("\\"):
+            return name[1:]
+        head, _, rest = name.partition("\\")
+        if head in aliases:
+            return aliases[head] + (f"\\{rest}" if rest else "")
+        return f"{namespace}\\{name}" if namespace else name
+
+    return namespace, aliases, resolve
+
+
+def parse(source: str) -> Dict[str, object]:
+    """Class name, parent, traits, referenced classes and typed properties of one PHP file (regex level)."""
+    namespace, aliases, resolve = resolver(source)
+    decl = DECLARATION.search(source)
+    body = RELATION.sub("", IMPORT.sub("", COMMENT.sub("", source)))
+    refs = {aliases[n] for n in NAME.findall(body) if n in aliases}
+    refs |= {resolve(n) for n in NAME.findall(body) if n not in aliases}
+    refs |= {q if q.split("\\")[0] in ("App", "Tests", "Database") else resolve(q) for q in QUALIFIED.findall(body)}
+    parent = EXTENDS.search(source)
+    traits = [resolve(t.strip()) for m in TRAIT_USE.finditer(body) for t in m.group(1).split(",")]
+    return {
+        "class": f"{namespace}\\{decl.group(1)}" if decl and namespace else (decl.group(1) if decl else ""),
+        "parent": resolve(parent.group(1)) if parent else "",
+        "traits": traits,
+        "refs": sorted(refs),
+        "props": {name: resolve(kind) for kind, name in PROPERTY.findall(source) if kind[0].isupper()},
+        "uses_props": sorted(set(THIS_PROPERTY.findall(source))),
+    }
+
+
+def is_test(path: str) -> bool:
+    return path.startswith("tests/") and path.endswith("Test.php")
+
+
+class ImpactMap:
+    """Source file -> test file dependencies for a Laravel checkout.
+
+    A test depends on its own file, its traits and base classes, plus everything
+    reachable in app code from the classes it references directly or through
+    the base-class properties it uses (`$this->supplyOrderService`). Base
+    classes' own references are not followed: TestCase imports every service.
+    A coverage map (test path -> source paths) replaces the static guess for
+    the tests it lists.
+    """
+
+    def __init__(self, files: Dict[str, Dict[str, object]], coverage: Optional[Dict[str, List[str]]] = None):
+        self.files = files
+        self.coverage = coverage or {}
+        self.by_class = {info["class"]: path for path, info in files.items() if info["class"]}
+        self._reach: Dict[str, Set[str]] = {}
+
+    def _reachable(self, path: str) -> Set[str]:
+        """App files reachable from `path` through class references (memoized, iterative)."""
+        if path in self._reach:
+            return self._reach[path]
+        seen, stack = {path}, [path]
+        while stack:
+            info = self.files[stack.pop()]
+            for ref in info["refs"] + [info["parent"]] + info["traits"]:
+                dep = self.by_class.get(ref)
+                if dep and dep not in seen and not dep.startswith("tests/"):
+                    seen.add(dep)
+                    stack.append(dep)
+        self._reach[path] = seen
+        return seen
+
+    def _parts(self, test: str) -> tuple[List[str], List[str]]:
+        """(the test file and its traits, its base classes and their traits), all inside the repo."""
+        own: List[str] = []
+        bases: List[str] = []
+        todo = [(test, False)]
+        while todo:
+            path, is_base = todo.pop()
+            if path in own or path in bases:
+                continue
+            (bases if is_base else own).append(path)
+            info = self.files[path]
+            if info["parent"] in self.by_class:
+                todo.append((self.by_class[info["parent"]], True))
+            todo += [(self.by_class[t], is_base) for t in info["traits"] if t in self.by_class]
+        return own, bases
+
+    def dependencies(self, test: str) -> Set[str]:
+        own, bases = self._parts(test)
+        deps = set(own) | set(bases)
+        if test in self.coverage:
+            return deps | set(self.coverage[test])
+        props: Dict[str, str] = {}
+        for path in bases:
+            props.update(self.files[path]["props"])
+        starts: Set[str] = set()
+        for path in own:
+            info = self.files[path]
+            starts |= {self.by_class[r] for r in info["refs"] if r in self.by_class}
+            starts |= {self.by_class[props[p]] for p in info["uses_props"] if props.get(p) in self.by_class}
+        for start in starts:
+            if not start.startswith("tests/"):
+                deps |= self._reachable(start)
+        return deps
+
+    def impacted(self, changed: Iterable[str]) -> Optional[List[str]]:
+        """Tests affected by `changed` paths, or None when a change is outside what the map models."""
+        changed = set(changed)
+        if any(not (p.endswith(".php") and p.startswith(("app/", "tests/"))) for p in changed):
+            return None
+        tests = [p for p in self.files if is_test(p)]
+        return sorted(t for t in tests if changed & self.dependencies(t))
+
+
+_lock = threading.Lock()
+
+
+def build(repo_root: str, checkout: str, coverage_path: Optional[str] = None) -> ImpactMap:
+    """Map for `checkout` (the main repo or one of its worktrees); parse results are shared via repo_root."""
+    cache_path = Path(repo_root) / "codex" / CACHE_FILE
+    with _lock:
+        try:
+            cache = json.loads(cache_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            cache = {}
+    _, listing, _ = git(["ls-files", "-s", "--", "app/*.php", "tests/*.php"], checkout)
+    _, status, _ = git(["status", "--porcelain", "-uall", "--", "app", "tests"], checkout)
+    dirty = {line[3:].split(" -> ")[-1] for line in status.splitlines() if line[3:].endswith(".php")}
+    files: Dict[str, Dict[str, object]] = {}
+    used: Dict[str, Dict[str, object]] = {}
+    blobs = {}
+    for line in listing.splitlines():
+        meta, _, path = line.partition("\t")
+        blobs[path] = meta.split()[1]
+    for path in set(blobs) | dirty:
+        full = os.path.join(checkout, path)
+        if path in dirty or path not in blobs:
+            if os.path.exists(full):
+                files[path] = parse(Path(full).read_text(encoding="utf-8", errors="replace"))
+            continue
+        blob = blobs[path]
+        if blob not in cache:
+            cache[blob] = parse(Path(full).read_text(encoding="utf-8", errors="replace"))
+        files[path] = used[blob] = cache[blob]
+    with _lock:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        cache_path.write_text(json.dumps(used), encoding="utf-8")
+    coverage = None
+    if coverage_path and os.path.exists(os.path.join(checkout, coverage_path)):
+        coverage = json.loads(Path(checkout, coverage_path).read_text(encoding="utf-8"))
+    return ImpactMap(files, coverage)
@@ -0,0 +1,585 @@
+from __future__ import annotations
+import functools
+import hashlib
+import itertools
+import json
+import math
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from rich import print as rprint
+
+# queued -> running -> succeeded | failed | dead (retries used up or lease lost too often)
+TERMINAL = ("succeeded", "failed", "dead")
+
+# A worker must renew its lease within this many seconds or the job is handed to another one
+LEASE = float(os.environ.get("CODEX_JOB_LEASE", "60"))
+# Fallback wake-up for jobs queued by another process (same-process submits wake workers at once)
+POLL = float(os.environ.get("CODEX_QUEUE_POLL", "0.5"))
+RETRY_BACKOFF = float(os.environ.get("CODEX_JOB_RETRY_BACKOFF", "10"))
+# Most jobs waiting to run; past it, submits are refused until workers catch up
+MAX_QUEUED = int(os.environ.get("CODEX_MAX_QUEUED", "20"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    state TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+CREATE TABLE IF NOT EXISTS spans (
+    job_id TEXT NOT NULL,
+    attempt INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    parent INTEGER,
+    name TEXT NOT NULL,
+    start REAL NOT NULL,
+    seconds REAL NOT NULL,
+    attrs TEXT
+);
+CREATE INDEX IF NOT EXISTS spans_job ON spans (job_id);
+CREATE INDEX IF NOT EXISTS spans_start ON spans (start);
+"""
+
+# Added after the first release; applied to existing databases on open
+COLUMNS = {
+    "attempts": "INTEGER NOT NULL DEFAULT 0",
+    "max_attempts": "INTEGER NOT NULL DEFAULT 1",
+    "run_after": "REAL NOT NULL DEFAULT 0",
+    "lease_until": "REAL",
+    "worker": "TEXT",
+    "dedupe_key": "TEXT",
+    "stats": "TEXT",
+}
+
+INDEXES = """
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (state, run_after);
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_dedupe ON jobs (dedupe_key) WHERE state IN ('queued', 'running');
+"""
+
+
+def default_path(repo_root: str) -> str:
+    return os.environ.get("CODEX_JOBS_DB") or str(Path(repo_root) / "codex" / "jobs.db")
+
+
+_current = threading.local()
+# A job's helper threads (see in_job) share its stats dict, log file and trace
+_lock = threading.Lock()
+
+
+class Trace:
+    """The finished spans of one job attempt, from every thread working on it."""
+
+    def __init__(self):
+        self.spans: List[Dict[str, Any]] = []
+        self.ids = itertools.count(1)
+
+
+def count(name: str, amount: float = 1) -> None:
+    """Add to a counter of the job running in this thread, saved as the job's `stats`; no-op outside jobs."""
+    stats = getattr(_current, "stats", None)
+    if stats is not None:
+        with _lock:
+            stats[name] = round(stats.get(name, 0) + amount, 3)
+
+
+def log(text: str) -> None:
+    """Append command output to the log of the job running in this thread; no-op outside jobs."""
+    f = getattr(_current, "log", None)
+    if f is not None:
+        with _lock:
+            # Helper threads winding down after their job ended find the log closed
+            if not f.closed:
+                f.write(text)
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[Dict[str, Any]]:
+    """Time a stage or command of the job running in this thread; no-op outside jobs.
+
+    Spans opened inside are its children. The yielded dict takes more attributes (exit code,
+    cache hit) until the span ends; an exception is recorded as `error`.
+    """
+    trace, stack = getattr(_current, "trace", None), getattr(_current, "stack", None)
+    if trace is None:
+        yield attrs
+        return
+    with _lock:
+        record = {"id": next(trace.ids), "parent": stack[-1]["id"] if stack else None, "name": name,
+                  "start": time.time(), **attrs}
+    started = time.monotonic()
+    stack.append(record)
+    try:
+        yield record
+    except BaseException as e:
+        record["error"] = f"exit {e.code}" if isinstance(e, SystemExit) else type(e).__name__
+        raise
+    finally:
+        stack.pop()
+        record["seconds"] = round(time.monotonic() - started, 4)
+        with _lock:
+            trace.spans.append(record)
+
+
+def annotate(**attrs: Any) -> None:
+    """Add attributes to the innermost open span of this thread."""
+    stack = getattr(_current, "stack", None)
+    if stack:
+        stack[-1].update(attrs)
+
+
+def traced(name: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """Run the decorated function in a span; a bool result is recorded as `ok`."""
+    def decorate(fn: Callable[..., Any]) -> Callable[..., Any]:
+        @functools.wraps(fn)
+        def run(*args: Any, **kwargs: Any) -> Any:
+            with span(name) as record:
+                result = fn(*args, **kwargs)
+                if isinstance(result, bool):
+                    record["ok"] = result
+                return result
+        return run
+    return decorate
+
+
+def in_job(fn: Callable[..., Any]) -> Callable[..., Any]:
+    """`fn`, counting, logging and tracing into the calling thread's job when it runs on another thread."""
+    stats, f, trace = getattr(_current, "stats", None), getattr(_current, "log", None), getattr(_current, "trace", None)
+    stack = getattr(_current, "stack", None)
+    # Spans of the other thread nest under the span open here
+    parent = stack[-1:] if stack else []
+
+    def run(*args: Any, **kwargs: Any) -> Any:
+        _current.stats, _current.log, _current.trace, _current.stack = stats, f, trace, list(parent)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current.stats = _current.log = _current.trace = _current.stack = None
+    return run
+
+
+class QueueFull(Exception):
+    """The queue already holds `depth` jobs waiting to run; `retry_after` seconds is a fair time to try again."""
+
+    def __init__(self, depth: int, retry_after: int):
+        super().__init__(f"{depth} jobs queued; retry in {retry_after}s")
+        self.depth = depth
+        self.retry_after = retry_after
+
+
+def dedupe_key(kind: str, payload: Dict[str, Any]) -> str:
+    return hashlib.sha256(f"{kind}\0{json.dumps(payload, sort_keys=True)}".encode("utf-8")).hexdigest()
+
+
+class JobStore:
+    """SQLite job queue shared by the HTTP server, the CLI loop and their workers.
+
+    Jobs are claimed under a lease; a job whose lease runs out (its worker died)
+    is claimed again until it has used `max_attempts`, then dead-lettered.
+    Writers notify waiters in this process; other processes see changes on
+    their next poll.
+    """
+
+    def __init__(self, path: str):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        self.conn.executescript(SCHEMA)
+        have = {r["name"] for r in self.conn.execute("PRAGMA table_info(jobs)")}
+        for name, decl in COLUMNS.items():
+            if name not in have:
+                self.conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {decl}")
+        self.conn.executescript(INDEXES)
+        self.changed = threading.Condition()
+
+    def _row(self, row: Optional[sqlite3.Row]) -> Optional[Dict[str, Any]]:
+        if row is None:
+            return None
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        job["stats"] = json.loads(job["stats"]) if job.get("stats") else {}
+        return job
+
+    def create(self, kind: str, payload: Dict[str, Any], max_attempts: int = 1, limit: Optional[int] = None,
+               once: bool = False) -> Dict[str, Any]:
+        """Queue a job; an identical job that is still queued or running is returned instead.
+
+        With `once`, so is an identical job that already succeeded. With `limit`, a new job is refused
+        with QueueFull while that many jobs are queued.
+        """
+        job_id = f"job-{uuid.uuid4().hex[:16]}"
+        key = dedupe_key(kind, payload)
+        states = "'queued', 'running', 'succeeded'" if once else "'queued', 'running'"
+        with self.changed:
+            row = self.conn.execute(
+                f"SELECT * FROM jobs WHERE dedupe_key = ? AND state IN ({states}) ORDER BY created_at DESC LIMIT 1",
+                (key,),
+            ).fetchone()
+            if row is not None:
+                return self._row(row)
+            if limit is not None:
+                depth = self.conn.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()[0]
+                if depth >= limit:
+                    raise QueueFull(depth, self._retry_after())
+            try:
+                self.conn.execute(
+                    "INSERT INTO jobs (id, kind, state, payload, created_at, max_attempts, dedupe_key)"
+                    " VALUES (?, ?, 'queued', ?, ?, ?, ?)",
+                    (job_id, kind, json.dumps(payload, ensure_ascii=False), time.time(), max_attempts, key),
+                )
+            except sqlite3.IntegrityError:
+                # Queued by another process since the lookup above
+                row = self.conn.execute(
+                    "SELECT * FROM jobs WHERE dedupe_key = ? AND state IN ('queued', 'running')", (key,)
+                ).fetchone()
+                if row is not None:
+                    return self._row(row)
+                raise
+            self.changed.notify_all()
+        return self.get(job_id)
+
+    def _retry_after(self) -> int:
+        """Seconds until a queue slot is likely to free up: the mean run time of recent jobs.
+
+        The caller holds the lock.
+        """
+        mean = self.conn.execute(
+            "SELECT AVG(finished_at - started_at) FROM (SELECT started_at, finished_at FROM jobs"
+            " WHERE finished_at IS NOT NULL AND started_at IS NOT NULL ORDER BY finished_at DESC LIMIT 20)"
+        ).fetchone()[0]
+        return max(1, min(600, math.ceil(mean))) if mean is not None else 30
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self.changed:
+            row = self.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row(row)
+
+    def claim(self, kinds: Iterable[str], worker: str, exclusive: Iterable[str] = ()) -> Optional[Dict[str, Any]]:
+        """Lease the oldest ready job of `kinds`, or None.
+
+        Jobs of an `exclusive` kind are only handed out while no other exclusive
+        job holds a live lease, in any process.
+        """
+        kinds, exclusive = list(kinds), list(exclusive)
+        if not kinds:
+            return None
+        now = time.time()
+        marks = ",".join("?" * len(kinds))
+        with self.changed:
+            # Idle workers poll; only take the write lock when there is something to hand out
+            ready = self.conn.execute(
+                f"SELECT 1 FROM jobs WHERE (state = 'queued' AND run_after <= ? AND kind IN ({marks}))"
+                " OR (state = 'running' AND lease_until < ?) LIMIT 1",
+                (now, *kinds, now),
+            ).fetchone()
+            if ready is None:
+                return None
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Workers that stopped renewing: retry their job or dead-letter it
+                self.conn.execute(
+                    "UPDATE jobs SET state = CASE WHEN attempts >= max_attempts THEN 'dead' ELSE 'queued' END,"
+                    " error = 'lease expired (worker ' || COALESCE(worker, '?') || ')',"
+                    " finished_at = CASE WHEN attempts >= max_attempts THEN ? END,"
+                    " lease_until = NULL, worker = NULL"
+                    " WHERE state = 'running' AND lease_until < ?",
+                    (now, now),
+                )
+                sql = f"SELECT id, kind FROM jobs WHERE state = 'queued' AND run_after <= ? AND kind IN ({marks})"
+                args: list = [now, *kinds]
+                if exclusive:
+                    busy = self.conn.execute(
+                        f"SELECT 1 FROM jobs WHERE state = 'running' AND kind IN ({','.join('?' * len(exclusive))})",
+                        exclusive,
+                    ).fetchone()
+                    if busy:
+                        sql += f" AND kind NOT IN ({','.join('?' * len(exclusive))})"
+                        args += exclusive
+                row = self.conn.execute(sql + " ORDER BY created_at LIMIT 1", args).fetchone()
+                if row is not None:
+                    self.conn.execute(
+                        "UPDATE jobs SET state = 'running', attempts = attempts + 1, started_at = ?,"
+                        " lease_until = ?, worker = ? WHERE id = ?",
+                        (now, now + LEASE, worker, row["id"]),
+                    )
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            if row is None:
+                return None
+            self.changed.notify_all()
+        return self.get(row["id"])
+
+    def renew(self, job_ids: Iterable[str], worker: str) -> None:
+        job_ids = list(job_ids)
+        if not job_ids:
+            return
+        with self.changed:
+            self.conn.execute(
+                f"UPDATE jobs SET lease_until = ? WHERE worker = ? AND state = 'running'"
+                f" AND id IN ({','.join('?' * len(job_ids))})",
+                (time.time() + LEASE, worker, *job_ids),
+            )
+
+    def _finish(self, job_id: str, worker: str, sql: str, args: tuple, stats: Optional[dict]) -> None:
+        # Only the lease holder may settle a job; a worker that lost its lease is ignored
+        with self.changed:
+            self.conn.execute(
+                f"UPDATE jobs SET {sql}, stats = ?, lease_until = NULL"
+                " WHERE id = ? AND worker = ? AND state = 'running'",
+                (*args, json.dumps(stats) if stats else None, job_id, worker),
+            )
+            self.changed.notify_all()
+
+    def succeed(self, job_id: str, worker: str, result: Any, stats: Optional[dict] = None) -> None:
+        self._finish(
+            job_id, worker, "state = 'succeeded', result = ?, finished_at = ?",
+            (json.dumps(result, ensure_ascii=False), time.time()), stats,
+        )
+
+    def fail(self, job_id: str, worker: str, error: str, retry: bool = False, stats: Optional[dict] = None) -> None:
+        """Fail the attempt; retryable errors go back to the queue with backoff until attempts run out."""
+        now = time.time()
+        self._finish(
+            job_id, worker,
+            "error = ?, state = CASE WHEN ? AND attempts < max_attempts THEN 'queued'"
+            " WHEN ? THEN 'dead' ELSE 'failed' END,"
+            " run_after = ? * (1 << (attempts - 1)) + ?,"
+            " finished_at = CASE WHEN ? AND attempts < max_attempts THEN NULL ELSE ? END, worker = NULL",
+            (error, retry, retry, RETRY_BACKOFF, now, retry, now), stats,
+        )
+
+    def wait(self, job_id: str, timeout: float, state: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Block until the job leaves `state` (default: its current state) or reaches a terminal one."""
+        deadline = time.monotonic() + timeout
+        job = self.get(job_id)
+        if job is None:
+            return None
+        state = state or job["state"]
+        while job["state"] == state and job["state"] not in TERMINAL:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            with self.changed:
+                self.changed.wait(min(remaining, 1.0))
+            job = self.get(job_id)
+        return job
+
+    def counts(self) -> Dict[str, int]:
+        with self.changed:
+            rows = self.conn.execute("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state").fetchall()
+        return {r["state"]: r["n"] for r in rows}
+
+    def add_spans(self, job_id: str, attempt: int, spans: List[Dict[str, Any]]) -> None:
+        core = ("id", "parent", "name", "start", "seconds")
+        rows = [(job_id, attempt, *(sp[k] for k in core), json.dumps({k: v for k, v in sp.items() if k not in core},
+                                                                    ensure_ascii=False, default=str))
+                for sp in spans]
+        with self.changed:
+            self.conn.execute("BEGIN")
+            self.conn.executemany("INSERT INTO spans (job_id, attempt, id, parent, name, start, seconds, attrs)"
+                                  " VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.conn.execute("COMMIT")
+
+    def timeline(self, job_id: str) -> List[Dict[str, Any]]:
+        """A job's spans in start order, each with its `offset` from the job's first span and its nesting `depth`."""
+        with self.changed:
+            rows = self.conn.execute("SELECT * FROM spans WHERE job_id = ? ORDER BY attempt, start, id",
+                                     (job_id,)).fetchall()
+        spans, depth = [], {}
+        origin = rows[0]["start"] if rows else 0.0
+        for r in rows:
+            key = (r["attempt"], r["id"])
+            depth[key] = depth.get((r["attempt"], r["parent"]), -1) + 1 if r["parent"] else 0
+            spans.append({"attempt": r["attempt"], "id": r["id"], "parent": r["parent"], "name": r["name"],
+                          "offset": round(r["start"] - origin, 4), "seconds": r["seconds"], "depth": depth[key],
+                          **json.loads(r["attrs"] or "{}")})
+        return spans
+
+    def span_stats(self, since: float, slowest: int = 10) -> Dict[str, Any]:
+        """Per span name since `since`: count, total and percentile seconds, most total time first.
+
+        Also the `slowest` single spans.
+        """
+        with self.changed:
+            rows = self.conn.execute("SELECT name, seconds, attrs FROM spans WHERE start >= ?", (since,)).fetchall()
+            top = self.conn.execute("SELECT job_id, name, start, seconds, attrs FROM spans WHERE start >= ?"
+                                    " ORDER BY seconds DESC LIMIT ?", (since, slowest)).fetchall()
+        by_name: Dict[str, List[float]] = {}
+        errors: Dict[str, int] = {}
+        for r in rows:
+            by_name.setdefault(r["name"], []).append(r["seconds"])
+            attrs = json.loads(r["attrs"] or "{}")
+            # Raised, exited non-zero, or returned False
+            if "error" in attrs or attrs.get("exit") or attrs.get("ok") is False:
+                errors[r["name"]] = errors.get(r["name"], 0) + 1
+        stages = []
+        for name, seconds in by_name.items():
+            seconds.sort()
+
+            def pct(p: float) -> float:
+                return seconds[min(len(seconds) - 1, int(p * len(seconds)))]
+            stages.append({"name": name, "count": len(seconds), "total": round(sum(seconds), 3),
+                           "p50": pct(0.5), "p90": pct(0.9), "p99": pct(0.99), "max": seconds[-1],
+                           "errors": errors.get(name, 0)})
+        stages.sort(key=lambda st: -st["total"])
+        return {
+            "since": since,
+            "stages": stages,
+            "slowest": [{"job_id": r["job_id"], "name": r["name"], "start": r["start"], "seconds": r["seconds"],
+                         **json.loads(r["attrs"] or "{}")} for r in top],
+        }
+
+    def log_path(self, job_id: str) -> Path:
+        """Where a job's command output is written as it runs (logs/ next to the database)."""
+        return Path(self.path).parent / "logs" / f"{job_id}.log"
+
+    def purge(self, older_than: float, keep: Iterable[str] = ()) -> int:
+        """Delete jobs finished more than `older_than` seconds ago, with their spans and logs.
+
+        Succeeded jobs of `keep` kinds lose only their spans and log: their row is what stops
+        create(once=True) from running them again.
+        """
+        keep = list(keep)
+        where, cutoff = "state IN ('succeeded', 'failed', 'dead') AND finished_at < ?", time.time() - older_than
+        kept = f"state = 'succeeded' AND kind IN ({','.join('?' * len(keep))})" if keep else "0"
+        with self.changed:
+            ids = [r["id"] for r in self.conn.execute(f"SELECT id FROM jobs WHERE {where}", (cutoff,))]
+            deleted = self.conn.execute(f"DELETE FROM jobs WHERE {where} AND NOT ({kept})", (cutoff, *keep)).rowcount
+            self.conn.executemany("DELETE FROM spans WHERE job_id = ?", [(i,) for i in ids])
+        for job_id in ids:
+            self.log_path(job_id).unlink(missing_ok=True)
+        return deleted
+
+
+class JobRunner:
+    """Worker threads over a JobStore.
+
+    Several runners (the HTTP server and `run-loop`) may share one database.
+    Jobs of `serial` kinds run one at a time across all of them. A job of a
+    `once` kind that succeeded is returned for the same payload, not run again.
+    """
+
+    def __init__(
+        self,
+        store: JobStore,
+        handlers: Dict[str, Callable[[Dict[str, Any]], Any]],
+        serial: tuple,
+        attempts: Optional[Dict[str, int]] = None,
+        once: tuple = (),
+    ):
+        self.store = store
+        self.handlers = handlers
+        self.serial = serial
+        self.attempts = attempts or {}
+        self.once = once
+        self.worker = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.parallel = int(os.environ.get("CODEX_WORKERS", "2"))
+        self.running: set = set()
+        self.stopping = threading.Event()
+        self.threads: list = []
+
+    def submit(self, kind: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Queue a job (see JobStore.create); raises QueueFull when MAX_QUEUED jobs are waiting."""
+        return self.store.create(kind, payload, self.attempts.get(kind, 1), limit=MAX_QUEUED, once=kind in self.once)
+
+    def start(self) -> "JobRunner":
+        days = float(os.environ.get("CODEX_JOB_RETENTION_DAYS", "14"))
+        self.store.purge(days * 86400, keep=self.once)
+        parallel_kinds = [k for k in self.handlers if k not in self.serial]
+        serial_kinds = [k for k in self.handlers if k in self.serial]
+        loops = [(parallel_kinds, ())] * (self.parallel if parallel_kinds else 0)
+        loops += [(serial_kinds, serial_kinds)] if serial_kinds else []
+        for i, (kinds, exclusive) in enumerate(loops):
+            t = threading.Thread(target=self._work, args=(kinds, exclusive), name=f"codex-job-{i}", daemon=True)
+            t.start()
+            self.threads.append(t)
+        t = threading.Thread(target=self._heartbeat, name="codex-lease", daemon=True)
+        t.start()
+        self.threads.append(t)
+        return self
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self.stopping.set()
+        with self.store.changed:
+            self.store.changed.notify_all()
+        for t in self.threads:
+            t.join(timeout)
+
+    def _work(self, kinds: list, exclusive: list) -> None:
+        while not self.stopping.is_set():
+            try:
+                job = self.store.claim(kinds, self.worker, exclusive)
+            except sqlite3.Error as e:
+                rprint(f"[red]Codex queue claim failed: {e}[/red]")
+                job = None
+            if job is None:
+                with self.store.changed:
+                    self.store.changed.wait(POLL)
+                continue
+            self._run(job)
+
+    def _run(self, job: Dict[str, Any]) -> None:
+        job_id, kind = job["id"], job["kind"]
+        self.running.add(job_id)
+        _current.stats = stats = {}
+        _current.trace = trace = Trace()
+        _current.stack = []
+        path = self.store.log_path(job_id)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Line-buffered, so the HTTP server can tail it while the job runs
+        _current.log = path.open("a", encoding="utf-8", errors="replace", buffering=1)
+        if job["attempts"] > 1:
+            log(f"--- attempt {job['attempts']} ---\n")
+        settle: Callable[[], None]
+        try:
+            with span(kind):
+                result = self.handlers[kind](job["payload"])
+        except SystemExit as e:
+            # The agent steps exit with a code or message when the change itself is rejected; not retried
+            error = str(e.code) if not isinstance(e.code, int) else f"exit code {e.code}"
+            settle = functools.partial(self.store.fail, job_id, self.worker, error, stats=stats)
+        except Exception as e:
+            rprint(f"[red]Codex job {job_id} ({kind}) attempt {job['attempts']} failed: {e}[/red]")
+            settle = functools.partial(self.store.fail, job_id, self.worker, f"{type(e).__name__}: {e}", retry=True,
+                                       stats=stats)
+        else:
+            settle = functools.partial(self.store.succeed, job_id, self.worker, result, stats)
+        finally:
+            with _lock:
+                _current.log.close()
+            _current.stats = _current.log = _current.trace = _current.stack = None
+        # Spans are saved first, so the timeline is complete once the job is seen to end
+        try:
+            self.store.add_spans(job_id, job["attempts"], trace.spans)
+        except sqlite3.Error as e:
+            rprint(f"[red]Codex job {job_id} spans not saved: {e}[/red]")
+        try:
+            settle()
+        finally:
+            self.running.discard(job_id)
+
+    def _heartbeat(self) -> None:
+        while not self.stopping.wait(LEASE / 3):
+            try:
+                self.store.renew(list(self.running), self.worker)
+            except sqlite3.Error as e:
+                rprint(f"[red]Codex lease renewal failed: {e}[/red]")
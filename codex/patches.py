@@ -0,0 +1,96 @@
+from __future__ import annotations
+import fnmatch
+import re
+from typing import Dict, List, Tuple
+
+from .git_utils import git
+
+# `diff --git a/<old> b/<new>`, or a ---/+++ pair (a lone "--- " may be a removed "-- " line);
+# /dev/null stands for "no file"
+FILE_HEADER = re.compile(r"^(?:diff --git a/(\S+) b/(\S+)|--- (?:a/)?(\S+).*\n\+\+\+ (?:b/)?(\S+))", re.M)
+HUNK = re.compile(r"^@@ -(\d+)(?:,\d+)? \+\d+(?:,\d+)? @@.*$", re.M)
+FAILED_AT = re.compile(r"^error: patch failed: (.+):(\d+)$")
+APPLY = ["apply", "--whitespace=fix"]
+
+
+def touched_paths(diff: str) -> List[str]:
+    """Every path a diff creates, modifies, deletes or renames, from its headers."""
+    paths = {p for m in FILE_HEADER.finditer(diff) for p in m.groups() if p and p != "/dev/null"}
+    return sorted(paths)
+
+
+def policy_errors(diffs: List[Dict], protected: List[str], allowed: List[str]) -> List[str]:
+    """Protected or not-allowed paths, both the declared `path` and those in the diff headers."""
+    errors: List[str] = []
+    for d in diffs:
+        paths = set(touched_paths(d.get("unified_diff") or ""))
+        if (d.get("path") or "").strip():
+            paths.add(d["path"].strip())
+        for path in sorted(paths):
+            if any(fnmatch.fnmatch(path, pat) for pat in protected):
+                errors.append(f"{path}: protected path")
+            elif allowed and not any(fnmatch.fnmatch(path, pat) for pat in allowed):
+                errors.append(f"{path}: not in allow_paths")
+    return errors
+
+
+def _hunks(patch: str) -> Dict[Tuple[str, int], str]:
+    """(path, old start line) -> "hunk #n (@@ ... @@)" for every hunk in a patch."""
+    marks = sorted([(m.start(), "file", m) for m in FILE_HEADER.finditer(patch)]
+                   + [(m.start(), "hunk", m) for m in HUNK.finditer(patch)], key=lambda mark: mark[0])
+    hunks: Dict[Tuple[str, int], str] = {}
+    path, n = "", 0
+    for _, kind, m in marks:
+        if kind == "file":
+            # The new name for a rename or a new file, the old one for a deletion
+            path, n = next(p for p in reversed(m.groups()) if p and p != "/dev/null"), 0
+            continue
+        n += 1
+        hunks[(path, int(m.group(1)))] = f"hunk #{n} ({m.group(0).split(' @@')[0]} @@)"
+    return hunks
+
+
+def check(cwd: str, patch: str) -> List[str]:
+    """Dry-run the whole patch against `cwd`; one message per failing hunk or file."""
+    code, out, err = git([*APPLY, "--check", "--verbose", "-"], cwd, input=patch)
+    if code == 0:
+        return []
+    hunks = _hunks(patch)
+    errors: List[str] = []
+    for line in (out + err).splitlines():
+        failed = FAILED_AT.match(line)
+        if failed:
+            path, start = failed.group(1), int(failed.group(2))
+            errors.append(f"{path}: {hunks.get((path, start), f'hunk at line {start}')} does not apply")
+        elif line.startswith("error: ") and not line.endswith("patch does not apply") \
+                and not line.startswith("error: while searching for"):
+            errors.append(line[len("error: "):])
+    return errors or [(err or out).strip() or "git apply --check failed"]
+
+
+def dry_run(cwd: str, diffs: List[Dict], protected: List[str], allowed: List[str]) -> List[str]:
+    """Why `apply` would refuse these diffs against `cwd` (empty if it would not); changes nothing."""
+    diffs = [d for d in diffs if (d.get("unified_diff") or "").strip()]
+    return policy_errors(diffs, protected, allowed) or (check(cwd, _combine(diffs)) if diffs else [])
+
+
+def _combine(diffs: List[Dict]) -> str:
+    # Each diff needs its final newline, which the AI response may have trimmed
+    return "".join(d["unified_diff"].lstrip().rstrip("\n") + "\n" for d in diffs)
+
+
+def apply(cwd: str, diffs: List[Dict], protected: List[str], allowed: List[str]) -> List[str]:
+    """Apply all diffs as one patch, or none of them; returns the reasons when nothing was applied.
+
+    Paths are checked against the policy first, then the combined patch is
+    dry-run, then applied with a single `git apply` (which is all-or-nothing).
+    Patches go over stdin, so concurrent jobs share no temp file.
+    """
+    diffs = [d for d in diffs if (d.get("unified_diff") or "").strip()]
+    if not diffs:
+        return []
+    errors = dry_run(cwd, diffs, protected, allowed)
+    if errors:
+        return errors
+    code, out, err = git([*APPLY, "-"], cwd, input=_combine(diffs))
+    return [] if code == 0 else [(err or out).strip()]
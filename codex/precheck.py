@@ -0,0 +1,199 @@
+from __future__ import annotations
+import json
+import os
+import re
+import shlex
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .git_utils import git
+from .impact import COMMENT, IMPORT, resolver
+from .jobs import count
+from .testcache import ResultCache, result_key
+
+# Where code names a class: new X, X::, extends X, instanceof X, catch (X
+CLASS_USE = re.compile(r"\b(?:new|extends|instanceof)\s+(\\?[A-Z][\w\\]*)|\bcatch\s*\(\s*(\\?[A-Z][\w\\]*)"
+                       r"|(?<![\w\\$>])(\\?[A-Z][\w\\]*)::")
+IMPLEMENTS = re.compile(r"\bimplements\s+([\w\\\s,]+?)\s*\{")
+DECLARES = re.compile(r"^\s*(?:(?:abstract|final|readonly)\s+)*(?:class|trait|interface|enum)\s+(\w+)", re.M)
+# Lines of a failing tool's output kept per file
+MESSAGE_LINES = 5
+
+Runner = Callable[[List[str]], Tuple[int, str, str]]
+
+
+def psr4(checkout: str) -> Dict[str, str]:
+    """Namespace prefix -> directory, from composer.json's autoload and autoload-dev."""
+    try:
+        composer = json.loads(Path(checkout, "composer.json").read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+    roots: Dict[str, str] = {}
+    for section in ("autoload", "autoload-dev"):
+        for prefix, dirs in ((composer.get(section) or {}).get("psr-4") or {}).items():
+            for d in [dirs] if isinstance(dirs, str) else dirs:
+                roots[prefix] = d.rstrip("/") + "/"
+    return roots
+
+
+def class_path(name: str, roots: Dict[str, str]) -> Optional[str]:
+    """Where PSR-4 expects class `name`, or None outside the project's namespaces."""
+    for prefix, directory in sorted(roots.items(), key=lambda r: -len(r[0])):
+        if name.startswith(prefix):
+            return directory + name[len(prefix):].replace("\\", "/") + ".php"
+    return None
+
+
+def _problems(source: str, path: str, checkout: str, roots: Dict[str, str]) -> Dict[str, str]:
+    """Class resolution problems in one file's source: {what: message}."""
+    # Blank out comments but keep their newlines, so line numbers stay right
+    code = COMMENT.sub(lambda m: "\n" * m.group(0).count("\n"), source)
+    namespace, _, resolve = resolver(code)
+    problems: Dict[str, str] = {}
+    declared = DECLARES.search(code)
+    if declared and any(path.startswith(d) for d in roots.values()):
+        name = f"{namespace}\\{declared.group(1)}" if namespace else declared.group(1)
+        expected = class_path(name, roots)
+        if expected and expected != path:
+            problems[f"declares {name}"] = f"{path}: declares {name}, which PSR-4 autoloads from {expected}"
+    # (fully qualified name, offset): imports above the class (below it, `use` pulls in traits), then code
+    top = declared.start() if declared else len(code)
+    names: List[Tuple[str, int]] = []
+    for m in IMPORT.finditer(code, 0, top):
+        base = m.group(1).rstrip("\\")
+        if m.group(2) is None:
+            names.append((base, m.start()))
+        else:
+            names += [(f"{base}\\{part.split(' as ')[0].strip()}", m.start()) for part in m.group(2).split(",") if part.strip()]
+    body = IMPORT.sub(lambda m: "\n" * m.group(0).count("\n"), code[:top]) + code[top:]
+    names += [(resolve(next(g for g in m.groups() if g)), m.start()) for m in CLASS_USE.finditer(body)]
+    names += [(resolve(n.strip()), m.start()) for m in IMPLEMENTS.finditer(body) for n in m.group(1).split(",")]
+    for name, offset in names:
+        expected = class_path(name, roots)
+        if not expected or name in problems:
+            continue
+        # An import may name a namespace (`use ...\Resources\UserResource\Pages;`)
+        if os.path.exists(os.path.join(checkout, expected)) or os.path.isdir(os.path.join(checkout, expected[:-4])):
+            continue
+        line = code.count("\n", 0, offset) + 1
+        problems[name] = f"{path}:{line}: class {name} not found (PSR-4 expects {expected})"
+    return problems
+
+
+def autoload_errors(checkout: str, changed: List[str]) -> List[str]:
+    """Class resolution as composer's PSR-4 autoloader will do it, for the changed files.
+
+    Reports what the change breaks: a class declared where PSR-4 will not
+    find it, an import or use of a project class that does not exist, and
+    references left to a class whose file was removed or renamed. Problems
+    the file already had at HEAD are not reported.
+    """
+    roots = psr4(checkout)
+    errors: List[str] = []
+    for path in changed if roots else []:
+        full = os.path.join(checkout, path)
+        if not path.endswith(".php"):
+            continue
+        if not os.path.exists(full):
+            errors += _dangling(checkout, path, roots)
+            continue
+        problems = _problems(Path(full).read_text(encoding="utf-8", errors="replace"), path, checkout, roots)
+        if problems:
+            code, before, _ = git(["show", f"HEAD:{path}"], checkout)
+            if code == 0:
+                for known in _problems(before, path, checkout, roots):
+                    problems.pop(known, None)
+        errors += problems.values()
+    return errors
+
+
+def _dangling(checkout: str, path: str, roots: Dict[str, str]) -> List[str]:
+    """References to the class a removed file used to hold."""
+    for prefix, directory in roots.items():
+        if path.startswith(directory):
+            name = prefix + path[len(directory):-len(".php")].replace("/", "\\")
+            break
+    else:
+        return []
+    _, out, _ = git(["grep", "-n", "-F", "-w", "-e", name, "--", "*.php"], checkout)
+    return [f"{line.split(':')[0]}:{line.split(':')[1]}: uses {name}, but {path} is gone"
+            for line in out.splitlines()[:MESSAGE_LINES]]
+
+
+def blobs(checkout: str, paths: List[str]) -> Dict[str, str]:
+    """Blob hash of each file's current content."""
+    if not paths:
+        return {}
+    code, out, _ = git(["hash-object", "--", *paths], checkout)
+    return dict(zip(paths, out.split())) if code == 0 else {}
+
+
+def _fill(command: List[str], placeholder: str, paths: List[str]) -> List[str]:
+    out: List[str] = []
+    for part in command:
+        if part == placeholder:
+            out += paths
+        else:
+            out.append(part.replace(placeholder, " ".join(shlex.quote(p) for p in paths)))
+    return out
+
+
+def _message(path: str, out: str, err: str) -> str:
+    lines = [line for line in (out + "\n" + err).splitlines() if line.strip()]
+    wanted = [line for line in lines if "error" in line.lower()] or lines
+    return f"{path}: " + "\n  ".join(wanted[:MESSAGE_LINES])
+
+
+def _cached(cache: Optional[ResultCache], key: str, run: Callable[[], Tuple[bool, str]], blob: str) -> Tuple[bool, str]:
+    hit = cache.get(key) if cache else None
+    if hit:
+        count("precheck_cache_hits")
+        return hit["passed"], hit["output"]
+    started = time.monotonic()
+    passed, message = run()
+    if cache:
+        cache.put(key, blob, passed, time.monotonic() - started, message)
+    return passed, message
+
+
+def run(checkout: str, settings: Dict, changed: List[str], runner: Runner,
+        cache: Optional[ResultCache] = None) -> List[str]:
+    """Syntax, class resolution and static analysis on the changed PHP files; one message per problem.
+
+    settings (config.yml `precheck`):
+      syntax:   command linting one file, "{file}" (e.g. php -l {file}); files run in parallel
+      jobs:     parallel syntax checks (4)
+      autoload: PSR-4 class resolution check (true)
+      static:   static analysis command over "{files}", run only when the other checks pass
+    Syntax and static results are cached by blob hash, so unchanged files are not checked twice.
+    """
+    files = [p for p in changed if p.endswith(".php") and os.path.exists(os.path.join(checkout, p))]
+    hashes = blobs(checkout, files)
+    errors: List[str] = []
+
+    syntax = settings.get("syntax")
+    if syntax and files:
+        def lint(path: str) -> Tuple[bool, str]:
+            def call() -> Tuple[bool, str]:
+                code, out, err = runner(_fill(syntax, "{file}", [path]))
+                return code == 0, "" if code == 0 else _message(path, out, err)
+            return _cached(cache, result_key(hashes.get(path, ""), syntax, "syntax"), call, hashes.get(path, ""))
+
+        with ThreadPoolExecutor(max_workers=max(1, int(settings.get("jobs", 4)))) as pool:
+            errors += [message for passed, message in pool.map(lint, files) if not passed]
+
+    if settings.get("autoload", True):
+        errors += autoload_errors(checkout, changed)
+
+    static = settings.get("static")
+    if static and files and not errors:
+        def analyse() -> Tuple[bool, str]:
+            code, out, err = runner(_fill(static, "{files}", files))
+            return code == 0, "" if code == 0 else _message("static analysis", out, err)
+        blob = ",".join(hashes.get(p, "") for p in files)
+        passed, message = _cached(cache, result_key(blob, static, "static"), analyse, blob)
+        if not passed:
+            errors.append(message)
+    return errors
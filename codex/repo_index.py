@@ -0,0 +1,194 @@
+from __future__ import annotations
+import os
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from .git_utils import git
+from .jobs import count
+
+# What gets indexed; chunks are stored once per blob, so unchanged files are never re-read
+ROOTS = ("app", "routes", "tests")
+# Longest chunk, in lines; longer methods are cut into windows of this size
+CHUNK_LINES = int(os.environ.get("CODEX_INDEX_CHUNK_LINES", "80"))
+# Prompt tokens spent on snippets (4 chars per token for code, conservatively 3)
+BUDGET = int(os.environ.get("CODEX_CONTEXT_TOKENS", "6000"))
+# Chunks from a single file, so one big class does not take the whole budget
+PER_FILE = 3
+# Blobs not seen in any checkout for this long are dropped
+RETENTION = 14 * 86400
+
+METHOD = re.compile(r"^\s*(?:(?:public|protected|private|static|abstract|final)\s+)*function\s+(\w+)")
+CLASS = re.compile(r"^\s*(?:(?:abstract|final|readonly)\s+)*(?:class|trait|interface|enum)\s+(\w+)")
+WORD = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|\d+")
+CAMEL = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+STOP = {"the", "and", "for", "this", "that", "with", "php", "return", "function", "public", "private",
+        "protected", "new", "use", "namespace", "class", "null", "true", "false", "array", "string", "int",
+        "void", "self", "static", "var", "let", "from", "into"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (blob TEXT PRIMARY KEY, used_at REAL NOT NULL);
+CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5(
+    blob UNINDEXED, path, symbol, terms, start UNINDEXED, end UNINDEXED, text UNINDEXED,
+    tokenize = 'porter unicode61'
+);
+"""
+
+
+def terms(text: str) -> List[str]:
+    """Lowercase search terms: every identifier, plus its camelCase/snake_case parts."""
+    out: List[str] = []
+    for word in WORD.findall(text):
+        parts = [p for piece in word.split("_") for p in CAMEL.findall(piece)]
+        for term in {word, *parts}:
+            term = term.lower()
+            if len(term) > 2 and term not in STOP:
+                out.append(term)
+    return out
+
+
+def tokens(text: str) -> int:
+    return len(text) // 3 + 1
+
+
+def chunks(path: str, source: str) -> List[Tuple[str, int, int]]:
+    """(symbol, first line, last line) pieces of a PHP file: the class head, then each method with its docblock."""
+    lines = source.splitlines()
+    klass = next((m.group(1) for m in map(CLASS.match, lines) if m), "")
+    starts: List[Tuple[int, str]] = []
+    for i, line in enumerate(lines):
+        m = METHOD.match(line)
+        if m:
+            # Take docblock, comments and attributes above the method along
+            j = i
+            while j > 0 and lines[j - 1].strip().startswith(("*", "/*", "//", "#[")):
+                j -= 1
+            starts.append((j, f"{klass}::{m.group(1)}" if klass else m.group(1)))
+    pieces: List[Tuple[str, int, int]] = []
+    bounds = [(0, klass or path)] + starts
+    for n, (start, symbol) in enumerate(bounds):
+        end = bounds[n + 1][0] if n + 1 < len(bounds) else len(lines)
+        for window in range(start, end, CHUNK_LINES):
+            last = min(end, window + CHUNK_LINES)
+            if any(line.strip() for line in lines[window:last]):
+                pieces.append((symbol, window + 1, last))
+    return pieces
+
+
+class RepoIndex:
+    """Full-text index of code chunks by blob SHA, ranked with SQLite FTS5's BM25."""
+
+    def __init__(self, path: str):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        self.conn.executescript(SCHEMA)
+
+    def files(self, checkout: str) -> Dict[str, str]:
+        """path -> blob for the indexed roots of a checkout, uncommitted edits included."""
+        _, listing, _ = git(["ls-files", "-s", "--", *ROOTS], checkout)
+        found: Dict[str, str] = {}
+        for line in listing.splitlines():
+            meta, _, path = line.partition("\t")
+            if path.endswith(".php"):
+                found[path] = meta.split()[1]
+        _, status, _ = git(["status", "--porcelain", "-uall", "--", *ROOTS], checkout)
+        dirty = [p for p in (line[3:].split(" -> ")[-1].strip('"') for line in status.splitlines())
+                 if p.endswith(".php")]
+        for path in dirty:
+            found.pop(path, None)
+        dirty = [p for p in dirty if os.path.exists(os.path.join(checkout, p))]
+        if dirty:
+            _, out, _ = git(["hash-object", "--", *dirty], checkout)
+            found.update(zip(dirty, out.split()))
+        return found
+
+    def update(self, checkout: str) -> Dict[str, str]:
+        """Index the checkout's blobs that are not indexed yet; returns its path -> blob map."""
+        started = time.monotonic()
+        files = self.files(checkout)
+        now = time.time()
+        with self.lock:
+            known = {row[0] for row in self.conn.execute("SELECT blob FROM blobs")}
+            new = {path: blob for path, blob in files.items() if blob not in known}
+            self.conn.execute("BEGIN")
+            try:
+                for path, blob in new.items():
+                    source = Path(checkout, path).read_text(encoding="utf-8", errors="replace")
+                    lines = source.splitlines()
+                    for symbol, start, end in chunks(path, source):
+                        text = "\n".join(lines[start - 1:end])
+                        self.conn.execute(
+                            "INSERT INTO chunks (blob, path, symbol, terms, start, end, text) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (blob, " ".join(terms(path)), " ".join(terms(symbol)), " ".join(terms(text)), start, end, text),
+                        )
+                    known.add(blob)
+                self.conn.executemany("INSERT OR REPLACE INTO blobs (blob, used_at) VALUES (?, ?)",
+                                      [(blob, now) for blob in set(files.values())])
+                stale = [row[0] for row in self.conn.execute("SELECT blob FROM blobs WHERE used_at < ?",
+                                                             (now - RETENTION,))]
+                for blob in stale:
+                    self.conn.execute("DELETE FROM chunks WHERE blob = ?", (blob,))
+                    self.conn.execute("DELETE FROM blobs WHERE blob = ?", (blob,))
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        count("index_files_added", len(new))
+        count("index_seconds", time.monotonic() - started)
+        return files
+
+    def search(self, checkout: str, query: str, budget: int = BUDGET) -> List[Dict[str, object]]:
+        """The chunks of `checkout` that best match `query`, best first, within `budget` tokens.
+
+        Paths or class names spelled out in the query rank first.
+        """
+        files = self.update(checkout)
+        by_blob: Dict[str, List[str]] = {}
+        for path, blob in files.items():
+            by_blob.setdefault(blob, []).append(path)
+        words = list(dict.fromkeys(terms(query)))
+        if not words:
+            return []
+        match = " OR ".join(f'"{w}"' for w in words)
+        mentioned = {p for p in files if p in query or Path(p).stem in query}
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT blob, symbol, start, end, text, bm25(chunks, 0, 4.0, 6.0, 1.0) AS score"
+                " FROM chunks WHERE chunks MATCH ? ORDER BY score LIMIT 400",
+                (match,),
+            ).fetchall()
+        ranked = []
+        for blob, symbol, start, end, text, score in rows:
+            for path in by_blob.get(blob, []):
+                ranked.append((path not in mentioned, score, path, start, end, text))
+        ranked.sort(key=lambda r: (r[0], r[1]))
+        picked: List[Dict[str, object]] = []
+        used, per_file = 0, {}
+        for _, _, path, start, end, text in ranked:
+            cost = tokens(text)
+            if used + cost > budget or per_file.get(path, 0) >= PER_FILE:
+                continue
+            used += cost
+            per_file[path] = per_file.get(path, 0) + 1
+            picked.append({"path": path, "lines": f"{start}-{end}", "code": text})
+        count("context_snippets", len(picked))
+        count("context_tokens", used)
+        return picked
+
+
+_indexes: Dict[str, RepoIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def index_for(repo_root: str) -> RepoIndex:
+    path = os.environ.get("CODEX_INDEX_DB") or str(Path(repo_root) / "codex" / "repo_index.db")
+    with _indexes_lock:
+        if path not in _indexes:
+            _indexes[path] = RepoIndex(path)
+        return _indexes[path]
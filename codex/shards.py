@@ -0,0 +1,172 @@
+from __future__ import annotations
+import json
+import os
+import queue
+import signal
+import subprocess
+import threading
+import time
+import xml.etree.ElementTree as ET
+from collections import deque
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .executor import CANCEL_GRACE, CANCEL_POLL, CANCELLED, MAX_LINE, TIMEOUT, cancel_event
+from .git_utils import git
+from .impact import is_test
+
+# Seconds per test file from earlier sharded runs, used to balance the next split
+DURATIONS_FILE = "test_durations.json"
+# Where shards write their JUnit reports, relative to the checkout (ignored by git)
+JUNIT_DIR = "codex/junit"
+# Lines of output kept per shard for the failure report and the result cache
+TAIL_LINES = 200
+
+_lock = threading.Lock()
+
+
+def test_files(checkout: str) -> List[str]:
+    """Test files in the checkout, tracked or not (ignored files excluded)."""
+    _, out, _ = git(["ls-files", "--cached", "--others", "--exclude-standard", "--", "tests"], checkout)
+    return sorted({p for p in out.splitlines() if is_test(p) and os.path.exists(os.path.join(checkout, p))})
+
+
+def load_durations(repo_root: str) -> Dict[str, float]:
+    try:
+        return json.loads((Path(repo_root) / "codex" / DURATIONS_FILE).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+
+def record_durations(repo_root: str, times: Dict[str, float]) -> None:
+    if not times:
+        return
+    path = Path(repo_root) / "codex" / DURATIONS_FILE
+    with _lock:
+        durations = load_durations(repo_root)
+        durations.update({test: round(seconds, 3) for test, seconds in times.items()})
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(durations, indent=1, sort_keys=True), encoding="utf-8")
+
+
+def split(tests: List[str], durations: Dict[str, float], count: int) -> List[List[str]]:
+    """Longest file first, each onto the shard with the least estimated time so far.
+
+    Files without a recorded duration count as the mean of the known ones.
+    """
+    known = [durations[t] for t in tests if t in durations]
+    default = sum(known) / len(known) if known else 1.0
+    shards: List[List[str]] = [[] for _ in range(max(1, min(count, len(tests))))]
+    loads = [0.0] * len(shards)
+    for test in sorted(tests, key=lambda t: (-durations.get(t, default), t)):
+        i = loads.index(min(loads))
+        shards[i].append(test)
+        loads[i] += durations.get(test, default)
+    return shards
+
+
+def read_junit(path: str, tests: List[str]) -> Tuple[Dict[str, int], Dict[str, float]]:
+    """(test/failure/error/skip counts, seconds per test file) from one JUnit report.
+
+    PHPUnit reports absolute paths as seen by the process that ran the tests
+    (possibly inside a container), so files are matched by path suffix.
+    """
+    totals = {"tests": 0, "failures": 0, "errors": 0, "skipped": 0}
+    times: Dict[str, float] = {}
+    try:
+        root = ET.parse(path).getroot()
+    except (OSError, ET.ParseError):
+        return totals, times
+    for case in root.iter("testcase"):
+        totals["tests"] += 1
+        for tag, key in (("failure", "failures"), ("error", "errors"), ("skipped", "skipped")):
+            if case.find(tag) is not None:
+                totals[key] += 1
+        file = (case.get("file") or "").replace("\\", "/")
+        match = next((t for t in tests if file == t or file.endswith("/" + t)), None)
+        if match:
+            times[match] = times.get(match, 0.0) + float(case.get("time") or 0)
+    return totals, times
+
+
+def run_all(commands: List[List[str]], cwd: str, envs: List[Dict[str, str]], timeout: Optional[float] = None,
+            on_line: Optional[Callable[[str], bool]] = None, echo: bool = False) -> Tuple[int, str]:
+    """Run the shard commands concurrently, prefixing their output with the shard number.
+
+    The first shard to fail (or the timeout, or the caller's cancel event) stops the rest; that
+    exit code is returned with the output tails, the failing shard's last. `on_line` sees each
+    prefixed line as executor.run's does; True fails that shard. Lines are printed only with `echo`,
+    since the shards' output interleaves.
+    """
+    done: "queue.Queue[Tuple[int, int]]" = queue.Queue()
+    tails = [deque(maxlen=TAIL_LINES) for _ in commands]
+    procs: List[subprocess.Popen] = []
+    pumps: List[threading.Thread] = []
+
+    def pump(i: int, proc: subprocess.Popen) -> None:
+        for line in iter(lambda: proc.stdout.readline(MAX_LINE), ""):
+            line = f"[{i + 1}] {line.rstrip()}"
+            if echo:
+                print(line, flush=True)
+            tails[i].append(line)
+            if on_line is not None and on_line(line + "\n"):
+                # The shard is cancelled with the rest; it reports once
+                done.put((i, 1))
+                return
+        done.put((i, proc.wait()))
+
+    for i, (cmd, env) in enumerate(zip(commands, envs)):
+        # Own process group, so cancelling reaches whatever the command started
+        proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+                                errors="replace", env={**os.environ, **env}, start_new_session=True)
+        procs.append(proc)
+        pumps.append(threading.Thread(target=pump, args=(i, proc), daemon=True))
+        pumps[-1].start()
+
+    deadline = time.monotonic() + timeout if timeout else None
+    event = cancel_event()
+    code, failed, finished = 0, None, 0
+    while finished < len(procs):
+        wait = CANCEL_POLL if event is not None else None
+        if deadline is not None:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                code = TIMEOUT
+                break
+            wait = min(wait, left) if wait else left
+        try:
+            i, rc = done.get(timeout=wait)
+        except queue.Empty:
+            if event is not None and event.is_set():
+                code = CANCELLED
+                break
+            continue
+        finished += 1
+        if rc != 0:
+            code, failed = rc, i
+            break
+    if code:
+        _cancel(procs)
+    for thread in pumps:
+        thread.join(CANCEL_GRACE)
+    order = [i for i in range(len(commands)) if i != failed] + ([failed] if failed is not None else [])
+    return code, "\n".join(line for i in order for line in tails[i])
+
+
+def _cancel(procs: List[subprocess.Popen]) -> None:
+    running = [p for p in procs if p.poll() is None]
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        for proc in running:
+            try:
+                os.killpg(proc.pid, sig)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + CANCEL_GRACE
+        for proc in running:
+            try:
+                proc.wait(max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                pass
+        running = [p for p in running if p.poll() is None]
+        if not running:
+            return
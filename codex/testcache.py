@@ -0,0 +1,80 @@
+from __future__ import annotations
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+# Results kept; the least recently used are dropped beyond this
+MAX_ENTRIES = int(os.environ.get("CODEX_TEST_CACHE_ENTRIES", "500"))
+# Characters of test output kept per result (the tail, where failures are reported)
+OUTPUT_CHARS = 4000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    tree TEXT NOT NULL,
+    passed INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    output TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    used_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_used ON results (used_at);
+"""
+
+
+def result_key(tree: str, command: Any, fingerprint: str) -> str:
+    return hashlib.sha256(f"{tree}\0{json.dumps(command)}\0{fingerprint}".encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """Test outcomes by tree hash, command and environment fingerprint, in SQLite with LRU eviction."""
+
+    def __init__(self, path: str, max_entries: int = MAX_ENTRIES):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        self.conn.executescript(SCHEMA)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE results SET used_at = ? WHERE key = ?", (time.time(), key))
+        return {**dict(row), "passed": bool(row["passed"])}
+
+    def put(self, key: str, tree: str, passed: bool, duration: float, output: str) -> None:
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO results (key, tree, passed, duration, output, created_at, used_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, tree, int(passed), round(duration, 3), output[-OUTPUT_CHARS:], now, now),
+            )
+            self.conn.execute(
+                "DELETE FROM results WHERE key NOT IN (SELECT key FROM results ORDER BY used_at DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+
+
+_caches: Dict[str, ResultCache] = {}
+_caches_lock = threading.Lock()
+
+
+def cache_for(repo_root: str, name: str = "test_cache.db") -> ResultCache:
+    """The shared cache `codex/<name>` (CODEX_TEST_CACHE_DB overrides the test result one)."""
+    default = str(Path(repo_root) / "codex" / name)
+    path = (os.environ.get("CODEX_TEST_CACHE_DB") or default) if name == "test_cache.db" else default
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = ResultCache(path)
+        return _caches[path]
@@ -0,0 +1,104 @@
+import os
+import subprocess
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+
+from codex.agent import deploy
+from codex.config import CodexConfig
+from codex.deploy import healthy, plan
+
+RULES = [
+    {"paths": ["tests/*", "*.md"], "build": []},
+    {"paths": ["app/*"], "build": ["php", "bot"]},
+    {"paths": ["public/*"], "build": ["nginx"]},
+    {"paths": ["config/cache.php"], "restart": ["php"]},
+]
+SERVICES = ["php", "nginx", "bot"]
+
+
+class PlanTest(unittest.TestCase):
+    def test_changed_paths_pick_services(self):
+        self.assertEqual(plan(["tests/Unit/ATest.php", "README.md"], RULES, SERVICES), ([], []))
+        self.assertEqual(plan(["public/app.css"], RULES, SERVICES), (["nginx"], []))
+        self.assertEqual(plan(["config/cache.php"], RULES, SERVICES), ([], ["php"]))
+        # A rebuild covers a restart; a path no rule knows rebuilds everything
+        self.assertEqual(plan(["app/A.php", "public/x.js", "config/cache.php"], RULES, SERVICES),
+                         (["php", "nginx", "bot"], []))
+        self.assertEqual(plan([".env.example"], RULES, SERVICES), (SERVICES, []))
+
+
+class HealthTest(unittest.TestCase):
+    def _get(self, healthy_after: dict, slow: str = ""):
+        calls = {url: 0 for url in healthy_after}
+
+        def get(url, timeout):
+            calls[url] += 1
+            if url == slow:
+                time.sleep(0.3)
+            if healthy_after[url] is None or calls[url] <= healthy_after[url]:
+                raise ConnectionError(url)
+            return SimpleNamespace(status_code=200)
+        return get, calls
+
+    def test_all_urls_are_probed_at_once_with_backoff(self):
+        get, calls = self._get({"http://a/": 3, "http://b/": 0})
+        started = time.monotonic()
+        self.assertTrue(healthy(list(calls), get, timeout=1, retries=10, backoff=0.05))
+        # 0.05 + 0.1 + 0.2 for a, while b answered at once
+        self.assertLess(time.monotonic() - started, 1.0)
+        self.assertEqual(calls, {"http://a/": 4, "http://b/": 1})
+
+    def test_one_url_out_of_retries_fails_the_rest_early(self):
+        get, calls = self._get({"http://down/": None, "http://slow/": 100}, slow="http://slow/")
+        self.assertFalse(healthy(list(calls), get, timeout=1, retries=3, backoff=0.05))
+        self.assertEqual(calls, {"http://down/": 3, "http://slow/": 1})
+
+
+class DeployTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.repo, self.log = os.path.join(tmp.name, "repo"), os.path.join(tmp.name, "deploys")
+        os.makedirs(self.repo)
+        for cmd in (["init", "-q"], ["config", "user.email", "t@t"], ["config", "user.name", "t"]):
+            subprocess.run(["git", *cmd], cwd=self.repo, check=True, capture_output=True)
+        self._commit("app/A.php", "<?php\n")
+        self.cfg = CodexConfig(
+            repo_root=self.repo, docker_compose="", php_container="", ai_url="", branch_prefix="", remote="",
+            push_mode="direct", restart_services=SERVICES,
+            deploy={"command": ["sh", "-c", f"echo build {{services}} >> {self.log}"],
+                    "restart_command": ["sh", "-c", f"echo restart {{services}} >> {self.log}"], "rules": RULES},
+        )
+
+    def _commit(self, path: str, text: str) -> str:
+        os.makedirs(os.path.dirname(os.path.join(self.repo, path)), exist_ok=True)
+        with open(os.path.join(self.repo, path), "w") as f:
+            f.write(text)
+        for cmd in (["add", "-A"], ["commit", "-qm", path]):
+            subprocess.run(["git", *cmd], cwd=self.repo, check=True, capture_output=True)
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=self.repo, check=True, capture_output=True,
+                              text=True).stdout.strip()
+
+    def _deploys(self) -> list:
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as f:
+            return f.read().splitlines()
+
+    def test_only_what_changed_since_the_last_deploy(self):
+        first = self._commit("tests/Unit/ATest.php", "<?php\n")
+        self.assertIsNone(deploy(self.cfg, f"{first}~1"))
+        self.assertEqual(self._deploys(), [])
+        self._commit("config/cache.php", "<?php\n")
+        self._commit("public/app.css", "a {}\n")
+        self.assertTrue(deploy(self.cfg, first))
+        self.assertEqual(self._deploys(), ["build nginx", "restart php"])
+        # Without a known deployed commit everything is deployed
+        self.assertTrue(deploy(self.cfg, ""))
+        self.assertEqual(self._deploys()[-1], "build php nginx bot")
+
+
+if __name__ == "__main__":
+    unittest.main()
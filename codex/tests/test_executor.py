@@ -0,0 +1,38 @@
+import os
+import tempfile
+import unittest
+
+from codex.executor import run
+
+
+class StreamingRunTest(unittest.TestCase):
+    def test_only_the_tail_is_kept_but_every_line_is_seen(self):
+        seen = []
+        code, out, err = run(["sh", "-c", "seq 1 1000; echo oops >&2"], on_line=seen.append, keep=3)
+        self.assertEqual(code, 0)
+        self.assertEqual(out, "[997 earlier lines not kept]\n998\n999\n1000\n")
+        self.assertEqual(err, "oops\n")
+        self.assertEqual(len(seen), 1001)
+
+    def test_callback_stops_the_command_at_the_first_failure(self):
+        # The callback returns True on the failure line; the shell's children die with it
+        code, out, _ = run(["sh", "-c", "echo ok; echo FAIL one; sleep 10; echo never"],
+                           on_line=lambda line: line.startswith("FAIL"))
+        self.assertEqual(code, 1)
+        self.assertEqual(out, "ok\nFAIL one\n")
+
+    def test_stopped_command_gets_to_clean_up(self):
+        # Like `docker compose run --rm`, which removes its container only on SIGTERM
+        with tempfile.TemporaryDirectory() as tmp:
+            marker = os.path.join(tmp, "cleaned")
+            script = f"trap 'touch {marker}; exit 143' TERM; echo FAIL; while :; do sleep 0.05; done"
+            code, _, _ = run(["sh", "-c", script], on_line=lambda line: line.startswith("FAIL"))
+            self.assertEqual(code, 1)
+            self.assertTrue(os.path.exists(marker))
+
+    def test_input_and_full_output_without_a_callback(self):
+        self.assertEqual(run(["cat"], input="a\nb"), (0, "a\nb", ""))
+
+
+if __name__ == "__main__":
+    unittest.main()
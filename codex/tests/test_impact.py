@@ -0,0 +1,135 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from codex.agent import check
+from codex.config import CodexConfig
+from codex.impact import build
+
+FILES = {
+    "app/Services/OrderService.php": """<?php
+namespace App\\Services;
+
+use App\\Models\\Order;
+
+class OrderService
+{
+    public function create(): Order { return new Order(); }
+}
+""",
+    "app/Services/MailService.php": """<?php
+namespace App\\Services;
+
+class MailService {}
+""",
+    "app/Models/Order.php": """<?php
+namespace App\\Models;
+
+/** @property Customer $customer */
+class Order
+{
+    public function customer() { return $this->belongsTo(Customer::class); }
+}
+""",
+    "app/Models/Customer.php": """<?php
+namespace App\\Models;
+
+class Customer {}
+""",
+    "tests/TestCase.php": """<?php
+namespace Tests;
+
+use App\\Services\\MailService;
+use App\\Services\\OrderService;
+
+abstract class TestCase
+{
+    protected OrderService $orderService;
+    protected MailService $mailService;
+}
+""",
+    "tests/Feature/OrderTest.php": """<?php
+namespace Tests\\Feature;
+
+use Tests\\TestCase;
+
+class OrderTest extends TestCase
+{
+    public function test_create(): void { $this->orderService->create(); }
+}
+""",
+    "tests/Feature/CustomerTest.php": """<?php
+namespace Tests\\Feature;
+
+use App\\Models\\Customer;
+use Tests\\TestCase;
+
+class CustomerTest extends TestCase
+{
+    public function test_new(): void { new Customer(); }
+}
+""",
+}
+
+
+class ImpactMapTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.repo = tmp.name
+        for path, source in FILES.items():
+            os.makedirs(os.path.dirname(os.path.join(self.repo, path)), exist_ok=True)
+            with open(os.path.join(self.repo, path), "w") as f:
+                f.write(source)
+        os.makedirs(os.path.join(self.repo, "codex"))
+        shutil.copyfile(os.path.join(os.path.dirname(__file__), "..", ".gitignore"),
+                        os.path.join(self.repo, "codex", ".gitignore"))
+        for cmd in (["init", "-q"], ["config", "user.email", "t@t"], ["config", "user.name", "t"],
+                    ["add", "-A"], ["commit", "-qm", "init"]):
+            subprocess.run(["git", *cmd], cwd=self.repo, check=True, capture_output=True)
+
+    def _impacted(self, *paths):
+        return build(self.repo, self.repo).impacted(paths)
+
+    def test_base_class_properties_count_only_when_used(self):
+        self.assertEqual(self._impacted("app/Services/OrderService.php"), ["tests/Feature/OrderTest.php"])
+        # TestCase imports MailService, but no test touches it
+        self.assertEqual(self._impacted("app/Services/MailService.php"), [])
+        self.assertEqual(len(self._impacted("tests/TestCase.php")), 2)
+
+    def test_relations_and_docblocks_are_not_dependencies(self):
+        self.assertEqual(self._impacted("app/Models/Customer.php"), ["tests/Feature/CustomerTest.php"])
+        self.assertEqual(self._impacted("app/Models/Order.php"), ["tests/Feature/OrderTest.php"])
+
+    def test_unmodelled_changes_need_the_full_suite(self):
+        self.assertIsNone(self._impacted("app/Models/Order.php", "config/app.php"))
+
+    def test_coverage_map_replaces_the_static_guess(self):
+        with open(os.path.join(self.repo, "coverage.json"), "w") as f:
+            f.write('{"tests/Feature/CustomerTest.php": ["app/Services/MailService.php"]}')
+        impact = build(self.repo, self.repo, "coverage.json")
+        self.assertEqual(impact.impacted(["app/Services/MailService.php"]), ["tests/Feature/CustomerTest.php"])
+        self.assertEqual(impact.impacted(["app/Models/Customer.php"]), [])
+
+    def test_failing_impacted_tests_skip_the_full_suite(self):
+        scratch = tempfile.TemporaryDirectory()
+        self.addCleanup(scratch.cleanup)
+        runs = os.path.join(scratch.name, "runs")
+        cfg = CodexConfig(
+            repo_root=self.repo, docker_compose="", php_container="", ai_url="", branch_prefix="", remote="",
+            push_mode="direct", tests={
+                "command": ["sh", "-c", f"echo full >> {runs}"],
+                "impacted_command": ["sh", "-c", f"echo '{{filter}}' >> {runs}; exit 1"],
+            },
+        )
+        with open(os.path.join(self.repo, "app/Services/OrderService.php"), "a") as f:
+            f.write("// changed\n")
+        self.assertFalse(check(cfg))
+        with open(runs) as f:
+            self.assertEqual(f.read().split(), ["(OrderTest)"])
+
+
+if __name__ == "__main__":
+    unittest.main()
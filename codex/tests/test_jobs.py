@@ -0,0 +1,252 @@
+import json
+import os
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+import urllib.request
+from unittest import mock
+
+from codex import jobs
+from codex.http_server import CodexServer
+from codex.jobs import JobRunner, JobStore
+
+
+class JobServerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.release = threading.Event()
+
+        def slow_propose(payload):
+            jobs.log(f"proposing {payload['prompt']}\n")
+            with jobs.span("ai", prompt=payload["prompt"]):
+                self.release.wait(5)
+            jobs.log("done\n")
+            return {"id": "prop-1", "title": payload["prompt"], "summary": "", "files": ["app/A.php"]}
+
+        self.applied = []
+
+        def apply(payload):
+            if payload["id"] == "prop-missing":
+                raise SystemExit("proposal not found: " + payload["id"])
+            self.applied.append(payload["id"])
+            return {"id": payload["id"]}
+
+        store = JobStore(os.path.join(self.tmp.name, "jobs.db"))
+        self.runner = JobRunner(store, {"propose": slow_propose, "apply": apply}, serial=("apply",),
+                                once=("apply",)).start()
+        self.server = CodexServer(self.runner, "127.0.0.1", 0).start()
+        self.base = f"http://127.0.0.1:{self.server.port}"
+
+    def tearDown(self):
+        self.release.set()
+        self.runner.stop()
+        self.server.stop()
+        self.runner.store.conn.close()
+        self.tmp.cleanup()
+
+    def _call(self, path, body=None, headers=False):
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib.request.Request(self.base + path, data=data, method="POST" if data else "GET")
+        try:
+            with urllib.request.urlopen(req, timeout=10) as r:
+                reply = r.status, json.loads(r.read()), r.headers
+        except urllib.error.HTTPError as e:
+            reply = e.code, json.loads(e.read()), e.headers
+        return reply if headers else reply[:2]
+
+    def test_propose_answers_at_once_and_can_be_polled(self):
+        t0 = time.monotonic()
+        code, body = self._call("/propose", {"prompt": "tezlashtir"})
+        self.assertEqual(code, 202)
+        self.assertLess(time.monotonic() - t0, 1.0)
+
+        _, job = self._call(f"/jobs/{body['job_id']}")
+        self.assertIn(job["state"], ("queued", "running"))
+        self.release.set()
+        while job["state"] in ("queued", "running"):
+            # Long poll: returns when the job leaves the state we last saw
+            _, job = self._call(f"/jobs/{body['job_id']}?wait=5&state={job['state']}")
+        self.assertEqual(job["state"], "succeeded")
+        self.assertEqual(job["result"]["files"], ["app/A.php"])
+
+    def test_post_with_wait_returns_the_result(self):
+        self.release.set()
+        code, body = self._call("/propose", {"prompt": "x", "wait": 5})
+        self.assertEqual(code, 200)
+        self.assertEqual(body["id"], "prop-1")
+
+    def test_failed_job_reports_error(self):
+        code, body = self._call("/apply", {"id": "prop-missing", "wait": 5})
+        self.assertEqual(code, 500)
+        self.assertIn("proposal not found", body["error"])
+
+    def test_events_stream_until_done(self):
+        _, body = self._call("/propose", {"prompt": "x"})
+        self.release.set()
+        with urllib.request.urlopen(f"{self.base}/jobs/{body['job_id']}/events", timeout=10) as r:
+            states = [json.loads(line[6:])["state"] for line in r.read().decode().splitlines() if line.startswith("data: ")]
+        self.assertEqual(states[-1], "succeeded")
+
+    def test_log_is_tailed_while_the_job_runs(self):
+        _, body = self._call("/propose", {"prompt": "x"})
+        _, tail = self._call(f"/jobs/{body['job_id']}/log?wait=5")
+        self.assertEqual((tail["state"], tail["text"]), ("running", "proposing x\n"))
+        self.release.set()
+        _, rest = self._call(f"/jobs/{body['job_id']}/log?wait=5&offset={tail['offset']}")
+        self.assertEqual(rest["text"], "done\n")
+        # A reconnecting event stream resumes after the last log event it saw
+        req = urllib.request.Request(f"{self.base}/jobs/{body['job_id']}/events?log=1",
+                                     headers={"Last-Event-ID": str(tail["offset"])})
+        with urllib.request.urlopen(req, timeout=10) as r:
+            events = r.read().decode().split("\n\n")
+        self.assertIn(f"id: {rest['offset']}\nevent: log\ndata: done", events)
+        self.assertFalse(any("proposing" in event for event in events))
+
+    def test_timeline_and_stats_show_where_time_went(self):
+        self.release.set()
+        _, body = self._call("/propose", {"prompt": "x", "wait": 5})
+        self._call("/apply", {"id": "prop-missing", "wait": 5})
+        _, timeline = self._call(f"/jobs/{body['job_id']}/timeline")
+        self.assertEqual([(sp["name"], sp["depth"]) for sp in timeline["spans"]], [("propose", 0), ("ai", 1)])
+        self.assertEqual(timeline["spans"][1]["prompt"], "x")
+        _, stats = self._call("/stats?days=1&slowest=2")
+        stages = {st["name"]: st for st in stats["stages"]}
+        self.assertEqual(set(stages), {"propose", "ai", "apply"})
+        self.assertEqual((stages["apply"]["count"], stages["apply"]["errors"]), (1, 1))
+        self.assertEqual(len(stats["slowest"]), 2)
+        self.assertEqual(stats["jobs"], {"succeeded": 1, "failed": 1})
+
+    def test_duplicate_prompt_joins_the_pending_job(self):
+        _, first = self._call("/propose", {"prompt": "bir xil"})
+        _, second = self._call("/propose", {"prompt": "bir xil"})
+        self.assertEqual(first["job_id"], second["job_id"])
+
+    def test_full_queue_is_refused_with_retry_after(self):
+        _, first = self._call("/propose", {"prompt": "x"})
+        with mock.patch.object(jobs, "MAX_QUEUED", 0):
+            code, body, headers = self._call("/propose", {"prompt": "y"}, headers=True)
+            self.assertEqual(code, 429)
+            self.assertEqual(headers["Retry-After"], str(body["retry_after"]))
+            # Joining a job that is already queued adds nothing, so it is still accepted
+            _, again = self._call("/propose", {"prompt": "x"})
+        self.assertEqual(again["job_id"], first["job_id"])
+
+    def test_proposal_is_applied_once(self):
+        code, first = self._call("/apply", {"id": "prop-1", "wait": 5})
+        self.assertEqual(code, 200)
+        _, second = self._call("/apply", {"id": "prop-1", "wait": 5})
+        self.assertEqual(second["job_id"], first["job_id"])
+        self.assertEqual(self.applied, ["prop-1"])
+        # A failed apply can be tried again
+        _, failed = self._call("/apply", {"id": "prop-missing", "wait": 5})
+        _, retried = self._call("/apply", {"id": "prop-missing"})
+        self.assertNotEqual(retried["job_id"], failed["job_id"])
+
+    def _raw(self, *chunks: bytes) -> bytes:
+        """Send `chunks` over one connection, each once the server has answered the one before; all replies."""
+        with socket.create_connection(("127.0.0.1", self.server.port), timeout=5) as sock:
+            replies = b""
+            for chunk in chunks:
+                sock.sendall(chunk)
+                replies += sock.recv(65536)
+            return replies
+
+    def test_chunked_body_is_refused_and_expect_continue_is_answered(self):
+        post = b"POST /propose HTTP/1.1\r\nHost: x\r\n"
+        reply = self._raw(post + b"Transfer-Encoding: chunked\r\n\r\n5\r\nhello\r\n0\r\n\r\n")
+        self.assertTrue(reply.startswith(b"HTTP/1.1 411 "))
+        self.assertIn(b"Connection: close", reply)
+        body = json.dumps({"prompt": "x"}).encode()
+        reply = self._raw(post + b"Expect: 100-continue\r\nContent-Length: %d\r\n\r\n" % len(body), body)
+        self.assertTrue(reply.startswith(b"HTTP/1.1 100 Continue\r\n\r\nHTTP/1.1 202 "))
+
+    def test_unexpected_error_answers_500(self):
+        with mock.patch.object(self.runner.store, "get", side_effect=sqlite3.OperationalError("database is locked")):
+            code, body = self._call("/jobs/job-1")
+        self.assertEqual((code, body), (500, {"error": "internal error"}))
+
+    def test_connections_are_served_without_a_thread_each(self):
+        threads = threading.active_count()
+        socks = [socket.create_connection(("127.0.0.1", self.server.port)) for _ in range(50)]
+        try:
+            _, body = self._call("/jobs/job-none")
+            self.assertEqual(body, {"error": "job not found"})
+            self.assertLess(threading.active_count(), threads + 5)
+        finally:
+            for sock in socks:
+                sock.close()
+
+
+class JobQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "jobs.db")
+        self.store = JobStore(self.path)
+        # Cleanups run last-in first-out: runners added by a test stop before the connection closes
+        self.addCleanup(self.tmp.cleanup)
+        self.addCleanup(self.store.conn.close)
+
+    def test_expired_lease_is_retried_then_dead_lettered(self):
+        job = self.store.create("propose", {"prompt": "x"}, max_attempts=2)
+        with mock.patch.object(jobs, "LEASE", -1):
+            # The worker holding it "dies": its lease is already over
+            self.assertEqual(self.store.claim(["propose"], "w1")["attempts"], 1)
+            self.assertEqual(self.store.claim(["propose"], "w2")["attempts"], 2)
+            self.assertIsNone(self.store.claim(["propose"], "w3"))
+        job = self.store.get(job["id"])
+        self.assertEqual(job["state"], "dead")
+        self.assertIn("lease expired (worker w2)", job["error"])
+        # A worker that lost its lease cannot settle the job any more
+        self.store.succeed(job["id"], "w2", {})
+        self.assertEqual(self.store.get(job["id"])["state"], "dead")
+
+    def test_failed_attempts_back_off_and_retry(self):
+        job = self.store.create("propose", {"prompt": "x"}, max_attempts=2)
+        self.store.claim(["propose"], "w1")
+        self.store.fail(job["id"], "w1", "timeout", retry=True)
+        self.assertEqual(self.store.get(job["id"])["state"], "queued")
+        self.assertIsNone(self.store.claim(["propose"], "w1"))
+        with mock.patch.object(jobs.time, "time", return_value=time.time() + jobs.RETRY_BACKOFF + 1):
+            self.assertIsNotNone(self.store.claim(["propose"], "w1"))
+        self.store.fail(job["id"], "w1", "timeout", retry=True)
+        self.assertEqual(self.store.get(job["id"])["state"], "dead")
+
+    def test_serial_jobs_exclusive_across_processes(self):
+        other = JobStore(self.path)
+        self.addCleanup(other.conn.close)
+        first = self.store.create("apply", {"id": "a"})
+        self.store.create("nudge", {"prompt": "b"})
+        serial = ["apply", "nudge"]
+        self.assertEqual(self.store.claim(serial, "w1", serial)["id"], first["id"])
+        self.assertIsNone(other.claim(serial, "w2", serial))
+        self.store.succeed(first["id"], "w1", {})
+        self.assertEqual(other.claim(serial, "w2", serial)["kind"], "nudge")
+
+    def test_purge_keeps_what_makes_a_job_run_once(self):
+        for kind in ("apply", "propose"):
+            job = self.store.create(kind, {"id": "prop-1"}, once=True)
+            self.store.claim([kind], "w1")
+            self.store.succeed(job["id"], "w1", {})
+        self.store.add_spans(job["id"], 1, [{"id": 1, "parent": None, "name": "x", "start": 0.0, "seconds": 1.0}])
+        with mock.patch.object(jobs.time, "time", return_value=time.time() + 86400):
+            self.assertEqual(self.store.purge(3600, keep=("apply",)), 1)
+        self.assertEqual(self.store.create("apply", {"id": "prop-1"}, once=True)["state"], "succeeded")
+        self.assertEqual(self.store.create("propose", {"id": "prop-1"}, once=True)["state"], "queued")
+        self.assertEqual(self.store.timeline(job["id"]), [])
+
+    def test_submit_wakes_an_idle_worker(self):
+        started = threading.Event()
+        runner = JobRunner(self.store, {"nudge": lambda p: started.set()}, serial=("nudge",)).start()
+        self.addCleanup(runner.stop)
+        time.sleep(0.1)
+        t0 = time.monotonic()
+        runner.submit("nudge", {"prompt": "x"})
+        self.assertTrue(started.wait(5))
+        self.assertLess(time.monotonic() - t0, jobs.POLL)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import subprocess
+import tempfile
+import unittest
+
+from codex.patches import apply, touched_paths
+
+EDIT_X = """diff --git a/app/x.txt b/app/x.txt
+--- a/app/x.txt
++++ b/app/x.txt
+@@ -1,3 +1,3 @@
+ a
+-b
++B
+ c
+"""
+STALE_Y = """--- a/app/y.txt
++++ b/app/y.txt
+@@ -1,3 +1,3 @@
+ 1
+-2
++two
+ 3
+@@ -5,3 +5,3 @@
+ 5
+-9
++Z
+ 7
+"""
+NEW_Z = """diff --git a/app/z.txt b/app/z.txt
+new file mode 100644
+--- /dev/null
++++ b/app/z.txt
+@@ -0,0 +1 @@
++z"""
+
+
+class PatchEngineTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.repo = tmp.name
+        os.makedirs(os.path.join(self.repo, "app"))
+        for name, text in (("x.txt", "a\nb\nc\n"), ("y.txt", "1\n2\n3\n4\n5\n6\n7\n")):
+            with open(os.path.join(self.repo, "app", name), "w") as f:
+                f.write(text)
+        for cmd in (["init", "-q"], ["config", "user.email", "t@t"], ["config", "user.name", "t"],
+                    ["add", "-A"], ["commit", "-qm", "init"]):
+            subprocess.run(["git", *cmd], cwd=self.repo, check=True, capture_output=True)
+
+    def _status(self) -> str:
+        return subprocess.run(["git", "status", "--porcelain"], cwd=self.repo, capture_output=True, text=True).stdout
+
+    def test_all_diffs_apply_together(self):
+        diffs = [{"path": "app/x.txt", "unified_diff": EDIT_X}, {"path": "app/z.txt", "unified_diff": NEW_Z}]
+        self.assertEqual(apply(self.repo, diffs, [], ["app/**"]), [])
+        self.assertEqual(self._status(), " M app/x.txt\n?? app/z.txt\n")
+
+    def test_one_bad_hunk_leaves_the_tree_untouched(self):
+        diffs = [{"path": "app/x.txt", "unified_diff": EDIT_X}, {"path": "app/y.txt", "unified_diff": STALE_Y},
+                 {"path": "app/z.txt", "unified_diff": NEW_Z}]
+        self.assertEqual(apply(self.repo, diffs, [], []), ["app/y.txt: hunk #2 (@@ -5,3 +5,3 @@) does not apply"])
+        self.assertEqual(self._status(), "")
+
+    def test_policy_covers_every_path_in_the_diff(self):
+        sneaky = {"path": "app/x.txt", "unified_diff": EDIT_X.replace("app/x.txt", ".env")}
+        self.assertEqual(apply(self.repo, [sneaky], [".env"], []), [".env: protected path"])
+        self.assertEqual(apply(self.repo, [{"path": "app/z.txt", "unified_diff": NEW_Z}], [], ["tests/**"]),
+                         ["app/z.txt: not in allow_paths"])
+        self.assertEqual(self._status(), "")
+
+    def test_removed_sql_comment_is_not_a_header(self):
+        diff = "--- a/db.sql\n+++ b/db.sql\n@@ -1,2 +1,2 @@\n--- old comment\n+-- new comment\n SELECT 1;\n"
+        self.assertEqual(touched_paths(diff), ["db.sql"])
+
+
+if __name__ == "__main__":
+    unittest.main()
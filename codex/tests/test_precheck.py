@@ -0,0 +1,89 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from codex.agent import prechecks
+from codex.config import CodexConfig
+
+FILES = {
+    "composer.json": '{"autoload": {"psr-4": {"App\\\\": "app/"}}}',
+    "app/Models/Order.php": "<?php\nnamespace App\\Models;\n\nclass Order {}\n",
+    "app/Services/OrderService.php": """<?php
+namespace App\\Services;
+
+use App\\Models\\Order;
+use App\\Models\\Legacy;
+
+class OrderService
+{
+    public function make(): Order { return new Order(); }
+}
+""",
+}
+
+
+class PrecheckTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.repo = os.path.join(tmp.name, "repo")
+        self.runs = os.path.join(tmp.name, "runs")
+        for path, source in FILES.items():
+            self._write(path, source)
+        os.makedirs(os.path.join(self.repo, "codex"))
+        shutil.copyfile(os.path.join(os.path.dirname(__file__), "..", ".gitignore"),
+                        os.path.join(self.repo, "codex", ".gitignore"))
+        for cmd in (["init", "-q"], ["config", "user.email", "t@t"], ["config", "user.name", "t"],
+                    ["add", "-A"], ["commit", "-qm", "init"]):
+            subprocess.run(["git", *cmd], cwd=self.repo, check=True, capture_output=True)
+        self.cfg = CodexConfig(
+            repo_root=self.repo, docker_compose="", php_container="", ai_url="", branch_prefix="", remote="",
+            push_mode="direct", precheck={
+                # Stands in for `php -l`: a file containing "syntax error" fails
+                "syntax": ["sh", "-c", f"echo {{file}} >> {self.runs}; ! grep -H 'syntax error' {{file}}"],
+            },
+        )
+
+    def _write(self, path: str, text: str) -> None:
+        os.makedirs(os.path.dirname(os.path.join(self.repo, path)), exist_ok=True)
+        with open(os.path.join(self.repo, path), "w") as f:
+            f.write(text)
+
+    def _linted(self) -> list:
+        if not os.path.exists(self.runs):
+            return []
+        with open(self.runs) as f:
+            return f.read().split()
+
+    def test_new_problems_are_reported_old_ones_are_not(self):
+        source = FILES["app/Services/OrderService.php"]
+        self._write("app/Services/OrderService.php", source.replace(
+            "return new Order();", "return new Order(); }\n    public function bill() { Invoice::make(); "))
+        self._write("app/Services/Billing.php", "<?php\nnamespace App\\Service;\n\nclass Billing {}\n")
+        self.assertCountEqual(prechecks(self.cfg), [
+            "app/Services/Billing.php: declares App\\Service\\Billing, which PSR-4 autoloads from app/Service/Billing.php",
+            "app/Services/OrderService.php:9: class App\\Services\\Invoice not found "
+            "(PSR-4 expects app/Services/Invoice.php)",
+        ])
+
+    def test_removed_class_must_not_be_referenced(self):
+        os.remove(os.path.join(self.repo, "app/Models/Order.php"))
+        self.assertEqual(prechecks(self.cfg),
+                         ["app/Services/OrderService.php:4: uses App\\Models\\Order, but app/Models/Order.php is gone"])
+
+    def test_syntax_results_are_cached_by_content(self):
+        self._write("app/Models/Order.php", "<?php\nnamespace App\\Models;\n\nclass Order { syntax error }\n")
+        errors = prechecks(self.cfg)
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith("app/Models/Order.php: app/Models/Order.php:"))
+        self.assertEqual(prechecks(self.cfg), errors)
+        self.assertEqual(self._linted(), ["app/Models/Order.php"])
+        self._write("app/Models/Order.php", "<?php\nnamespace App\\Models;\n\nclass Order { }\n")
+        self.assertEqual(prechecks(self.cfg), [])
+        self.assertEqual(len(self._linted()), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
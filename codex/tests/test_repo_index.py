@@ -0,0 +1,82 @@
+import os
+import subprocess
+import tempfile
+import unittest
+
+from codex.repo_index import RepoIndex, chunks, terms, tokens
+
+SERVICE = """<?php
+namespace App\\Services;
+
+class SupplyOrderService
+{
+    /**
+     * Close the order and book received goods into the warehouse.
+     */
+    public function closeOrder(SupplyOrder $order): void
+    {
+        $this->inventory->receive($order->items);
+    }
+
+    public function cancelOrder(SupplyOrder $order): void
+    {
+        $order->delete();
+    }
+}
+"""
+
+
+class RepoIndexTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.repo = os.path.join(tmp.name, "repo")
+        self._write("app/Services/SupplyOrderService.php", SERVICE)
+        self._write("app/Models/User.php", "<?php\nclass User { public function name() { return 'warehouse'; } }\n")
+        self._write("routes/web.php", "<?php\nRoute::get('/', fn () => view('welcome'));\n")
+        for cmd in (["init", "-q"], ["config", "user.email", "t@t"], ["config", "user.name", "t"],
+                    ["add", "-A"], ["commit", "-qm", "init"]):
+            subprocess.run(["git", *cmd], cwd=self.repo, check=True, capture_output=True)
+        self.index = RepoIndex(os.path.join(tmp.name, "index.db"))
+        self.addCleanup(self.index.conn.close)
+
+    def _write(self, path: str, text: str) -> None:
+        os.makedirs(os.path.dirname(os.path.join(self.repo, path)), exist_ok=True)
+        with open(os.path.join(self.repo, path), "w") as f:
+            f.write(text)
+
+    def _blobs(self) -> int:
+        return self.index.conn.execute("SELECT COUNT(DISTINCT blob) FROM chunks").fetchone()[0]
+
+    def test_methods_are_chunks_with_their_docblocks(self):
+        self.assertEqual(chunks("app/Services/SupplyOrderService.php", SERVICE), [
+            ("SupplyOrderService", 1, 5),
+            ("SupplyOrderService::closeOrder", 6, 13),
+            ("SupplyOrderService::cancelOrder", 14, 18),
+        ])
+        self.assertEqual(sorted(terms("closeOrder supply_order_id")),
+                         ["close", "closeorder", "order", "order", "supply", "supply_order_id"])
+
+    def test_only_new_blobs_are_indexed(self):
+        self.index.update(self.repo)
+        self.assertEqual(self._blobs(), 3)
+        self._write("routes/web.php", "<?php\nRoute::get('/home', fn () => view('home'));\n")
+        files = self.index.update(self.repo)
+        self.assertEqual(self._blobs(), 4)
+        snippets = self.index.search(self.repo, "home route")
+        self.assertEqual(snippets[0]["code"], "<?php\nRoute::get('/home', fn () => view('home'));")
+        self.assertEqual(len(files), 3)
+
+    def test_ranking_and_budget(self):
+        snippets = self.index.search(self.repo, "Closing a supply order should update the warehouse")
+        self.assertEqual((snippets[0]["path"], snippets[0]["lines"]), ("app/Services/SupplyOrderService.php", "6-13"))
+        # A file named in the prompt comes first
+        snippets = self.index.search(self.repo, "User.php: warehouse name is wrong")
+        self.assertEqual(snippets[0]["path"], "app/Models/User.php")
+        snippets = self.index.search(self.repo, "supply order warehouse", budget=60)
+        self.assertTrue(snippets)
+        self.assertLessEqual(sum(tokens(s["code"]) for s in snippets), 60)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from contextlib import redirect_stdout
+from io import StringIO
+
+from codex.agent import test_suite as run_tests
+from codex.config import CodexConfig
+from codex.shards import run_all, split
+
+# Stands in for `php artisan test --log-junit {junit} {tests}`: a test file containing
+# "sleep N" takes N seconds, one containing "fail" fails
+FAKE_RUNNER = """
+import os, sys, time
+junit, tests = sys.argv[1], sys.argv[2:]
+cases, failed = [], False
+for test in tests:
+    source = open(test).read()
+    seconds = float(source.split("sleep ")[1].split()[0]) if "sleep " in source else 0.0
+    time.sleep(seconds)
+    broken = "fail" in source
+    failed |= broken
+    cases.append('<testcase name="t" file="/var/www/%s" time="%s">%s</testcase>'
+                 % (test, seconds, "<failure>boom</failure>" if broken else ""))
+    print("ran", test)
+with open(junit, "w") as f:
+    f.write("<testsuites><testsuite>%s</testsuite></testsuites>" % "".join(cases))
+sys.exit(1 if failed else 0)
+"""
+
+
+class ShardSplitTest(unittest.TestCase):
+    def test_longest_files_are_spread_first(self):
+        durations = {"a": 8.0, "b": 5.0, "c": 4.0, "d": 3.0}
+        groups = split(["a", "b", "c", "d", "e"], durations, 2)
+        loads = [sum(durations.get(t, 5.0) for t in g) for g in groups]
+        self.assertEqual(sorted(loads), [12.0, 13.0])
+        self.assertEqual(sorted(t for g in groups for t in g), ["a", "b", "c", "d", "e"])
+        self.assertEqual(len(split(["a"], {}, 4)), 1)
+
+    def test_first_failure_cancels_the_other_shards(self):
+        started = time.monotonic()
+        code, out = run_all([["sh", "-c", "sleep 30"], ["sh", "-c", "echo broken; exit 3"]], ".", [{}, {}])
+        self.assertEqual(code, 3)
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertTrue(out.endswith("[2] broken"))
+
+    def test_stop_on_match_fails_the_shard_quietly(self):
+        printed = StringIO()
+        with redirect_stdout(printed):
+            code, out = run_all([["sh", "-c", "echo FAIL x; sleep 30"], ["sh", "-c", "sleep 30"]], ".", [{}, {}],
+                                on_line=lambda line: "FAIL" in line)
+        self.assertEqual(code, 1)
+        self.assertTrue(out.endswith("[1] FAIL x"))
+        self.assertEqual(printed.getvalue(), "")
+
+
+class ShardedSuiteTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.repo = tmp.name
+        os.makedirs(os.path.join(self.repo, "tests", "Feature"))
+        for name, body in (("ATest", "sleep 0.4"), ("BTest", "sleep 0.2"), ("CTest", "sleep 0.2"), ("DTest", "")):
+            with open(os.path.join(self.repo, "tests", "Feature", f"{name}.php"), "w") as f:
+                f.write(f"<?php // {body}\n")
+        os.makedirs(os.path.join(self.repo, "codex"))
+        shutil.copyfile(os.path.join(os.path.dirname(__file__), "..", ".gitignore"),
+                        os.path.join(self.repo, "codex", ".gitignore"))
+        for cmd in (["init", "-q"], ["config", "user.email", "t@t"], ["config", "user.name", "t"],
+                    ["add", "-A"], ["commit", "-qm", "init"]):
+            subprocess.run(["git", *cmd], cwd=self.repo, check=True, capture_output=True)
+        self.cfg = CodexConfig(
+            repo_root=self.repo, docker_compose="", php_container="", ai_url="", branch_prefix="", remote="",
+            push_mode="direct", tests={
+                "command": ["false"], "cache": False,
+                "shards": {"count": 2, "command": [sys.executable, "-c", FAKE_RUNNER, "{junit}", "{tests}"]},
+            },
+        )
+
+    def test_shards_merge_and_learn_durations(self):
+        self.assertTrue(run_tests(self.cfg))
+        with open(os.path.join(self.repo, "codex", "test_durations.json")) as f:
+            durations = json.load(f)
+        self.assertEqual(durations["tests/Feature/ATest.php"], 0.4)
+        self.assertEqual(len(durations), 4)
+        self.assertEqual(subprocess.run(["git", "status", "--porcelain"], cwd=self.repo,
+                                        capture_output=True, text=True).stdout, "")
+
+    def test_each_shard_is_set_up_once(self):
+        done = os.path.join(self.repo, "setup.log")
+        self.cfg.tests["shards"]["setup"] = ["sh", "-c", f"echo {{shard}} >> {done}"]
+        self.assertTrue(run_tests(self.cfg))
+        self.assertTrue(run_tests(self.cfg))
+        with open(done) as f:
+            self.assertEqual(sorted(f.read().split()), ["1", "2"])
+
+    def test_a_failing_file_fails_the_suite(self):
+        with open(os.path.join(self.repo, "tests", "Feature", "DTest.php"), "w") as f:
+            f.write("<?php // fail\n")
+        self.assertFalse(run_tests(self.cfg))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import os
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from codex import agent
+from codex.config import CodexConfig
+from codex.executor import CANCELLED, cancellable, run
+
+
+def _new_file_diff(path: str, text: str) -> dict:
+    diff = f"diff --git a/{path} b/{path}\nnew file mode 100644\n--- /dev/null\n+++ b/{path}\n@@ -0,0 +1 @@\n+{text}\n"
+    return {"path": path, "unified_diff": diff}
+
+
+class CancelTest(unittest.TestCase):
+    def test_cancel_kills_the_whole_command(self):
+        event = threading.Event()
+        threading.Timer(0.3, event.set).start()
+        started = time.monotonic()
+        with cancellable(event):
+            code, _, _ = run(["sh", "-c", "sleep 5; echo done"])
+        self.assertEqual(code, CANCELLED)
+        self.assertLess(time.monotonic() - started, 2)
+        with cancellable(event):
+            self.assertEqual(run(["true"])[0], CANCELLED)
+
+
+class SpeculativeTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.repo = tmp.name
+        os.makedirs(os.path.join(self.repo, "codex"))
+        with open(os.path.join(os.path.dirname(__file__), "..", ".gitignore")) as f:
+            ignored = f.read()
+        with open(os.path.join(self.repo, "codex", ".gitignore"), "w") as f:
+            f.write(ignored + ".last_good_sha\n")
+        for cmd in (["init", "-q"], ["config", "user.email", "t@t"], ["config", "user.name", "t"],
+                    ["add", "-A"], ["commit", "-qm", "init"]):
+            self._git(*cmd)
+        self.prompts = []
+        for patch in (mock.patch.object(agent, "CANDIDATES", 3), mock.patch.object(agent, "propose", self._propose),
+                      mock.patch.dict(os.environ, {"CODEX_CONTEXT": "0"})):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(self._join_losers)
+
+    def _git(self, *args) -> str:
+        return subprocess.run(["git", *args], cwd=self.repo, check=True, capture_output=True, text=True).stdout.strip()
+
+    def _join_losers(self):
+        for thread in threading.enumerate():
+            if thread.name.startswith("codex-candidate"):
+                thread.join(10)
+
+    def _cfg(self, test: str) -> CodexConfig:
+        return CodexConfig(
+            repo_root=self.repo, docker_compose="", php_container="", ai_url="", branch_prefix="codex/auto",
+            remote="origin", push_mode="direct", tests={"command": ["sh", "-c", test], "cache": False},
+            commit_message_template="{title}",
+        )
+
+    def _propose(self, url, prompt, context):
+        self.prompts.append(prompt)
+        if "fix failures only" in prompt:
+            return {"diffs": [_new_file_diff("app/fixed.txt", "fixed")] if "small" in prompt else []}
+        name = "good" if "small" in prompt else f"bad{len(self.prompts)}"
+        return {"title": name, "diffs": [_new_file_diff(f"app/{name}.txt", name)]}
+
+    def test_first_green_candidate_wins_and_the_rest_are_cancelled(self):
+        started = time.monotonic()
+        agent._run_prompt(self._cfg("test -f app/good.txt || { sleep 10; exit 1; }"), "add a file")
+        self.assertLess(time.monotonic() - started, 8)
+        self.assertEqual(len(set(self.prompts)), 3)
+        self.assertEqual(self._git("ls-files", "app"), "app/good.txt")
+        self.assertEqual(self._git("log", "-1", "--format=%s"), "good")
+
+    def test_failures_get_parallel_fixes(self):
+        agent._run_prompt(self._cfg("test -f app/fixed.txt"), "add a file")
+        self.assertEqual(len(self.prompts), 6)
+        landed = self._git("ls-files", "app").split()
+        self.assertIn("app/fixed.txt", landed)
+        self.assertEqual(len(landed), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+from codex.agent import test_suite as run_tests
+from codex.config import CodexConfig
+from codex.jobs import JobRunner, JobStore
+
+
+class TestResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.repo = os.path.join(tmp.name, "repo")
+        self.runs = os.path.join(tmp.name, "runs")
+        os.makedirs(os.path.join(self.repo, "codex"))
+        with open(os.path.join(self.repo, "app.txt"), "w") as f:
+            f.write("v1\n")
+        shutil.copyfile(os.path.join(os.path.dirname(__file__), "..", ".gitignore"),
+                        os.path.join(self.repo, "codex", ".gitignore"))
+        for cmd in (["init", "-q"], ["config", "user.email", "t@t"], ["config", "user.name", "t"],
+                    ["add", "-A"], ["commit", "-qm", "init"]):
+            subprocess.run(["git", *cmd], cwd=self.repo, check=True, capture_output=True)
+        self.cfg = CodexConfig(
+            repo_root=self.repo, docker_compose="", php_container="", ai_url="", branch_prefix="", remote="",
+            push_mode="direct", tests={"command": ["sh", "-c", f"echo run >> {self.runs}; grep -q v app.txt"],
+                                       "cache_env": ["APP_ENV"]},
+        )
+
+    def _runs(self) -> int:
+        if not os.path.exists(self.runs):
+            return 0
+        with open(self.runs) as f:
+            return len(f.readlines())
+
+    def test_same_tree_is_tested_once(self):
+        self.assertTrue(run_tests(self.cfg))
+        self.assertTrue(run_tests(self.cfg))
+        self.assertEqual(self._runs(), 1)
+        # Uncommitted edits are part of the tree hash
+        with open(os.path.join(self.repo, "app.txt"), "w") as f:
+            f.write("x\n")
+        self.assertFalse(run_tests(self.cfg))
+        self.assertFalse(run_tests(self.cfg))
+        self.assertEqual(self._runs(), 2)
+        # The index is left as it was
+        status = subprocess.run(["git", "status", "--porcelain"], cwd=self.repo, capture_output=True, text=True)
+        self.assertEqual(status.stdout.strip(), "M app.txt")
+
+    def test_environment_is_part_of_the_key(self):
+        run_tests(self.cfg)
+        with mock.patch.dict(os.environ, {"APP_ENV": "other"}):
+            run_tests(self.cfg)
+        self.assertEqual(self._runs(), 2)
+
+    def test_hits_are_recorded_on_the_job(self):
+        store = JobStore(os.path.join(self.repo, "codex", "jobs.db"))
+        self.addCleanup(store.conn.close)
+        runner = JobRunner(store, {"check": lambda p: [run_tests(self.cfg) for _ in range(3)]}, serial=()).start()
+        self.addCleanup(runner.stop)
+        job = store.wait(runner.submit("check", {})["id"], 10, "queued")
+        job = store.wait(job["id"], 10, "running")
+        self.assertEqual(job["state"], "succeeded")
+        self.assertEqual(job["stats"]["test_runs"], 1)
+        self.assertEqual(job["stats"]["test_cache_misses"], 1)
+        self.assertEqual(job["stats"]["test_cache_hits"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import unittest
+
+from codex.agent import apply_proposal
+from codex.config import CodexConfig
+
+
+def _new_file_diff(path: str, text: str) -> dict:
+    diff = f"diff --git a/{path} b/{path}\nnew file mode 100644\n--- /dev/null\n+++ b/{path}\n@@ -0,0 +1 @@\n+{text}\n"
+    return {"path": path, "unified_diff": diff}
+
+
+class WorktreeJobsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.repo = self.tmp.name
+        os.makedirs(os.path.join(self.repo, "codex", "proposals"))
+        with open(os.path.join(os.path.dirname(__file__), "..", ".gitignore")) as f:
+            ignored = f.read()
+        with open(os.path.join(self.repo, "codex", ".gitignore"), "w") as f:
+            f.write(ignored + "proposals/\n.last_good_sha\n")
+        for cmd in (["init", "-q"], ["config", "user.email", "t@t"], ["config", "user.name", "t"],
+                    ["add", "-A"], ["commit", "-qm", "init"]):
+            self._git(*cmd)
+        self.base = self._git("rev-parse", "HEAD")
+        self.cfg = CodexConfig(
+            repo_root=self.repo, docker_compose="", php_container="", ai_url="http://127.0.0.1:9",
+            branch_prefix="codex/auto", remote="origin", push_mode="direct",
+            tests={"command": ["sh", "-c", "sleep 0.3"]},
+        )
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _git(self, *args) -> str:
+        return subprocess.run(["git", *args], cwd=self.repo, check=True, capture_output=True, text=True).stdout.strip()
+
+    def _proposal(self, pid: str, *diffs: dict) -> None:
+        data = {"id": pid, "base_sha": self.base, "suggestion": {"title": pid, "diffs": list(diffs)}}
+        with open(os.path.join(self.repo, "codex", "proposals", f"{pid}.json"), "w") as f:
+            json.dump(data, f)
+
+    def _apply_all(self, *pids: str) -> dict:
+        errors = {}
+
+        def run(pid):
+            try:
+                apply_proposal(self.cfg, pid)
+            except SystemExit as e:
+                errors[pid] = e.code
+
+        threads = [threading.Thread(target=run, args=(pid,)) for pid in pids]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(30)
+        return errors
+
+    def test_concurrent_proposals_all_land(self):
+        self._proposal("prop-a", _new_file_diff("app/a.txt", "a"))
+        self._proposal("prop-b", _new_file_diff("app/b.txt", "b"))
+        self.assertEqual(self._apply_all("prop-a", "prop-b"), {})
+        self.assertEqual(self._git("rev-list", "--count", "HEAD"), "3")
+        self.assertEqual(self._git("status", "--porcelain"), "")
+        for name in ("a", "b"):
+            self.assertTrue(os.path.exists(os.path.join(self.repo, "app", f"{name}.txt")))
+
+    def test_commands_see_the_job_worktree_as_repo(self):
+        self._proposal("prop-a", _new_file_diff("app/a.txt", "a"))
+        # Before publishing, only the job's worktree has the change; {root} is the main checkout
+        self.cfg.tests = {"command": ["sh", "-c", "test -f {repo}/app/a.txt && test ! -e {root}/app/a.txt"
+                                                  " && test {root} = " + os.path.realpath(self.repo)]}
+        self.assertEqual(self._apply_all("prop-a"), {})
+        self.assertTrue(os.path.exists(os.path.join(self.repo, "app", "a.txt")))
+
+    def test_conflicting_proposal_is_rejected_without_touching_the_repo(self):
+        self._proposal("prop-a", _new_file_diff("app/a.txt", "a"))
+        self._proposal("prop-c", _new_file_diff("app/a.txt", "c"))
+        errors = self._apply_all("prop-a", "prop-c")
+        self.assertEqual(len(errors), 1)
+        self.assertIn("conflict", str(next(iter(errors.values()))))
+        self.assertEqual(self._git("rev-list", "--count", "HEAD"), "2")
+        self.assertEqual(self._git("status", "--porcelain"), "")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+from __future__ import annotations
+import fcntl
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator
+
+from .git_utils import git
+
+# Checkouts shared by every Codex process on this repo; each is used by one job at a time
+SLOTS = int(os.environ.get("CODEX_WORKTREES", "4"))
+
+
+class Workspaces:
+    """Pool of detached `git worktree` checkouts plus the lock for the main checkout.
+
+    Both are file locks (flock), so the HTTP server and `run-loop` share them.
+    A slot's directory is kept between jobs and reset to the requested commit,
+    which keeps ignored files such as vendor/ warm.
+    """
+
+    def __init__(self, repo_root: str, size: int = SLOTS):
+        self.repo_root = repo_root
+        self.size = max(1, size)
+        self.base = Path(os.environ.get("CODEX_WORKTREE_DIR") or Path(repo_root) / "codex" / "worktrees")
+        self.base.mkdir(parents=True, exist_ok=True)
+        with self._flock(self.base / "admin.lock"):
+            git(["worktree", "prune"], repo_root)
+
+    @contextmanager
+    def _flock(self, path: Path, blocking: bool = True) -> Iterator[bool]:
+        with open(path, "a+") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @contextmanager
+    def checkout(self, sha: str) -> Iterator[str]:
+        """Yield the path of a free worktree at `sha`; blocks while every slot is busy."""
+        while True:
+            for i in range(self.size):
+                with self._flock(self.base / f"wt-{i}.lock", blocking=False) as held:
+                    if held:
+                        yield self._prepare(self.base / f"wt-{i}", sha)
+                        return
+            time.sleep(0.2)
+
+    def _prepare(self, path: Path, sha: str) -> str:
+        if (path / ".git").exists():
+            code, _, _ = git(["checkout", "--detach", "--force", sha], str(path))
+            if code == 0:
+                git(["clean", "-fdq"], str(path))
+                return str(path)
+        # Adding one worktree while another job prunes can delete the new one's metadata halfway
+        with self._flock(self.base / "admin.lock"):
+            if (path / ".git").exists():
+                # Broken checkout: start over
+                git(["worktree", "remove", "--force", str(path)], self.repo_root)
+            git(["worktree", "prune"], self.repo_root)
+            code, _, err = git(["worktree", "add", "--detach", "--force", str(path), sha], self.repo_root)
+        if code != 0:
+            raise RuntimeError(f"git worktree add failed: {err.strip()}")
+        return str(path)
+
+    @contextmanager
+    def repo_lock(self) -> Iterator[None]:
+        """Exclusive use of the main checkout: integrate, push, deploy, roll back."""
+        with self._flock(self.base / "repo.lock"):
+            yield
+
+
+_pools: Dict[str, Workspaces] = {}
+
+
+def workspaces(repo_root: str) -> Workspaces:
+    key = os.path.realpath(repo_root)
+    if key not in _pools:
+        _pools[key] = Workspaces(repo_root)
+    return _pools[key]